@@ -61,6 +61,13 @@ int spits_job_manager_next_task(void *user_data,
 
 void spits_job_manager_finalize(void *user_data);
 
+/* Optional, generate up to count tasks in a single call, the i-th task */
+/* is pushed with jmctx[i]. Return the number of tasks generated, fewer */
+/* than count when there are no more tasks. */
+
+int spits_job_manager_next_tasks(void *user_data, spitssize_t count,
+    spitspush_t push_task, const spitsctx_t jmctx[]);
+
 /* Worker */
 
 void* spits_worker_new(int argc, const char *argv[]);
@@ -71,6 +78,13 @@ int spits_worker_run(void *user_data, const void* task,
 
 void spits_worker_finalize(void *user_data);
 
+/* Optional, run count tasks in a single call, the result of the i-th */
+/* task is pushed with taskctx[i] and its return code stored in rets[i] */
+
+void spits_worker_run_batch(void *user_data, spitssize_t count,
+    const void* const tasks[], const spitssize_t tasksz[],
+    spitspush_t push_result, const spitsctx_t taskctx[], int rets[]);
+
 /* Committer */
 
 void* spits_committer_new(int argc, const char *argv[],
@@ -79,6 +93,12 @@ void* spits_committer_new(int argc, const char *argv[],
 int spits_committer_commit_pit(void *user_data,
     const void* result, spitssize_t resultsz);
 
+/* Optional, commit count results in a single call, the return code of */
+/* the i-th commit is stored in rets[i] */
+
+void spits_committer_commit_pits(void *user_data, spitssize_t count,
+    const void* const results[], const spitssize_t resultsz[], int rets[]);
+
 int spits_committer_commit_job(void *user_data,
     spitspush_t push_final_result, spitsctx_t jobctx);
 
@@ -178,6 +178,21 @@ extern "C" int spits_job_manager_next_task(void *user_data,
     return jm->next_task(task) ? 1 : 0;
 }
 
+extern "C" int spits_job_manager_next_tasks(void *user_data,
+    spitssize_t count, spitspush_t push_task, const spitsctx_t jmctx[])
+{
+    class spitz::job_manager *jm = reinterpret_cast
+        <spitz::job_manager*>(user_data);
+
+    spitssize_t i;
+    for (i = 0; i < count; i++) {
+        spitz::pusher task(push_task, jmctx[i]);
+        if (!jm->next_task(task))
+            break;
+    }
+    return static_cast<int>(i);
+}
+
 extern "C" void spits_job_manager_finalize(void *user_data)
 {
     class spitz::job_manager *jm = reinterpret_cast
@@ -205,6 +220,20 @@ extern "C" int spits_worker_run(void *user_data, const void* task,
     return w->run(stask, result);
 }
 
+extern "C" void spits_worker_run_batch(void *user_data, spitssize_t count,
+    const void* const tasks[], const spitssize_t tasksz[],
+    spitspush_t push_result, const spitsctx_t taskctx[], int rets[])
+{
+    spitz::worker *w = reinterpret_cast
+        <spitz::worker*>(user_data);
+
+    for (spitssize_t i = 0; i < count; i++) {
+        spitz::istream stask(tasks[i], tasksz[i]);
+        spitz::pusher result(push_result, taskctx[i]);
+        rets[i] = w->run(stask, result);
+    }
+}
+
 extern "C" void spits_worker_finalize(void *user_data)
 {
     spitz::worker *w = reinterpret_cast
@@ -231,6 +260,19 @@ extern "C" int spits_committer_commit_pit(void *user_data,
     return co->commit_task(sresult);
 }
 
+extern "C" void spits_committer_commit_pits(void *user_data,
+    spitssize_t count, const void* const results[],
+    const spitssize_t resultsz[], int rets[])
+{
+    spitz::committer *co = reinterpret_cast
+        <spitz::committer*>(user_data);
+
+    for (spitssize_t i = 0; i < count; i++) {
+        spitz::istream sresult(results[i], resultsz[i]);
+        rets[i] = co->commit_task(sresult);
+    }
+}
+
 extern "C" int spits_committer_commit_job(void *user_data,
     spitspush_t push_final_result, spitsctx_t jobctx)
 {
@@ -22,8 +22,9 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
-from libspitz import JobBinary, SimpleEndpoint
-from libspitz import messaging, config
+from libspitz import JobBinary, SimpleEndpoint, ConnectionPool, LeaseHeap
+from libspitz import Speculator, Listener, ResultWatcher, CapacityTable
+from libspitz import messaging, config, codec
 from libspitz import memstat
 from libspitz import make_uid
 from libspitz import log_lines
@@ -32,6 +33,7 @@ from libspitz import PerfModule
 
 import Args
 import sys, threading, os, time, logging, struct, traceback
+import collections
 
 # Global configuration parameters
 jm_killtms = None # Kill task managers after execution
@@ -48,6 +50,24 @@ jm_profiling = None # 1 to enable profiling
 jm_perf_rinterv = None # Profiling report interval (seconds)
 jm_perf_subsamp = None # Number of samples collected between report intervals
 jm_heartbeat_interval = None
+jm_persistent = None # 1 to keep the sessions with the task managers open
+jm_push_window = None # 1 to stream windows of tasks to the task managers
+jm_pull_batch = None # Maximum results pulled per batch, 0 to pull one by one
+jm_pull_batch_bytes = None # Maximum payload bytes pulled per batch
+jm_codecs = None # Comma separated list of codecs offered to the task managers
+jm_codec_threshold = None # Minimum size of a compressed payload
+jm_async = None # 1 to serve the task managers concurrently with asyncio
+jm_max_inflight = None # Maximum concurrent exchanges with the task managers
+jm_tm_timeout = None # Maximum duration of an exchange, 0 for no limit
+jm_native_batch = None # Tasks generated or committed per call to the module
+jm_tm_workers = None # Number of workers requested to each TM, 0 to keep theirs
+jm_lease_time = None # Seconds before a pushed task is pushed again
+jm_max_copies = None # Maximum leases held on a task at the same time
+jm_speculate = None # Copy the tasks late by this multiple of the latency, 0 to disable
+jm_capacity = None # Capacity of the TMs to push them work by throughput, None to disable
+jm_notify = None # 1 to pull the results only when the TMs notify them
+jm_listen = None # Port where the task managers pull tasks, 0 to push them
+jm_listen_addr = None # Address where the task managers pull tasks
 jm_jobid = None
 
 ###############################################################################
@@ -57,7 +77,11 @@ def parse_global_config(argdict):
     global jm_killtms, jm_log_file, jm_verbosity, jm_heart_timeout, \
         jm_conn_timeout, jm_recv_timeout, jm_send_timeout, jm_send_backoff, \
         jm_recv_backoff, jm_memstat, jm_profiling, jm_perf_rinterv, \
-        jm_perf_subsamp, jm_heartbeat_interval, jm_jobid
+        jm_perf_subsamp, jm_heartbeat_interval, jm_jobid, jm_persistent, \
+        jm_push_window, jm_pull_batch, jm_pull_batch_bytes, jm_codecs, \
+        jm_codec_threshold, jm_async, jm_max_inflight, jm_tm_timeout, \
+        jm_native_batch, jm_tm_workers, jm_lease_time, jm_max_copies, \
+        jm_speculate, jm_listen, jm_listen_addr, jm_notify, jm_capacity
 
     def as_int(v):
         if v == None:
@@ -89,6 +113,27 @@ def parse_global_config(argdict):
     jm_perf_subsamp = as_int(argdict.get('subsamp', 12))
     jm_heartbeat_interval = as_float(argdict.get('heartbeat-interval', 10))
     jm_jobid = argdict.get('jobid', '')
+    jm_persistent = as_int(argdict.get('persistent', 1))
+    weighted = as_int(argdict.get('weighted', 0))
+    jm_capacity = CapacityTable() if weighted == 1 else None
+    # The share of the task managers is only enforced with windows
+    jm_push_window = as_int(argdict.get('window', weighted))
+    jm_pull_batch = as_int(argdict.get('rbatch', 0))
+    jm_pull_batch_bytes = as_int(argdict.get('rbatchsz', 64 * 1024 * 1024))
+    jm_codecs = argdict.get('compress', '')
+    jm_codec_threshold = as_int(argdict.get('cthreshold', 4096))
+    jm_async = as_int(argdict.get('async', 0))
+    jm_max_inflight = as_int(argdict.get('inflight', 16))
+    jm_tm_timeout = float(argdict.get('tmtimeout', 0))
+    jm_native_batch = max(as_int(argdict.get('nbatch', 1)), 1)
+    jm_tm_workers = max(as_int(argdict.get('tmworkers', 0)), 0)
+    jm_lease_time = float(argdict.get('lease', config.lease_time))
+    jm_speculate = float(argdict.get('speculate', 0))
+    jm_max_copies = max(as_int(argdict.get('copies',
+        2 if jm_speculate > 0 else 1)), 1)
+    jm_notify = as_int(argdict.get('notify', 0))
+    jm_listen = max(as_int(argdict.get('listen', 0)), 0)
+    jm_listen_addr = argdict.get('listenaddr', '0.0.0.0')
 
 ###############################################################################
 # Configure the log output format
@@ -153,6 +198,13 @@ def parse_node(cmd, proxies):
     if len(cmd) == 2:
         return (name, SimpleEndpoint(addr, port))
 
+    # Endpoint on the same host with payloads in shared memory
+    elif len(cmd) == 3:
+        if cmd[2] != config.mode_shm:
+            raise Exception()
+
+        return (name, SimpleEndpoint(addr, port, True))
+
     # Endpoint behind a proxy
     elif len(cmd) == 4:
         if cmd[2] != 'through':
@@ -240,36 +292,175 @@ def load_tm_list():
     return tms
 
 ###############################################################################
-# Exchange messages with an endpoint to begin pushing tasks
+# Reload the list of task managers, keeping the current one if the new list
+# is empty or could not be parsed
 ###############################################################################
-def setup_endpoint_for_pushing(e):
+def reload_tm_list(tmlist):
+    try:
+        newtmlist = load_tm_list()
+        if len(newtmlist) > 0:
+            return newtmlist
+        elif len(tmlist) > 0:
+            logging.warning('New list of task managers is ' +
+                'empty and will not be updated!')
+    except:
+        logging.error('Failed parsing task manager list!')
+    return tmlist
+
+###############################################################################
+# Exchange the job identifiers with a task manager, returns True if they
+# match
+###############################################################################
+def check_jobid(e):
+    # Send the job identifier
+    e.WriteString(jm_jobid)
+
+    # Verify job id of the answer
+    jobid = e.ReadString(jm_recv_timeout)
+
+    if jm_jobid != jobid:
+        logging.error('Job Id mismatch from %s:%d! Self: %s, task manager: %s!',
+            e.address, e.port, jm_jobid, jobid)
+        return False
+
+    return True
+
+###############################################################################
+# Exchange the job identifiers with a newly connected task manager, name is
+# its name in the list of task managers
+###############################################################################
+def setup_session(name, e):
+    if not check_jobid(e):
+        return False
+
+    # Negotiate the compression of the payloads
+    if jm_codecs != '':
+        e.WriteInt64(messaging.msg_set_codec)
+        e.WriteString(jm_codecs)
+        e.WriteInt64(jm_codec_threshold)
+        e.codec = codec.by_name(e.ReadString(jm_recv_timeout))
+        logging.debug('Using codec %s with %s:%d.', codec.name(e.codec),
+            e.address, e.port)
+
+    # Set the number of workers of the task manager
+    if jm_tm_workers > 0:
+        e.WriteInt64(messaging.msg_set_workers)
+        e.WriteInt64(jm_tm_workers)
+        logging.debug('Task manager at %s:%d is using %d workers.',
+            e.address, e.port, e.ReadInt64(jm_recv_timeout))
+
+    # Learn the capacity of the task manager before its first visit
+    if jm_capacity != None:
+        query_capacity(e, name)
+
+    return True
+
+###############################################################################
+# Ask a task manager for its capacity and record it under name
+###############################################################################
+def query_capacity(e, name):
+    e.WriteInt64(messaging.msg_query_capacity)
+    workers, free, rate = e.ReadHeader(messaging.capacity_header,
+        jm_recv_timeout)
+    jm_capacity.Update(name, workers, free, rate)
+    logging.debug('Task manager %s has %d workers and %d free slots ' +
+        'and runs %.2f tasks/s.', name, workers, free, rate)
+
+###############################################################################
+# Get the task managers in the order they are visited, the fastest first
+# when their capacity is known
+###############################################################################
+def order_tms(tmlist):
+    if jm_capacity == None:
+        return list(tmlist.items())
+    return [(name, tmlist[name]) for name in jm_capacity.Order(list(tmlist))]
+
+###############################################################################
+# Get the most tasks pushed to a task manager in a visit from its current
+# capacity, None for no limit
+###############################################################################
+def push_quota(name, tm):
+    if jm_capacity == None:
+        return None
+    jm_capacity.Visit(name)
+    try:
+        query_capacity(tm, name)
+    except:
+        # The session is dropped by the pushing loop
+        logging.warning('Error querying the capacity of task manager ' +
+            'at %s:%d!', tm.address, tm.port)
+        log_lines(traceback.format_exc(), logging.debug)
+        tm.Close()
+    return jm_capacity.Quota(name)
+
+###############################################################################
+# Open a session with a task manager to be told when its results are ready,
+# returns None if it failed
+###############################################################################
+def subscribe_results(name, endpoint):
+    e = SimpleEndpoint(endpoint.address, endpoint.port)
     try:
-        # Try to connect to a task manager
         e.Open(jm_conn_timeout)
+        if check_jobid(e):
+            e.WriteInt64(messaging.msg_watch_results)
+            e.WriteInt64(config.notify_bytes)
+            return e
     except:
-        # Problem connecting to the task manager
         # Because this is a connection event,
         # make it a debug rather than a warning
-        logging.debug('Error connecting to task manager at %s:%d!',
-            e.address, e.port)
+        logging.debug('Error subscribing to the results of %s!', name)
         log_lines(traceback.format_exc(), logging.debug)
-        e.Close()
-        return
-    try:
-        # Send the job identifier
-        e.WriteString(jm_jobid)
+    e.Close()
+    return None
 
-        # Ask if it is possible to send tasks
-        e.WriteInt64(messaging.msg_send_task)
+###############################################################################
+# Start watching the results of the task managers, None if disabled
+###############################################################################
+def make_result_watcher():
+    if jm_notify != 1:
+        return None
+    watcher = ResultWatcher(subscribe_results)
+    watcher.start()
+    return watcher
+
+###############################################################################
+# Check if the results must be pulled from a task manager, either because it
+# notified them or because it was not polled for too long
+###############################################################################
+def results_due(watcher, sweeps, name):
+    if watcher == None:
+        return True
+    now = time.time()
+    if watcher.Take(name) or now >= sweeps.get(name, 0):
+        sweeps[name] = now + config.notify_sweep
+        return True
+    return False
 
-        # Verify job id of the answer
-        jobid = e.ReadString(jm_recv_timeout)
+###############################################################################
+# Send a task, compressing it if a codec was negotiated
+###############################################################################
+def write_task(tm, taskid, runid, task):
+    if tm.codec == None:
+        tm.WriteMessage(messaging.task_header, (taskid, runid,
+            len(task) if task != None else 0), task)
+    else:
+        c, task = codec.encode(tm.codec, task, jm_codec_threshold)
+        tm.WriteMessage(messaging.ctask_header, (taskid, runid,
+            len(task) if task != None else 0, c), task)
 
-        if jm_jobid != jobid:
-            logging.error('Job Id mismatch from %s:%d! Self: %s, task manager: %s!',
-                e.address, e.port, jm_jobid, jobid)
-            e.Close()
-            return False
+###############################################################################
+# Create the pool of sessions with the task managers
+###############################################################################
+def make_session_pool():
+    return ConnectionPool(setup_session, jm_persistent == 1)
+
+###############################################################################
+# Exchange messages with an endpoint to begin pushing tasks
+###############################################################################
+def setup_endpoint_for_pushing(e):
+    try:
+        # Ask if it is possible to send tasks
+        e.WriteInt64(messaging.msg_send_task)
 
         # Wait for a response
         response = e.ReadInt64(jm_recv_timeout)
@@ -278,6 +469,7 @@ def setup_endpoint_for_pushing(e):
             # Task mananger is full
             logging.debug('Task manager at %s:%d is full.',
                 e.address, e.port)
+            return False
 
         elif response == messaging.msg_send_more:
             # Continue to the task pushing loop
@@ -301,33 +493,8 @@ def setup_endpoint_for_pushing(e):
 ###############################################################################
 def setup_endpoint_for_pulling(e):
     try:
-        # Try to connect to a task manager
-        e.Open(jm_conn_timeout)
-    except:
-        # Problem connecting to the task manager
-        # Because this is a connection event,
-        # make it a debug rather than a warning
-        logging.debug('Error connecting to task manager at %s:%d!',
-            e.address, e.port)
-        log_lines(traceback.format_exc(), logging.debug)
-        e.Close()
-        return
-    try:
-        # Send the job identifier
-        e.WriteString(jm_jobid)
-
-        # Ask if it is possible to send tasks
+        # Ask if it is possible to read results
         e.WriteInt64(messaging.msg_read_result)
-
-        # Verify job id of the answer
-        jobid = e.ReadString(jm_recv_timeout)
-
-        if jm_jobid != jobid:
-            logging.error('Job Id mismatch from %s:%d! Self: %s, task manager: %s!',
-                e.address, e.port, jm_jobid, jobid)
-            e.Close()
-            return False
-
         return True
 
     except:
@@ -339,10 +506,89 @@ def setup_endpoint_for_pulling(e):
     e.Close()
     return False
 
+###############################################################################
+# Generate up to count tasks, returns 1 if the tasks were generated, 0 if
+# there are no more tasks and -1 if the generation failed, along with the
+# last task id and the tasks generated before that
+###############################################################################
+def generate_tasks(job, jm, taskid, tasklist, count):
+    tasks = []
+    failed = False
+    # The i-th task is generated with the context taskid + 1 + i, the
+    # failed tasks do not take an id
+    firstctx = taskid + 1
+    results = job.spits_job_manager_next_tasks(jm, count, firstctx)
+    for i, (r1, newtask, ctx) in enumerate(results):
+        # Exit if done
+        if r1 == 0:
+            return (0, taskid, tasks)
+
+        if newtask == None:
+            logging.error('Task %d was not pushed!', firstctx + i)
+            failed = True
+            continue
+
+        if ctx != firstctx + i:
+            logging.error('Context verification failed for task %d!',
+                firstctx + i)
+            failed = True
+            continue
+
+        # Add the generated task to the tasklist
+        taskid += 1
+        task = newtask[0]
+        # The tasklist keeps the crashes of each task with its payload
+        tasklist[taskid] = (0, task)
+        tasks.append((taskid, task))
+
+        logging.debug('Generated task %d with payload size of %d bytes.',
+            taskid, len(task) if task != None else 0)
+
+    return (-1 if failed else 1, taskid, tasks)
+
+###############################################################################
+# Create the task generator. The tasks are generated jm_native_batch at a
+# time and handed out one by one, generate returns 1 if a task was
+# generated, 0 if there are no more tasks and -1 if the generation failed
+###############################################################################
+def make_generator(job, jm, tasklist):
+    ahead = [] # (taskid, task) generated but not handed out yet
+    state = [1, 0] # Result of the last generation and last task id
+
+    def generate(taskid):
+        if len(ahead) == 0 and state[0] == 1:
+            state[0], state[1], tasks = generate_tasks(job, jm, state[1],
+                tasklist, jm_native_batch)
+            ahead.extend(tasks)
+
+        if len(ahead) > 0:
+            taskid, task = ahead.pop(0)
+            return (1, taskid, task)
+
+        r1 = state[0]
+        if r1 < 0:
+            # Try again on the next call
+            state[0] = 1
+        return (r1, state[1], None)
+
+    return generate
+
+###############################################################################
+# Get the next timed out task that is still pending, returns (0, None) if
+# there is none
+###############################################################################
+def pop_retry(retry, tasklist):
+    while len(retry) > 0:
+        taskid = retry.popleft()
+        p = tasklist.get(taskid, None)
+        if p != None:
+            return (taskid, p[1])
+    return (0, None)
+
 ###############################################################################
 # Push tasks while the task manager is not full
 ###############################################################################
-def push_tasks(job, runid, jm, tm, taskid, task, tasklist, completed):
+def push_tasks(generate, runid, tm, taskid, task, completed):
     # Keep pushing until finished or the task manager is full
     sent = []
     while True:
@@ -351,44 +597,27 @@ def push_tasks(job, runid, jm, tm, taskid, task, tasklist, completed):
             # Avoid calling next_task after it's finished
             if completed:
                 logging.debug('There are no new tasks to generate.')
+                # The task manager is still waiting for a task
+                tm.Close()
                 return (True, 0, None, sent)
 
             # Only get a task if the last one was already sent
-            newtaskid = taskid + 1
-            r1, newtask, ctx = job.spits_job_manager_next_task(jm, newtaskid)
+            r1, taskid, task = generate(taskid)
 
             # Exit if done
             if r1 == 0:
+                tm.Close()
                 return (True, 0, None, sent)
 
-            if newtask == None:
-                logging.error('Task %d was not pushed!', newtaskid)
-                return (False, taskid, task, sent)
-
-            if ctx != newtaskid:
-                logging.error('Context verification failed for task %d!',
-                    newtaskid)
+            if r1 < 0:
+                tm.Close()
                 return (False, taskid, task, sent)
 
-            # Add the generated task to the tasklist
-            taskid = newtaskid
-            task = newtask[0]
-            tasklist[taskid] = (0, task)
-
-            logging.debug('Generated task %d with payload size of %d bytes.',
-                taskid, len(task) if task != None else 0)
-
         try:
             logging.debug('Pushing %d...', taskid)
 
             # Push the task to the active task manager
-            tm.WriteInt64(taskid)
-            tm.WriteInt64(runid)
-            if task == None:
-                tm.WriteInt64(0)
-            else:
-                tm.WriteInt64(len(task))
-                tm.Write(task)
+            write_task(tm, taskid, runid, task)
 
             # Wait for a response
             response = tm.ReadInt64(jm_recv_timeout)
@@ -397,7 +626,7 @@ def push_tasks(job, runid, jm, tm, taskid, task, tasklist, completed):
                 # Task was sent, but the task manager is now full
                 sent.append((taskid, task))
                 task = None
-                break
+                return (False, taskid, task, sent)
 
             elif response == messaging.msg_send_more:
                 # Continue pushing tasks
@@ -424,12 +653,294 @@ def push_tasks(job, runid, jm, tm, taskid, task, tasklist, completed):
             log_lines(traceback.format_exc(), logging.debug)
             break
 
+    # The exchange was interrupted, the session cannot be reused
+    tm.Close()
     return (False, taskid, task, sent)
 
+###############################################################################
+# Push windows of tasks while the task manager has free slots, up to limit
+# tasks if it is not None
+###############################################################################
+def push_tasks_window(generate, runid, tm, taskid, task, completed,
+    limit=None):
+    sent = []
+    finished = False
+    try:
+        while not finished:
+            # Leave the rest of the tasks to the other task managers
+            if limit != None and len(sent) >= limit:
+                break
+
+            # Ask how many tasks the task manager can take
+            tm.WriteInt64(messaging.msg_send_window)
+            nfree = tm.ReadInt64(jm_recv_timeout)
+
+            if nfree <= 0:
+                logging.debug('Task manager at %s:%d is full.',
+                    tm.address, tm.port)
+                break
+
+            if limit != None:
+                nfree = min(nfree, limit - len(sent))
+
+            # Fill the window, starting with the pending task
+            window = []
+            if task != None:
+                window.append((taskid, task))
+                task = None
+
+            while len(window) < nfree and not completed:
+                r1, taskid, newtask = generate(taskid)
+                if r1 == 0:
+                    finished = True
+                    break
+                if r1 < 0:
+                    break
+                window.append((taskid, newtask))
+
+            if completed:
+                finished = True
+
+            logging.debug('Pushing %d tasks...', len(window))
+
+            # Stream the whole window without waiting for replies
+            tm.WriteInt64(len(window))
+            for wtaskid, wtask in window:
+                write_task(tm, wtaskid, runid, wtask)
+
+            # A single acknowledgement lists the rejected tasks
+            rejected = tm.ReadInt64Array(jm_recv_timeout)
+
+            # Rejected tasks are not predicted for a model where just one
+            # task manager pushes tasks, leave them to the fault tolerance
+            # system and stop pushing to this task manager
+            sent = sent + window
+            if len(rejected) > 0:
+                logging.warning('Task manager at %s:%d rejected tasks %s',
+                    tm.address, tm.port, rejected)
+                break
+
+            # The generation failed, retry on the next round
+            if len(window) < nfree and not finished:
+                break
+
+    except:
+        # Something went wrong with the connection,
+        # try with another task manager
+        logging.error('Error pushing tasks to task manager!')
+        log_lines(traceback.format_exc(), logging.debug)
+        tm.Close()
+
+    if finished:
+        return (True, 0, None, sent)
+    return (False, taskid, task, sent)
+
+###############################################################################
+# Validate a result received from a task manager, returns True if it must
+# be committed
+###############################################################################
+def accept_result(runid, taskid, taskrunid, r, tasklist, completed):
+    if r != 0:
+        if r == messaging.as_result(messaging.res_module_error):
+            logging.error('The remote worker crashed while ' +
+                'executing task %d!', taskid)
+        else:
+            logging.error('The task %d was not successfully executed, ' +
+                'worker returned %d!', taskid, r)
+
+    if taskrunid < runid:
+        logging.debug('The task %d is from the previous run %d ' +
+            'and will be ignored!', taskid, taskrunid)
+        return False
+
+    if taskrunid > runid:
+        logging.error('Received task %d from a future run %d!',
+            taskid, taskrunid)
+        return False
+
+    # Validated completed task
+
+    c = completed.get(taskid, (None, None))
+    if c[0] != None:
+        # This may happen with the fault tolerance system. This may
+        # lead to tasks being put in the tasklist by the job manager
+        # while being committed. The tasklist must be constantly
+        # sanitized.
+        logging.warning('The task %d was received more than once ' +
+            'and will not be committed again!',
+            taskid)
+        # Removed the completed task from the tasklist
+        tasklist.pop(taskid, (None, None))
+        return False
+
+    # Remove it from the tasklist
+
+    p = tasklist.pop(taskid, (None, None))
+    if p[0] == None and c[0] == None:
+        # The task was not already completed and was not scheduled
+        # to be executed, this is serious problem!
+        logging.error('The task %d was not in the working list!',
+            taskid)
+
+    return True
+
+###############################################################################
+# Collect the partial results streamed by an attempt of a task, returns the
+# return code of the task and its results once the end record and all the
+# partial results were received, None otherwise
+###############################################################################
+def collect_stream(streams, taskid, r, res, rescodec, completed):
+    attempt, seq, end = messaging.parse_stream_result(r)
+    key = (taskid, attempt)
+    if completed.get(taskid, (None, None))[0] != None:
+        # The task was already committed
+        streams.pop(key, None)
+        return None
+
+    # The end record and the partial results by sequence number, the
+    # results put back in the queue of the task manager arrive late
+    s = streams.setdefault(key, [None, {}])
+    if end:
+        s[0] = (messaging.int64_header.unpack_from(codec.decode(rescodec,
+            res))[0], seq)
+    else:
+        s[1][seq] = codec.decode(rescodec, res)
+    if s[0] == None or len(s[1]) < s[0][1]:
+        return None
+
+    del streams[key]
+    return s[0][0], [s[1][i] for i in range(s[0][1])]
+
+###############################################################################
+# Validate and commit the results received from a task manager, up to
+# jm_native_batch per call to the module, returns the number of tasks that
+# were not successfully executed. The partial results are kept in streams
+# until their task ends
+###############################################################################
+def commit_results(job, runid, co, results, tasklist, completed, streams,
+    retry=None, speculator=None):
+    n_errors = 0
+    accepted = [] # (taskid, r, [results])
+    seen = set()
+    for taskid, taskrunid, r, res, rescodec in results:
+        parts = None
+        if r == messaging.as_result(messaging.res_module_timeout):
+            # The task is still pending, push it again before new ones
+            if (taskrunid == runid and taskid in tasklist and
+                    completed.get(taskid, (None, None))[0] == None and
+                    retry != None):
+                logging.warning('The task %d timed out and will be ' +
+                    'scheduled again!', taskid)
+                retry.append(taskid)
+            continue
+
+        # The task crashed its worker, push it again a few times before
+        # giving up on it, the attempts are kept in the tasklist
+        crashed = r == messaging.as_result(messaging.res_module_error)
+        p = tasklist.get(taskid, None)
+        if (crashed and taskrunid == runid and p != None and
+                completed.get(taskid, (None, None))[0] == None and
+                retry != None and p[0] < config.crash_retries):
+            logging.warning('The task %d crashed its worker and will be ' +
+                'scheduled again, attempt %d of %d!', taskid, p[0] + 1,
+                config.crash_retries)
+            tasklist[taskid] = (p[0] + 1, p[1])
+            retry.append(taskid)
+            continue
+
+        if messaging.parse_stream_result(r) != None:
+            if taskrunid != runid:
+                continue
+            try:
+                collected = collect_stream(streams, taskid, r, res,
+                    rescodec, completed)
+            except:
+                logging.error('Error collecting the results of task %d!',
+                    taskid)
+                log_lines(traceback.format_exc(), logging.debug)
+                continue
+            if collected == None:
+                continue
+            r, parts = collected
+
+        if r != 0:
+            n_errors += 1
+
+        # The same task may appear twice in a batch, it is only
+        # marked completed after the commit
+        if taskid in seen:
+            logging.warning('The task %d was received more than once ' +
+                'and will not be committed again!',
+                taskid)
+            continue
+
+        if not accept_result(runid, taskid, taskrunid, r, tasklist,
+                completed):
+            continue
+        seen.add(taskid)
+
+        # Drop the partial results of the other attempts
+        for key in [k for k in streams if k[0] == taskid]:
+            del streams[key]
+
+        # There is no result to commit from a task that crashed every
+        # attempt, it is recorded as failed
+        if crashed:
+            logging.error('Giving up on task %d, it crashed every attempt!',
+                taskid)
+            completed[taskid] = (r, None)
+            if speculator != None:
+                speculator.Commit(taskid)
+            continue
+
+        try:
+            if parts == None:
+                parts = [codec.decode(rescodec, res)]
+            accepted.append((taskid, r, parts))
+        except:
+            logging.error('Error decoding the result of task %d!', taskid)
+            log_lines(traceback.format_exc(), logging.debug)
+
+    # Every result is committed with its own commit_pit, do not let one
+    # task stop the others from being committed
+    pits = [(i, res) for i, (taskid, r, parts) in enumerate(accepted)
+        for res in parts]
+    r2s = [0] * len(accepted)
+    failed = set()
+    for j in range(0, len(pits), jm_native_batch):
+        chunk = pits[j:j + jm_native_batch]
+        try:
+            rets = job.spits_committer_commit_pits(co, [x[1] for x in chunk])
+        except:
+            logging.error('Error committing tasks %s!',
+                sorted(set(accepted[x[0]][0] for x in chunk)))
+            log_lines(traceback.format_exc(), logging.debug)
+            failed.update(x[0] for x in chunk)
+            continue
+
+        for (i, res), r2 in zip(chunk, rets):
+            if r2s[i] == 0:
+                r2s[i] = r2
+
+    for i, (taskid, r, parts) in enumerate(accepted):
+        if i in failed:
+            continue
+
+        if r2s[i] != 0:
+            logging.error('The task %d was not successfully committed, ' +
+                'committer returned %d', taskid, r2s[i])
+
+        # Add completed task to list
+        completed[taskid] = (r, r2s[i])
+        if speculator != None:
+            speculator.Commit(taskid)
+
+    return n_errors
+
 ###############################################################################
 # Read and commit tasks while the task manager is not empty
 ###############################################################################
-def commit_tasks(job, runid, co, tm, tasklist, completed):
+def commit_tasks(commit, tm):
     # Keep pulling until finished or the task manager is full
     n_errors = 0
     while True:
@@ -441,13 +952,16 @@ def commit_tasks(job, runid, co, tm, tasklist, completed):
                 # No more task to receive
                 return
 
-            # Read the run id
-            taskrunid = tm.ReadInt64(jm_recv_timeout)
-
-            # Read the rest of the task
-            r = tm.ReadInt64(jm_recv_timeout)
-            ressz = tm.ReadInt64(jm_recv_timeout)
-            res = tm.Read(ressz, jm_recv_timeout)
+            # Read the rest of the task, the run id, result, size and
+            # codec have the same layout of a task header
+            if tm.codec == None:
+                taskrunid, r, ressz = tm.ReadHeader(messaging.task_header,
+                    jm_recv_timeout)
+                c = codec.codec_none
+            else:
+                taskrunid, r, ressz, c = tm.ReadHeader(
+                    messaging.ctask_header, jm_recv_timeout)
+            res = tm.ReadPayload(ressz, jm_recv_timeout)
 
             # Tell the task manager that the task was received
             tm.WriteInt64(messaging.msg_read_result)
@@ -455,62 +969,77 @@ def commit_tasks(job, runid, co, tm, tasklist, completed):
             # Warning, exceptions after this line may cause task loss
             # if not handled properly!!
 
-            if r != 0:
-                n_errors += 1
-                if r == messaging.res_module_error:
-                    logging.error('The remote worker crashed while ' +
-                        'executing task %d!', r)
-                else:
-                    logging.error('The task %d was not successfully executed, ' +
-                        'worker returned %d!', taskid, r)
+            n_errors += commit([(taskid, taskrunid, r, res, c)])
 
-            if taskrunid < runid:
-                logging.debug('The task %d is from the previous run %d ' +
-                    'and will be ignored!', taskid, taskrunid)
-                continue
+        except:
+            # Something went wrong with the connection,
+            # try with another task manager
+            tm.Close()
+            break
+    if n_errors > 0:
+        logging.warn('There were %d failed tasks' % (n_errors, ))
 
-            if taskrunid > runid:
-                logging.error('Received task %d from a future run %d!',
-                    taskid, taskrunid)
-                continue
+###############################################################################
+# Read a batch of results, returns the results and their size in bytes
+###############################################################################
+def read_results(tm, nresults):
+    batch = []
+    batchsz = 0
+    for i in range(nresults):
+        if tm.codec == None:
+            taskid, taskrunid, r, ressz = tm.ReadHeader(
+                messaging.result_header, jm_recv_timeout)
+            c = codec.codec_none
+        else:
+            taskid, taskrunid, r, ressz, c = tm.ReadHeader(
+                messaging.cresult_header, jm_recv_timeout)
+        res = tm.ReadPayload(ressz, jm_recv_timeout)
+        batch.append((taskid, taskrunid, r, res, c))
+        batchsz += ressz
+    return batch, batchsz
 
-            # Validated completed task
+###############################################################################
+# Read and commit batches of results while the task manager is not empty
+###############################################################################
+def commit_tasks_batch(commit, tm):
+    n_errors = 0
+    try:
+        while True:
+            # Ask for every ready result within the budget
+            tm.WriteInt64(messaging.msg_read_batch)
+            tm.WriteInt64(jm_pull_batch)
+            tm.WriteInt64(jm_pull_batch_bytes)
+
+            nresults = tm.ReadInt64(jm_recv_timeout)
+            if nresults <= 0:
+                # No more task to receive
+                break
 
-            c = completed.get(taskid, (None, None))
-            if c[0] != None:
-                # This may happen with the fault tolerance system. This may
-                # lead to tasks being put in the tasklist by the job manager
-                # while being committed. The tasklist must be constantly
-                # sanitized.
-                logging.warning('The task %d was received more than once ' +
-                    'and will not be committed again!',
-                    taskid)
-                # Removed the completed task from the tasklist
-                tasklist.pop(taskid, (None, None))
-                continue
+            batch, batchsz = read_results(tm, nresults)
 
-            # Remove it from the tasklist
+            # Tell the task manager which tasks were received, the
+            # unacknowledged ones are put back in its queue
+            tm.WriteInt64Array([x[0] for x in batch])
 
-            p = tasklist.pop(taskid, (None, None))
-            if p[0] == None and c[0] == None:
-                # The task was not already completed and was not scheduled
-                # to be executed, this is serious problem!
-                logging.error('The task %d was not in the working list!',
-                    taskid)
+            logging.debug('Received %d results (%d bytes) from %s:%d.',
+                nresults, batchsz, tm.address, tm.port)
 
-            r2 = job.spits_committer_commit_pit(co, res)
+            # Warning, the whole batch was acknowledged, the results are
+            # committed together
+            n_errors += commit(batch)
 
-            if r2 != 0:
-                logging.error('The task %d was not successfully committed, ' +
-                    'committer returned %d', taskid, r2)
+            # The queue was drained before the budget was reached
+            if nresults < jm_pull_batch and batchsz < jm_pull_batch_bytes:
+                break
 
-            # Add completed task to list
-            completed[taskid] = (r, r2)
+    except:
+        # Something went wrong with the connection,
+        # try with another task manager
+        logging.warning('Error pulling results from task manager at %s:%d!',
+            tm.address, tm.port)
+        log_lines(traceback.format_exc(), logging.debug)
+        tm.Close()
 
-        except:
-            # Something went wrong with the connection,
-            # try with another task manager
-            break
     if n_errors > 0:
         logging.warn('There were %d failed tasks' % (n_errors, ))
 
@@ -556,64 +1085,56 @@ def infinite_tmlist_generator():
 ###############################################################################
 def heartbeat(finished):
     global jm_heartbeat_interval
-    t_last = time.clock()
+    pool = make_session_pool()
+    t_last = time.monotonic()
     for isEnd, name, tm in infinite_tmlist_generator():
         if finished[0]:
             logging.debug('Stopping heartbeat thread...')
+            pool.CloseAll()
             return
         if isEnd:
-            t_curr = time.clock()
+            t_curr = time.monotonic()
             elapsed = t_curr - t_last
             t_last = t_curr
             sleep_for = max(jm_heartbeat_interval - elapsed, 0)
             time.sleep(sleep_for)
         else:
-            try:
-                tm.Open(jm_heart_timeout)
-            except:
-                # Problem connecting to the task manager
-                # Because this is a connection event,
-                # make it a debug rather than a warning
-                logging.debug('Error connecting to task manager at %s:%d!',
-                    tm.address, tm.port)
-                log_lines(traceback.format_exc(), logging.debug)
-                tm.Close()
+            tm = pool.Get(name, tm, jm_heart_timeout)
+            if tm == None:
                 continue
             try:
-                # Send the job identifier
-                tm.WriteString(jm_jobid)
-
-                # Verify job id of the answer
-                jobid = tm.ReadString(jm_recv_timeout)
-
-                if jm_jobid != jobid:
-                    logging.error('Job Id mismatch from %s:%d! Self: %s, task manager: %s!',
-                        tm.address, tm.port, jm_jobid, jobid)
-                    tm.Close()
-                    continue
-
                 # Send the heartbeat
                 tm.WriteInt64(messaging.msg_send_heart)
+                if jm_capacity != None:
+                    query_capacity(tm, name)
             except:
                 logging.warning('Error connecting to task manager at %s:%d!',
                     tm.address, tm.port)
                 log_lines(traceback.format_exc(), logging.debug)
-            finally:
                 tm.Close()
+            finally:
+                pool.Release(name)
 
 
 ###############################################################################
 # Job Manager routine
 ###############################################################################
-def jobmanager(argv, job, runid, jm, tasklist, completed):
+def jobmanager(argv, job, runid, jm, tasklist, completed, retry,
+    speculator):
     logging.info('Job manager running...')
     memstat.stats()
 
     # Load the list of nodes to connect to
     tmlist = load_tm_list()
 
-    # Store some metadata
-    submissions = [] # (taskid, submission time, [sent to])
+    # Keep the sessions with the task managers between rounds
+    pool = make_session_pool()
+
+    # Generate the tasks in this thread
+    generate = make_generator(job, jm, tasklist)
+
+    # Leases of the tasks pushed to the task managers
+    leases = LeaseHeap(jm_lease_time, jm_max_copies)
 
     # Task generation loop
 
@@ -624,39 +1145,66 @@ def jobmanager(argv, job, runid, jm, tasklist, completed):
     while True:
         # Reload the list of task managers at each
         # run so new tms can be added on the fly
-        try:
-            newtmlist = load_tm_list()
-            if len(newtmlist) > 0:
-                tmlist = newtmlist
-            elif len(tmlist) > 0:
-                logging.warning('New list of task managers is ' +
-                    'empty and will not be updated!')
-        except:
-            logging.error('Failed parsing task manager list!')
+        tmlist = reload_tm_list(tmlist)
 
-        for name, tm in tmlist.items():
+        # Close the sessions with task managers that left the list
+        pool.Prune(tmlist)
+        if jm_capacity != None:
+            jm_capacity.Prune(tmlist)
+
+        for name, tm in order_tms(tmlist):
             logging.debug('Connecting to %s:%d...', tm.address, tm.port)
 
+            # Push the timed out tasks first
+            if task == None and len(retry) > 0:
+                taskid, task = pop_retry(retry, tasklist)
+
+            # Copy a straggler to this task manager when there is
+            # nothing else to push
+            if task == None and completed[0] == 1 and speculator != None:
+                straggler = speculator.Straggler(tasklist, leases, name)
+                if straggler != None:
+                    taskid, task = straggler
+                    logging.info('Pushing a copy of the straggler ' +
+                        'task %d to %s.', taskid, name)
+
             # Open the connection to the task manager and query if it is
             # possible to send data
-            if not setup_endpoint_for_pushing(tm):
-                finished = False
+            if completed[0] == 1 and task == None:
+                # There is nothing to push, do not hold the session
+                # waiting for a task
+                finished = True
             else:
-                logging.debug('Pushing tasks to %s:%d...', tm.address, tm.port)
-
-                # Task pushing loop
-                memstat.stats()
-                finished, taskid, task, sent = push_tasks(job, runid, jm,
-                    tm, taskid, task, tasklist, completed[0] == 1)
-
-                # Add the sent tasks to the sumission list
-                submissions = submissions + sent
-
-                # Close the connection with the task manager
-                tm.Close()
-
-                logging.debug('Finished pushing tasks to %s:%d.',
-                    tm.address, tm.port)
+                tm = pool.Get(name, tm, jm_conn_timeout)
+                if tm == None:
+                    finished = False
+                elif jm_push_window != 1 and not setup_endpoint_for_pushing(tm):
+                    finished = False
+                else:
+                    logging.debug('Pushing tasks to %s:%d...',
+                        tm.address, tm.port)
+
+                    # Task pushing loop
+                    memstat.stats()
+                    if jm_push_window == 1:
+                        finished, taskid, task, sent = push_tasks_window(
+                            generate, runid, tm, taskid, task,
+                            completed[0] == 1, push_quota(name, tm))
+                    else:
+                        finished, taskid, task, sent = push_tasks(generate,
+                            runid, tm, taskid, task, completed[0] == 1)
+
+                    # Lease the sent tasks to the task manager
+                    for sentid, senttask in sent:
+                        leases.Grant(sentid, senttask, name)
+                        if speculator != None:
+                            speculator.Dispatch(sentid, completed=completed)
+
+                    logging.debug('Finished pushing tasks to %s:%d.',
+                        tm.address, tm.port)
+
+            # Keep the session for the next round if it is still usable
+            pool.Release(name)
 
             if finished and completed[0] == 0:
                 # Tell everyone the task generation was completed
@@ -666,81 +1214,568 @@ def jobmanager(argv, job, runid, jm, tasklist, completed):
             # Exit the job manager when done
             if len(tasklist) == 0 and completed[0] == 1:
                 logging.debug('Job manager exiting...')
+                pool.CloseAll()
                 return
 
-            # Keep sending the uncommitted tasks
-            # TODO: WARNING this will flood the system
-            # with repeated tasks
-            if finished and len(tasklist) > 0:
-                if len(submissions) == 0:
-                    logging.critical('The submission list is empty but '
+            # Push again the uncommitted tasks whose lease expired
+            if finished and len(tasklist) > 0 and task == None:
+                if len(leases) == 0 and len(retry) == 0:
+                    logging.critical('The lease list is empty but '
                         'the task list is not! Some tasks were lost!')
 
-                # Select the oldest task that is not already completed
-                while True:
-                    taskid, task = submissions.pop(0)
-                    if taskid in tasklist:
-                        break
-
-        # Remove the committed tasks from the submission list
-        submissions = [x for x in submissions if x[0] in tasklist]
+                expired = leases.Expired(tasklist)
+                if expired != None:
+                    taskid, task = expired
+                    logging.debug('The lease of task %d expired.', taskid)
 
         time.sleep(jm_send_backoff)
 
 ###############################################################################
 # Committer routine
 ###############################################################################
-def committer(argv, job, runid, co, tasklist, completed):
+def committer(argv, job, runid, co, tasklist, completed, retry,
+    speculator):
     logging.info('Committer running...')
     memstat.stats()
 
     # Load the list of nodes to connect to
     tmlist = load_tm_list()
 
+    # Keep the sessions with the task managers between rounds
+    pool = make_session_pool()
+
+    # Partial results waiting for the end of their tasks
+    streams = {}
+
+    # Commit the results in this thread
+    def commit(results):
+        return commit_results(job, runid, co, results, tasklist, completed,
+            streams, retry, speculator)
+
+    # Pull only from the task managers with results ready
+    watcher = make_result_watcher()
+    sweeps = {} # name: time of the next poll without notification
+
     # Result pulling loop
     while True:
         # Reload the list of task managers at each
         # run so new tms can be added on the fly
-        try:
-            newtmlist = load_tm_list()
-            if len(newtmlist) > 0:
-                tmlist = newtmlist
-            elif len(tmlist) > 0:
-                logging.warning('New list of task managers is ' +
-                    'empty and will not be updated!')
-        except:
-            logging.error('Failed parsing task manager list!')
+        tmlist = reload_tm_list(tmlist)
+
+        # Close the sessions with task managers that left the list
+        pool.Prune(tmlist)
+
+        if watcher != None:
+            watcher.Update(tmlist)
 
         for name, tm in tmlist.items():
+            if not results_due(watcher, sweeps, name):
+                continue
+
             logging.debug('Connecting to %s:%d...', tm.address, tm.port)
 
             # Open the connection to the task manager and query if it is
             # possible to send data
-            if not setup_endpoint_for_pulling(tm):
+            tm = pool.Get(name, tm, jm_conn_timeout)
+            if tm == None or (jm_pull_batch <= 0 and
+                    not setup_endpoint_for_pulling(tm)):
+                pool.Release(name)
                 continue
 
             logging.debug('Pulling tasks from %s:%d...', tm.address, tm.port)
 
             # Task pulling loop
-            commit_tasks(job, runid, co, tm, tasklist, completed)
+            if jm_pull_batch > 0:
+                commit_tasks_batch(commit, tm)
+            else:
+                commit_tasks(commit, tm)
             memstat.stats()
 
-            # Close the connection with the task manager
-            tm.Close()
+            # Keep the session for the next round if it is still usable
+            pool.Release(name)
 
             logging.debug('Finished pulling tasks from %s:%d.',
                 tm.address, tm.port)
 
             if len(tasklist) == 0 and completed[0] == 1:
-                logging.info('All tasks committed.')
-                logging.debug('Committer exiting...')
-                return
+                break
+
+        if len(tasklist) == 0 and completed[0] == 1:
+            logging.info('All tasks committed.')
+            logging.debug('Committer exiting...')
+            pool.CloseAll()
+            if watcher != None:
+                watcher.Stop()
+            return
 
         # Refresh the tasklist
         for taskid in completed:
             tasklist.pop(taskid, 0)
 
-        time.sleep(jm_recv_backoff)
+        # Wake up as soon as a task manager has results ready, the
+        # task managers not watched are polled after the backoff
+        if watcher != None:
+            watcher.Wait(jm_recv_backoff)
+        else:
+            time.sleep(jm_recv_backoff)
+
+###############################################################################
+# Job Manager routine serving all task managers concurrently
+###############################################################################
+def jobmanager_async(argv, job, runid, jm, tasklist, completed, retry,
+    speculator, sched):
+    logging.info('Job manager running...')
+    memstat.stats()
+
+    # Keep the sessions with the task managers between rounds
+    pool = make_session_pool()
+
+    # The task managers are served by many threads, the task generation
+    # and the bookkeeping below must be synchronized
+    lock = threading.Lock()
+    leases = LeaseHeap(jm_lease_time, jm_max_copies)
+    pending = [] # (taskid, task) waiting to be pushed again
+
+    # Generate the tasks from a shared generator in the native thread
+    generator = make_generator(job, jm, tasklist)
+
+    def next_task():
+        if completed[0] == 1:
+            # Avoid calling next_task after it's finished
+            return (0, 0, None)
+        r1, taskid, task = generator(0)
+        if r1 == 0 and completed[0] == 0:
+            # Tell everyone the task generation was completed
+            logging.info('All tasks generated.')
+            completed[0] = 1
+        return (r1, taskid, task)
+
+    def generate(taskid):
+        return sched.Native(next_task)
+
+    def exchange(name, tm):
+        # Start with a task that was not accepted by the other
+        # task managers
+        with lock:
+            taskid, task = pending.pop(0) if len(pending) > 0 else (0, None)
+            if task == None:
+                # Push the timed out tasks first
+                taskid, task = pop_retry(retry, tasklist)
+            if task == None and completed[0] == 1 and speculator != None:
+                # Copy a straggler to this task manager when there is
+                # nothing else to push
+                straggler = speculator.Straggler(tasklist, leases, name)
+                if straggler != None:
+                    taskid, task = straggler
+                    logging.info('Pushing a copy of the straggler ' +
+                        'task %d to %s.', taskid, name)
+
+        if completed[0] == 1 and task == None:
+            # There is nothing to push, do not hold the session
+            # waiting for a task
+            finished = True
+        else:
+            finished = False
+            tm = pool.Get(name, tm, jm_conn_timeout)
+            if tm != None and (jm_push_window == 1 or
+                    setup_endpoint_for_pushing(tm)):
+                logging.debug('Pushing tasks to %s:%d...',
+                    tm.address, tm.port)
+
+                if jm_push_window == 1:
+                    finished, taskid, task, sent = push_tasks_window(
+                        generate, runid, tm, taskid, task,
+                        completed[0] == 1, push_quota(name, tm))
+                else:
+                    finished, taskid, task, sent = push_tasks(generate,
+                        runid, tm, taskid, task, completed[0] == 1)
+
+                with lock:
+                    for sentid, senttask in sent:
+                        leases.Grant(sentid, senttask, name)
+                        if speculator != None:
+                            speculator.Dispatch(sentid, completed=completed)
+
+                logging.debug('Finished pushing tasks to %s:%d.',
+                    tm.address, tm.port)
+
+            # Keep the session for the next round if it is still usable
+            pool.Release(name)
+
+        with lock:
+            # Give the task back to the other task managers
+            if task != None:
+                pending.append((taskid, task))
+
+            # Push again the uncommitted tasks whose lease expired
+            if finished and len(tasklist) > 0:
+                if (len(leases) == 0 and len(retry) == 0 and
+                        len(pending) == 0):
+                    logging.critical('The lease list is empty but '
+                        'the task list is not! Some tasks were lost!')
+
+                expired = leases.Expired(tasklist)
+                if expired != None:
+                    logging.debug('The lease of task %d expired.',
+                        expired[0])
+                    pending.append(expired)
+
+    # The exchange uses the pooled session or the endpoint being
+    # connected if there is none
+    def abort(name, tm):
+        pool.sessions.get(name, tm).Shutdown()
+
+    def done():
+        return len(tasklist) == 0 and completed[0] == 1
+
+    sched.Run(reload_tm_list, exchange, done, jm_send_backoff, abort,
+        pool.Drop)
+
+    logging.debug('Job manager exiting...')
+    pool.CloseAll()
+
+###############################################################################
+# Committer routine serving all task managers concurrently
+###############################################################################
+def committer_async(argv, job, runid, co, tasklist, completed, retry,
+    speculator, sched):
+    logging.info('Committer running...')
+    memstat.stats()
+
+    # Keep the sessions with the task managers between rounds
+    pool = make_session_pool()
+
+    # Partial results waiting for the end of their tasks, only used
+    # from the native thread
+    streams = {}
+
+    # Commit the results in the native thread
+    def commit(results):
+        return sched.Native(commit_results, job, runid, co, results,
+            tasklist, completed, streams, retry, speculator)
+
+    # Pull only from the task managers with results ready, the
+    # notifications are checked every send backoff
+    watcher = make_result_watcher()
+    sweeps = {} # name: time of the next poll without notification
+    backoff = jm_recv_backoff if watcher == None else jm_send_backoff
+
+    def load(tmlist):
+        tmlist = reload_tm_list(tmlist)
+        if watcher != None:
+            watcher.Update(tmlist)
+        return tmlist
+
+    def exchange(name, tm):
+        if not results_due(watcher, sweeps, name):
+            return
+
+        tm = pool.Get(name, tm, jm_conn_timeout)
+        if tm != None and (jm_pull_batch > 0 or
+                setup_endpoint_for_pulling(tm)):
+            logging.debug('Pulling tasks from %s:%d...', tm.address, tm.port)
+
+            if jm_pull_batch > 0:
+                commit_tasks_batch(commit, tm)
+            else:
+                commit_tasks(commit, tm)
+            memstat.stats()
+
+            logging.debug('Finished pulling tasks from %s:%d.',
+                tm.address, tm.port)
+
+        # Keep the session for the next round if it is still usable
+        pool.Release(name)
+
+        # Refresh the tasklist
+        for taskid in list(completed):
+            tasklist.pop(taskid, 0)
+
+    # The exchange uses the pooled session or the endpoint being
+    # connected if there is none
+    def abort(name, tm):
+        pool.sessions.get(name, tm).Shutdown()
+
+    def done():
+        return len(tasklist) == 0 and completed[0] == 1
+
+    sched.Run(load, exchange, done, backoff, abort, pool.Drop)
+
+    logging.info('All tasks committed.')
+    logging.debug('Committer exiting...')
+    pool.CloseAll()
+    if watcher != None:
+        watcher.Stop()
+
+###############################################################################
+# Create the state shared by the listener and the routines serving the task
+# managers that pull tasks
+###############################################################################
+def make_pull_hub():
+    return { 'lock': threading.Lock(), 'tasks': None, 'results': None,
+        'sessions': set(), 'finished': False }
+
+###############################################################################
+# Register the routine serving the task requests or the result pushes of the
+# current run, None when the run is over
+###############################################################################
+def pull_register(hub, key, fn):
+    with hub['lock']:
+        hub[key] = fn
+
+###############################################################################
+# Serve the handshake of a task manager pulling tasks
+###############################################################################
+def pull_accept(tm, addr, port, hub):
+    try:
+        if check_jobid(tm):
+            logging.info('Task manager at %s:%d connected.', addr, port)
+            with hub['lock']:
+                hub['sessions'].add((addr, port))
+            return True
+    except:
+        logging.warning('Error connecting to task manager at %s:%d!',
+            addr, port)
+        log_lines(traceback.format_exc(), logging.debug)
+    return False
+
+###############################################################################
+# Serve a request of a task manager pulling tasks, returns False if the
+# session must be dropped
+###############################################################################
+def pull_request(tm, addr, port, hub):
+    name = '%s:%d' % (addr, port)
+    try:
+        mtype = tm.ReadInt64(jm_recv_timeout)
+
+        with hub['lock']:
+            serve, commit = hub['tasks'], hub['results']
+            finished = hub['finished']
+
+        # Task manager is asking for tasks
+        if mtype == messaging.msg_pull_tasks:
+            count = tm.ReadInt64(jm_recv_timeout)
+            if finished:
+                # Tell the task manager to exit when the job is over
+                tm.WriteInt64(-1 if jm_killtms else 0)
+            elif serve == None or commit == None:
+                # No run is going on
+                tm.WriteInt64(0)
+            else:
+                serve(tm, name, count)
+            return True
+
+        # Task manager is pushing the results of completed tasks
+        elif mtype == messaging.msg_push_results:
+            nresults = tm.ReadInt64(jm_recv_timeout)
+            batch, batchsz = read_results(tm, nresults)
+
+            # Tell the task manager which tasks were received
+            tm.WriteInt64Array([x[0] for x in batch])
+
+            logging.debug('Received %d results (%d bytes) from %s.',
+                nresults, batchsz, name)
+
+            if commit == None:
+                # The tasks are only pulled during a run, so these
+                # are from a run that is over
+                logging.debug('The results from %s are from a previous ' +
+                    'run and will be ignored!', name)
+            else:
+                commit(batch)
+            return True
+
+        else:
+            logging.warning('Unknown message received from %s \'%d\'!',
+                name, mtype)
+
+    except messaging.SocketClosed:
+        logging.debug('Task manager at %s closed the session.', name)
+
+    except:
+        logging.warning('Error serving task manager at %s!', name)
+        log_lines(traceback.format_exc(), logging.debug)
+
+    with hub['lock']:
+        hub['sessions'].discard((addr, port))
+    return False
+
+###############################################################################
+# Wait for the task managers pulling tasks to be told that the job is over
+###############################################################################
+def pull_drain(hub):
+    with hub['lock']:
+        hub['finished'] = True
+    if not jm_killtms:
+        return
+
+    logging.info('Killing task managers...')
+    t_end = time.time() + config.pull_drain
+    while time.time() < t_end:
+        with hub['lock']:
+            if len(hub['sessions']) == 0:
+                return
+        time.sleep(jm_send_backoff)
+    logging.warning('Some task managers did not leave!')
+
+###############################################################################
+# Job Manager routine serving the task managers that pull tasks
+###############################################################################
+def jobmanager_pull(argv, job, runid, jm, tasklist, completed, retry,
+    speculator, hub):
+    logging.info('Job manager running...')
+    memstat.stats()
+
+    # The task managers are served by the listener threads, the task
+    # generation and the bookkeeping below must be synchronized
+    lock = threading.Lock()
+    leases = LeaseHeap(jm_lease_time, jm_max_copies)
+    pending = [] # (taskid, task) waiting to be pushed again
+
+    generate = make_generator(job, jm, tasklist)
+
+    def next_task(name):
+        # Start with a task that was not accepted by the other
+        # task managers
+        if len(pending) > 0:
+            return pending.pop(0)
+
+        # Push the timed out tasks first
+        taskid, task = pop_retry(retry, tasklist)
+        if task != None:
+            return (taskid, task)
+
+        if completed[0] == 0:
+            r1, taskid, task = generate(taskid)
+            if r1 == 1:
+                return (taskid, task)
+            if r1 < 0:
+                # Try again on the next request
+                return None
+            # Tell everyone the task generation was completed
+            logging.info('All tasks generated.')
+            completed[0] = 1
+
+        # Push again the uncommitted tasks whose lease expired
+        expired = leases.Expired(tasklist)
+        if expired != None:
+            logging.debug('The lease of task %d expired.', expired[0])
+            return expired
+
+        # Copy a straggler to this task manager when there is
+        # nothing else to push
+        if speculator != None:
+            straggler = speculator.Straggler(tasklist, leases, name)
+            if straggler != None:
+                logging.info('Pushing a copy of the straggler ' +
+                    'task %d to %s.', straggler[0], name)
+                return straggler
+
+        return None
+
+    def serve(tm, name, count):
+        tasks = []
+        with lock:
+            while len(tasks) < count and not closed[0]:
+                t = next_task(name)
+                if t == None:
+                    break
+                tasks.append(t)
+
+            if (len(tasks) == 0 and completed[0] == 1 and len(tasklist) > 0
+                    and len(leases) == 0 and len(retry) == 0 and
+                    len(pending) == 0):
+                logging.critical('The lease list is empty but '
+                    'the task list is not! Some tasks were lost!')
+
+        logging.debug('Pushing %d tasks to %s...', len(tasks), name)
+
+        try:
+            tm.WriteInt64(len(tasks))
+            if len(tasks) == 0:
+                return
+            for taskid, task in tasks:
+                write_task(tm, taskid, runid, task)
+
+            # A single acknowledgement lists the rejected tasks
+            rejected = set(tm.ReadInt64Array(jm_recv_timeout))
+        except:
+            # Give the tasks back to the other task managers
+            with lock:
+                pending.extend(tasks)
+            raise
+
+        if len(rejected) > 0:
+            logging.warning('Task manager at %s rejected tasks %s',
+                name, sorted(rejected))
+
+        with lock:
+            for taskid, task in tasks:
+                if taskid in rejected:
+                    pending.append((taskid, task))
+                    continue
+                # Lease the sent task to the task manager
+                leases.Grant(taskid, task, name)
+                if speculator != None:
+                    speculator.Dispatch(taskid, completed=completed)
+
+    # The listener threads may still hold serve after the run is over
+    closed = [False]
+    pull_register(hub, 'tasks', serve)
+
+    while True:
+        time.sleep(jm_send_backoff)
+        with lock:
+            if len(tasklist) == 0 and completed[0] == 1:
+                closed[0] = True
+                break
+
+    pull_register(hub, 'tasks', None)
+    logging.debug('Job manager exiting...')
+
+###############################################################################
+# Committer routine serving the task managers that pull tasks
+###############################################################################
+def committer_pull(argv, job, runid, co, tasklist, completed, retry,
+    speculator, hub):
+    logging.info('Committer running...')
+    memstat.stats()
+
+    # Partial results waiting for the end of their tasks
+    streams = {}
+
+    # The results are pushed from the listener threads, commit them
+    # one batch at a time
+    lock = threading.Lock()
+
+    def commit(results):
+        with lock:
+            if closed[0]:
+                logging.debug('The results are from a previous ' +
+                    'run and will be ignored!')
+                return
+            n_errors = commit_results(job, runid, co, results, tasklist,
+                completed, streams, retry, speculator)
+        memstat.stats()
+        if n_errors > 0:
+            logging.warn('There were %d failed tasks' % (n_errors, ))
+
+    # The tasks are removed from the tasklist before being committed, the
+    # run is only over once no commit is going on. The listener threads
+    # may still hold commit after that
+    closed = [False]
+    pull_register(hub, 'results', commit)
+
+    while True:
+        time.sleep(jm_send_backoff)
+        with lock:
+            if len(tasklist) == 0 and completed[0] == 1:
+                closed[0] = True
+                break
+
+    pull_register(hub, 'results', None)
+    logging.info('All tasks committed.')
+    logging.debug('Committer exiting...')
 
 ###############################################################################
 # Kill all task managers
@@ -774,7 +1809,7 @@ def killtms():
 ###############################################################################
 # Run routine
 ###############################################################################
-def run(argv, jobinfo, job, runid):
+def run(argv, jobinfo, job, runid, hub=None):
     # List of pending tasks
     memstat.stats()
     tasklist = {}
@@ -782,14 +1817,36 @@ def run(argv, jobinfo, job, runid):
     # Keep an extra list of completed tasks
     completed = {0: 0}
 
+    # Tasks reported as timed out, to be pushed again first
+    retry = collections.deque()
+
+    # Copy the straggler tasks to idle task managers
+    speculator = None
+    if jm_speculate > 0:
+        speculator = Speculator(jm_speculate, config.speculate_percentile,
+            config.speculate_samples)
+
+    # Serve the task managers concurrently from an event loop,
+    # imported here because it requires Python 3
+    if hub != None:
+        jmtarget, cotarget, extra = jobmanager_pull, committer_pull, (hub, )
+    elif jm_async == 1:
+        from libspitz.AsyncScheduler import AsyncScheduler
+        sched = AsyncScheduler(jm_max_inflight, jm_tm_timeout)
+        jmtarget, cotarget, extra = jobmanager_async, committer_async, \
+            (sched, )
+    else:
+        jmtarget, cotarget, extra = jobmanager, committer, ()
+
     # Start the job manager
     logging.info('Starting job manager jor job %d...', runid)
 
     # Create the job manager from the job module
     jm = job.spits_job_manager_new(argv, jobinfo)
 
-    jmthread = threading.Thread(target=jobmanager,
-        args=(argv, job, runid, jm, tasklist, completed))
+    jmthread = threading.Thread(target=jmtarget,
+        args=(argv, job, runid, jm, tasklist, completed, retry,
+            speculator) + extra)
     jmthread.start()
 
     # Start the committer
@@ -798,14 +1855,21 @@ def run(argv, jobinfo, job, runid):
     # Create the job manager from the job module
     co = job.spits_committer_new(argv, jobinfo)
 
-    cothread = threading.Thread(target=committer,
-        args=(argv, job, runid, co, tasklist, completed))
+    cothread = threading.Thread(target=cotarget,
+        args=(argv, job, runid, co, tasklist, completed, retry,
+            speculator) + extra)
     cothread.start()
 
     # Wait for both threads
     jmthread.join()
     cothread.join()
 
+    if jm_async == 1 and hub == None:
+        sched.Shutdown()
+
+    if speculator != None:
+        speculator.LogStats(logging.info)
+
     # Commit the job
     logging.info('Committing Job...')
     r, res, ctx = job.spits_committer_commit_job(co, 0x12345678)
@@ -819,6 +1883,7 @@ def run(argv, jobinfo, job, runid):
     logging.debug('Finalizing Committer...')
     job.spits_committer_finalize(co)
     memstat.stats()
+    codec.log_stats(logging.info)
 
     if res == None:
         logging.error('Job did not push any result!')
@@ -866,10 +1931,19 @@ def main(argv):
     # Keep a run identifier
     runid = [0]
 
+    # Let the task managers connect and pull the tasks of every run
+    hub = None
+    if jm_listen > 0:
+        hub = make_pull_hub()
+        listener = Listener(config.mode_tcp, jm_listen_addr, jm_listen,
+            pull_request, (hub, ), config.listen_backlog,
+            config.pull_handlers, pull_accept)
+        listener.Start()
+
     # Wrapper to include job module
     def run_wrapper(argv, jobinfo):
         runid[0] = runid[0] + 1
-        return run(argv, jobinfo, job, runid[0])
+        return run(argv, jobinfo, job, runid[0], hub)
 
     # Wrapper for the heartbeat
     finished = [False]
@@ -888,8 +1962,12 @@ def main(argv):
     # Stop the heartbeat thread
     finished[0] = True
 
-    # Kill the workers
-    if jm_killtms:
+    # Kill the workers, the ones pulling tasks are told to exit
+    # when they ask for more tasks
+    if hub != None:
+        pull_drain(hub)
+        listener.Stop()
+    elif jm_killtms:
         killtms()
 
     # Print final memory report
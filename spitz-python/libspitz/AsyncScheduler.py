@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# This module requires Python 3 and is not imported by the package,
+# import it directly with libspitz.AsyncScheduler
+
+from libspitz import log_lines
+
+import asyncio, logging, traceback
+from concurrent.futures import ThreadPoolExecutor
+
+class AsyncScheduler(object):
+    """Serve all task managers concurrently from an asyncio event loop.
+       Each task manager runs on its own schedule, so a slow or dead task
+       manager does not hold back the others. The blocking endpoint calls
+       run on a bounded pool of threads and the calls to the job module run
+       on a single dedicated thread."""
+
+    def __init__(self, max_inflight, timeout=None):
+        """Construct a new scheduler. At most max_inflight exchanges run at
+           the same time in each call to Run and exchanges lasting more
+           than timeout seconds are aborted, None disables the timeout."""
+        self.max_inflight = max(max_inflight, 1)
+        self.timeout = timeout if timeout != None and timeout > 0 else None
+        self.native = ThreadPoolExecutor(1)
+
+    def Native(self, fn, *args):
+        """Run fn on the native thread and wait for its result. Must not
+           be called from the native thread itself."""
+        return self.native.submit(fn, *args).result()
+
+    def Run(self, load, exchange, done, backoff, abort=None, leave=None):
+        """Serve the task managers until done() returns True.
+
+           load(tms) returns the current dictionary of task managers given
+           the previous one. exchange(name, endpoint) runs on a pool thread
+           and is repeated for each task manager every backoff seconds.
+           abort(name, endpoint) is called from the event loop every time
+           an exchange exceeds the timeout and must unblock it. leave(name)
+           runs on a pool thread when a task manager is no longer
+           served."""
+        loop = asyncio.new_event_loop()
+        io = ThreadPoolExecutor(self.max_inflight)
+        try:
+            loop.run_until_complete(self._run(loop, io, load, exchange,
+                done, backoff, abort, leave))
+        finally:
+            loop.close()
+            io.shutdown()
+
+    def Shutdown(self):
+        """Stop the native thread."""
+        self.native.shutdown()
+
+    async def _run(self, loop, io, load, exchange, done, backoff, abort,
+        leave):
+        sem = asyncio.Semaphore(self.max_inflight)
+        stop = asyncio.Event()
+        tms = {}
+        servers = {}
+        while not stop.is_set():
+            if done():
+                stop.set()
+                break
+
+            # Reload the list of task managers so new ones can be
+            # added on the fly
+            newtms = await loop.run_in_executor(io, load, dict(tms))
+            tms.clear()
+            tms.update(newtms)
+
+            # Start serving the new task managers, the ones that left
+            # the list stop by themselves
+            for name in tms:
+                s = servers.get(name, None)
+                if s == None or s.done():
+                    servers[name] = loop.create_task(self._serve(loop, io,
+                        sem, stop, name, tms, exchange, done, backoff, abort,
+                        leave))
+
+            await self._sleep(stop, backoff)
+
+        await asyncio.gather(*servers.values(), return_exceptions=True)
+
+    async def _sleep(self, stop, backoff):
+        # Sleep for backoff seconds or until the scheduler stops
+        try:
+            await asyncio.wait_for(stop.wait(), backoff)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _serve(self, loop, io, sem, stop, name, tms, exchange, done,
+        backoff, abort, leave):
+        while name in tms and not stop.is_set():
+            async with sem:
+                endpoint = tms[name]
+                fut = loop.run_in_executor(io, exchange, name, endpoint)
+                # The pool thread is only released when the exchange
+                # returns, keep aborting it until it does
+                while True:
+                    finished, pending = await asyncio.wait([fut],
+                        timeout=self.timeout)
+                    if len(pending) == 0:
+                        break
+                    logging.warning('Exchange with task manager %s ' +
+                        'timed out!', name)
+                    if abort != None:
+                        abort(name, endpoint)
+                try:
+                    fut.result()
+                except:
+                    logging.warning('Error serving task manager %s!', name)
+                    log_lines(traceback.format_exc(), logging.debug)
+
+            # Wake up everyone as soon as the work is done
+            if done():
+                stop.set()
+                break
+
+            await self._sleep(stop, backoff)
+
+        if leave != None:
+            await loop.run_in_executor(io, leave, name)
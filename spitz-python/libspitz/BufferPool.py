@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+from .Blob import Blob
+
+import ctypes, logging, threading, time
+
+class BufferPool(object):
+    """Pool of reusable buffers for task and result payloads. Buffers are
+       allocated as Blobs in power of two size classes and handed out as
+       writable memoryviews with the requested size. Idle buffers beyond
+       the memory limit are evicted, least recently released first."""
+
+    def __init__(self, limit, min_size=4096, max_size=None):
+        """Construct a new pool keeping at most limit bytes of idle
+           buffers. Requests larger than max_size are not pooled."""
+        self.limit = limit
+        self.min_size = max(min_size, 1)
+        self.max_size = max_size
+        self.idle = {}
+        self.idle_size = 0
+        self.lock = threading.Lock()
+        self.stats = { 'hits' : 0, 'misses' : 0, 'evictions' : 0 }
+
+    def size_class(self, size):
+        """Get the size of the buffers serving a request of size bytes."""
+        c = self.min_size
+        while c < size:
+            c *= 2
+        return c
+
+    def Get(self, size):
+        """Get a writable buffer of size bytes, or None if the size is not
+           served by the pool."""
+        if size <= 0 or (self.max_size != None and size > self.max_size):
+            return None
+        c = self.size_class(size)
+        blob = None
+        with self.lock:
+            free = self.idle.get(c, None)
+            if free:
+                # Reuse the most recently released buffer, it is the
+                # most likely to still be in the cache
+                blob, t = free.pop()
+                self.idle_size -= c
+                self.stats['hits'] += 1
+            else:
+                self.stats['misses'] += 1
+        if blob == None:
+            blob = Blob(c)
+            # The buffer keeps track of its blob so it can be released
+            # from any view of it
+            blob._inner_data._blob = blob
+        return memoryview(blob._inner_data).cast('B')[:size]
+
+    def Release(self, buf):
+        """Give a buffer back to the pool. Buffers that were not taken from
+           the pool are ignored. The buffer must not be used afterwards."""
+        if not isinstance(buf, memoryview):
+            return
+        blob = getattr(buf.obj, '_blob', None)
+        if blob == None:
+            return
+        c = blob.get_size()
+        with self.lock:
+            self.idle.setdefault(c, []).append((blob, time.time()))
+            self.idle_size += c
+            while self.idle_size > self.limit:
+                self.evict()
+
+    def evict(self):
+        # Drop the buffer released the longest time ago
+        oldest = None
+        for c, free in self.idle.items():
+            if len(free) == 0:
+                continue
+            if oldest == None or free[0][1] < self.idle[oldest][0][1]:
+                oldest = c
+        self.idle[oldest].pop(0)
+        self.idle_size -= oldest
+        self.stats['evictions'] += 1
+
+    def Idle(self):
+        """Get the number of bytes held by idle buffers."""
+        with self.lock:
+            return self.idle_size
+
+    def LogStats(self, dest):
+        """Log how many requests were served by pooled buffers."""
+        with self.lock:
+            s = dict(self.stats)
+            idle = self.idle_size
+        if s['hits'] + s['misses'] > 0:
+            dest('Buffer pool served %d of %d requests, %d evictions, ' \
+                '%d idle bytes.' % (s['hits'], s['hits'] + s['misses'],
+                s['evictions'], idle))
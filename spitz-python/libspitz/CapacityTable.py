@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import math, threading, time
+
+class CapacityTable(object):
+    """Capacity reported by the task managers: workers, free slots in the
+       task queue and throughput in tasks per second. Each task manager is
+       visited first when it is faster and is given at most the tasks it
+       runs until the next visit, so the work is spread in proportion to
+       the throughput of the task managers."""
+
+    def __init__(self, weight=0.2):
+        self.weight = weight
+        self.reports = {} # name: (workers, free, rate)
+        self.visits = {} # name: [last visit, average interval]
+        self.lock = threading.Lock()
+
+    def Update(self, name, workers, free, rate):
+        """Record the capacity reported by a task manager, a rate of 0
+           means the throughput was not measured yet."""
+        with self.lock:
+            self.reports[name] = (workers, free, rate)
+
+    def Get(self, name):
+        """Get the last report of a task manager as (workers, free, rate),
+           or None."""
+        with self.lock:
+            return self.reports.get(name, None)
+
+    def Prune(self, names):
+        """Forget the task managers not present in names."""
+        with self.lock:
+            for name in [n for n in self.reports if n not in names]:
+                del self.reports[name]
+            for name in [n for n in self.visits if n not in names]:
+                del self.visits[name]
+
+    def Order(self, names):
+        """Sort the names from the fastest to the slowest task manager,
+           the ones not measured yet come first so they get work."""
+        with self.lock:
+            rates = dict((n, self.reports.get(n, (0, 0, 0))[2])
+                for n in names)
+        return sorted(names, key=lambda n: -rates[n] if rates[n] > 0
+            else -float('inf'))
+
+    def Visit(self, name, now=None):
+        """Record a visit to a task manager to push tasks."""
+        if now == None:
+            now = time.time()
+        with self.lock:
+            v = self.visits.setdefault(name, [None, None])
+            if v[0] != None:
+                interval = now - v[0]
+                v[1] = interval if v[1] == None else v[1] + self.weight * \
+                    (interval - v[1])
+            v[0] = now
+
+    def Quota(self, name):
+        """Get the number of tasks a task manager runs until the next
+           visit, never less than its workers, or None if unknown."""
+        with self.lock:
+            report = self.reports.get(name, None)
+            interval = self.visits.get(name, [None, None])[1]
+        if report == None or report[2] <= 0 or interval == None:
+            return None
+        workers, free, rate = report
+        return max(int(math.ceil(rate * interval)), workers, 1)
@@ -30,20 +30,12 @@ import socket
 class ClientEndpoint(SimpleEndpoint):
     """Message exchange class with a client"""
 
-    def __init__(self, address, port, conn):
-        SimpleEndpoint.__init__(self, address, port)
+    def __init__(self, address, port, conn, shm=False):
+        SimpleEndpoint.__init__(self, address, port, shm)
         self.socket = conn
 
     def Open(self, timeout):
         pass
 
-    def Read(self, size, timeout):
-        return messaging.recv(self.socket, size, timeout)
-
     def Write(self, data):
         self.socket.sendall(data)
-
-    def Close(self):
-        if self.socket != None:
-            self.socket.close()
-            self.socket = None
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+from libspitz import log_lines
+
+import logging, traceback
+
+class ConnectionPool(object):
+    """Pool of authenticated sessions with task managers, keyed by name"""
+
+    def __init__(self, handshake, persistent=True):
+        """Construct a new pool. The handshake is called with the name and
+           the endpoint of every newly connected task manager and must
+           return True when the session is ready to be used. When persistent is False the sessions are
+           closed every time they are released."""
+        self.handshake = handshake
+        self.persistent = persistent
+        self.sessions = {}
+
+    def Get(self, name, endpoint, timeout):
+        """Get an open session with the task manager, reusing the pooled
+           one if it is still healthy. Return None if the task manager
+           could not be reached."""
+        e = self.sessions.get(name, None)
+        if e is not None:
+            if (e.address == endpoint.address and e.port == endpoint.port
+                    and e.Alive()):
+                return e
+            # The session was dropped or the task manager moved,
+            # discard it and connect again
+            logging.debug('Reconnecting to task manager at %s:%d...',
+                endpoint.address, endpoint.port)
+            self.Drop(name)
+
+        e = endpoint
+        try:
+            # Try to connect to a task manager
+            e.Open(timeout)
+        except:
+            # Problem connecting to the task manager
+            # Because this is a connection event,
+            # make it a debug rather than a warning
+            logging.debug('Error connecting to task manager at %s:%d!',
+                e.address, e.port)
+            log_lines(traceback.format_exc(), logging.debug)
+            e.Close()
+            return None
+
+        try:
+            if not self.handshake(name, e):
+                e.Close()
+                return None
+        except:
+            logging.warning('Error connecting to task manager at %s:%d!',
+                e.address, e.port)
+            log_lines(traceback.format_exc(), logging.debug)
+            e.Close()
+            return None
+
+        self.sessions[name] = e
+        return e
+
+    def Release(self, name):
+        """Return a session to the pool after an exchange. Sessions
+           closed during the exchange are discarded."""
+        e = self.sessions.get(name, None)
+        if e is None:
+            return
+        if not self.persistent or not e.Alive():
+            self.Drop(name)
+
+    def Drop(self, name):
+        """Close and remove a session from the pool."""
+        e = self.sessions.pop(name, None)
+        if e is not None:
+            e.Close()
+
+    def Prune(self, names):
+        """Close the sessions of task managers not present in names."""
+        for name in [n for n in list(self.sessions) if n not in names]:
+            self.Drop(name)
+
+    def CloseAll(self):
+        """Close all pooled sessions."""
+        for name in list(self.sessions):
+            self.Drop(name)
@@ -22,6 +22,8 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
 # IN THE SOFTWARE.
 
+from libspitz import messaging, config, spill
+
 import struct
 
 class Endpoint(object):
@@ -30,17 +32,49 @@ class Endpoint(object):
     def Open(self):
         raise NotImplementedError('Please specialize this class to make a custom endpoint')
 
-    def Read(self, size, timeout):
+    def Read(self, size, timeout, buf=None):
         raise NotImplementedError('Please specialize this class to make a custom endpoint')
 
     def Write(self, data):
         raise NotImplementedError('Please specialize this class to make a custom endpoint')
 
+    def ReadPayload(self, size, timeout, buf=None):
+        # Spill large payloads to disk as they are received
+        if buf == None and spill.should_spill(size):
+            return self.ReadChunks(size, timeout, spill.allocate(size))
+        return self.Read(size, timeout, buf)
+
+    def ReadChunks(self, size, timeout, buf):
+        view = memoryview(buf)
+        for offset in range(0, size, config.spill_chunk):
+            n = min(config.spill_chunk, size - offset)
+            self.Read(n, timeout, view[offset:offset + n])
+        return buf
+
+    def ReadHeader(self, header, timeout):
+        return header.unpack(self.Read(header.size, timeout))
+
+    def WriteMessage(self, header, values, payload=None):
+        self.Write(header.pack(*values))
+        if payload != None and len(payload) > 0:
+            self.Write(payload)
+
     def ReadInt64(self, timeout):
-        return struct.unpack('!q', self.Read(8, timeout))[0]
+        return messaging.int64_header.unpack(self.Read(8, timeout))[0]
 
     def WriteInt64(self, value):
-        self.Write(struct.pack('!q', value))
+        self.Write(messaging.int64_header.pack(value))
+
+    def ReadInt64Array(self, timeout):
+        n = self.ReadInt64(timeout)
+        if n > 0:
+            return list(struct.unpack('!%dq' % n, self.Read(8 * n, timeout)))
+        else:
+            return []
+
+    def WriteInt64Array(self, values):
+        self.Write(struct.pack('!%dq' % (len(values) + 1),
+            len(values), *values))
 
     def ReadString(self, timeout):
         sz = struct.unpack('!I', self.Read(4, timeout))[0]
@@ -57,5 +91,11 @@ class Endpoint(object):
         if len(s) > 0:
             self.Write(struct.pack(str(l)+'s', s))
 
+    def Alive(self):
+        raise NotImplementedError('Please specialize this class to make a custom endpoint')
+
+    def Shutdown(self):
+        raise NotImplementedError('Please specialize this class to make a custom endpoint')
+
     def Close(self):
         raise NotImplementedError('Please specialize this class to make a custom endpoint')
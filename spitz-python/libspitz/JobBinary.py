@@ -25,6 +25,7 @@
 import ctypes, os, struct, sys
 
 from libspitz import Blob, Pointer
+from libspitz import spill
 
 # TODO try-except around C calls
 
@@ -88,6 +89,13 @@ class JobBinary(object):
             c_context
         ])
 
+        self.try_init_method('spits_job_manager_next_tasks', ctypes.c_int, [
+            ctypes.c_void_p,
+            ctypes.c_longlong,
+            self.cpusher,
+            ctypes.POINTER(c_context)
+        ])
+
         self.try_init_method('spits_job_manager_finalize', None, [
             ctypes.c_void_p
         ])
@@ -107,6 +115,16 @@ class JobBinary(object):
             c_context
         ])
 
+        self.try_init_method('spits_worker_run_batch', None, [
+            ctypes.c_void_p,
+            ctypes.c_longlong,
+            ctypes.POINTER(ctypes.c_void_p),
+            ctypes.POINTER(ctypes.c_longlong),
+            self.cpusher,
+            ctypes.POINTER(c_context),
+            ctypes.POINTER(ctypes.c_int)
+        ])
+
         self.try_init_method('spits_worker_finalize', None, [
             ctypes.c_void_p
         ])
@@ -126,6 +144,14 @@ class JobBinary(object):
             ctypes.c_longlong
         ])
 
+        self.try_init_method('spits_committer_commit_pits', None, [
+            ctypes.c_void_p,
+            ctypes.c_longlong,
+            ctypes.POINTER(ctypes.c_void_p),
+            ctypes.POINTER(ctypes.c_longlong),
+            ctypes.POINTER(ctypes.c_int)
+        ])
+
         self.try_init_method('spits_committer_commit_job', ctypes.c_int, [
             ctypes.c_void_p,
             self.cpusher,
@@ -175,15 +201,62 @@ class JobBinary(object):
         # Cover the case where an empty array or list is passed
         if it == None or len(it) == 0:
             return ctypes.c_void_p(None), 0
+        # The native methods take const pointers, so immutable bytes
+        # are passed with a pointer to their own buffer
+        if isinstance(it, bytes):
+            return it, ctypes.c_longlong(len(it))
+        try:
+            size = memoryview(it).nbytes
+        except TypeError:
+            size = None
+        if size != None:
+            citsz = ctypes.c_longlong(size)
+            try:
+                # Point into writable buffers such as bytearrays and
+                # spilled payloads
+                return (ctypes.c_byte * size).from_buffer(it), citsz
+            except (TypeError, ValueError):
+                # Read-only buffers are copied at once
+                return (ctypes.c_byte * size).from_buffer_copy(it), citsz
         # Normal C allocation
         cit = (ctypes.c_byte * len(it))()
         cit[:] = self.unbyte(it)
         citsz = ctypes.c_longlong(len(it))
         return cit, citsz
 
-    def to_py_array(self, v, sz):
-        v = ctypes.cast(v, ctypes.POINTER(ctypes.c_byte))
-        return self.bytes(v[0:sz])
+    def to_c_arrays(self, items):
+        # Build the arrays of pointers and sizes of a batch, the
+        # converted items must be kept alive during the native call
+        n = len(items)
+        keep = [self.to_c_array(it) for it in items]
+        cptrs = (ctypes.c_void_p * n)()
+        csizes = (ctypes.c_longlong * n)()
+        for i, (cit, citsz) in enumerate(keep):
+            cptrs[i] = ctypes.cast(cit, ctypes.c_void_p).value
+            csizes[i] = citsz
+        return keep, cptrs, csizes
+
+    def c_contexts(self, n):
+        # The i-th item of a batch is identified by the context i + 1,
+        # so no context is null
+        return (ctypes.c_void_p * n)(*range(1, n + 1))
+
+    def to_py_array(self, v, sz, pool=None):
+        # Copy the data with a single memcpy
+        if sz <= 0:
+            return b''
+        # Reuse a pooled buffer when possible
+        buf = pool.Get(sz) if pool != None else None
+        if buf == None:
+            return ctypes.string_at(v, sz)
+        ctypes.memmove((ctypes.c_byte * sz).from_buffer(buf), v, sz)
+        return buf
+
+    def to_spilled_array(self, v, sz, pool=None):
+        # Keep large data out of the Python heap
+        if spill.should_spill(sz):
+            return spill.copy(v, sz)
+        return self.to_py_array(v, sz, pool)
 
     def spits_main(self, argv, runner):
         # Call the runner if the job does not have an initializer
@@ -207,8 +280,7 @@ class JobBinary(object):
                 data[0] = None
                 size[0] = 0
             else:
-                cdata = (ctypes.c_byte * len(pdata))()
-                cdata[:] = self.unbyte(pdata)
+                cdata = (ctypes.c_byte * len(pdata)).from_buffer_copy(pdata)
                 data[0] = ctypes.cast(cdata, ctypes.c_void_p)
                 size[0] = len(pdata)
 
@@ -236,7 +308,7 @@ class JobBinary(object):
         def push(ctask, ctasksz, ctx):
             # Thanks to python closures, the context is not
             # necessary, in any case, check for correctness
-            res[1] = (self.to_py_array(ctask, ctasksz),)
+            res[1] = (self.to_spilled_array(ctask, ctasksz),)
             res[2] = ctx
         # Get the next task
         res[0] = self.module.spits_job_manager_next_task(p_user_data,
@@ -244,6 +316,35 @@ class JobBinary(object):
         # Return the pushed data along with the return code of the method
         return res
 
+    def spits_job_manager_next_tasks(self, user_data, count, jmctx):
+        # Fall back to one call per task if the batch is not exported
+        if not hasattr(self.module, 'spits_job_manager_next_tasks'):
+            results = []
+            for i in range(count):
+                res = self.spits_job_manager_next_task(user_data, jmctx + i)
+                results.append(res)
+                if res[0] == 0:
+                    break
+            return results
+        tasks = {}
+        # Get the native pointer to the user data
+        p_user_data = user_data.get_value()
+        # Create an inner converter for the callback
+        def push(ctask, ctasksz, ctx):
+            tasks[ctx] = (self.to_spilled_array(ctask, ctasksz),)
+        # Get the next tasks
+        n = self.module.spits_job_manager_next_tasks(p_user_data, count,
+            self.cpusher(push), self.c_contexts(count))
+        # Return the same data of next_task for each generated task, the
+        # contexts are translated back to the ones requested
+        results = []
+        for i in range(n):
+            task = tasks.get(i + 1, None)
+            results.append([1, task, jmctx + i if task != None else None])
+        if n < count:
+            results.append([0, None, None])
+        return results
+
     def spits_job_manager_finalize(self, user_data):
         # Get the native pointer to the user data
         p_user_data = user_data.get_value()
@@ -260,7 +361,8 @@ class JobBinary(object):
         # Call the native method casting the result to a simple pointer
         return Pointer(self.module.spits_worker_new(cargc, cargv))
 
-    def spits_worker_run(self, user_data, task, taskctx):
+    def spits_worker_run(self, user_data, task, taskctx, pool=None,
+        stream=None):
         res = [None, None, None]
         # Get the native pointer to the user data
         p_user_data = user_data.get_value()
@@ -270,14 +372,45 @@ class JobBinary(object):
         def push(cres, cressz, ctx):
             # Thanks to python closures, the context is not
             # necessary, in any case, check for correctness
-            res[1] = (self.to_py_array(cres, cressz),)
+            res[1] = (self.to_spilled_array(cres, cressz, pool),)
             res[2] = ctx
+            # Hand every pushed result over as soon as it is pushed
+            if stream != None:
+                stream(res[1][0], ctx)
         # Run the task
         res[0] = self.module.spits_worker_run(p_user_data, ctask,
             ctasksz, self.cpusher(push), taskctx)
         # Return the pushed data along with the return code of the method
         return res
 
+    def spits_worker_run_batch(self, user_data, tasks, taskctxs, pool=None,
+        streams=None):
+        # Fall back to one call per task if the batch is not exported
+        if not hasattr(self.module, 'spits_worker_run_batch'):
+            return [self.spits_worker_run(user_data, tasks[i], taskctxs[i],
+                pool, streams[i] if streams != None else None)
+                for i in range(len(tasks))]
+        n = len(tasks)
+        res = [[None, None, None] for i in range(n)]
+        # Get the native pointer to the user data
+        p_user_data = user_data.get_value()
+        # Create the arrays of pointers to the tasks and task sizes
+        keep, ctasks, ctaskssz = self.to_c_arrays(tasks)
+        crets = (ctypes.c_int * n)()
+        # Create an inner converter for the callback
+        def push(cres, cressz, ctx):
+            res[ctx - 1][1] = (self.to_spilled_array(cres, cressz, pool),)
+            res[ctx - 1][2] = taskctxs[ctx - 1]
+            if streams != None:
+                streams[ctx - 1](res[ctx - 1][1][0], taskctxs[ctx - 1])
+        # Run the tasks
+        self.module.spits_worker_run_batch(p_user_data, n, ctasks, ctaskssz,
+            self.cpusher(push), self.c_contexts(n), crets)
+        # Return the pushed data along with the return code of each task
+        for i in range(n):
+            res[i][0] = crets[i]
+        return res
+
     def spits_worker_finalize(self, user_data):
         # Get the native pointer to the user data
         p_user_data = user_data.get_value()
@@ -302,6 +435,21 @@ class JobBinary(object):
         p_user_data = user_data.get_value()
         return self.module.spits_committer_commit_pit(p_user_data, cres, cressz)
 
+    def spits_committer_commit_pits(self, user_data, results):
+        # Fall back to one call per result if the batch is not exported
+        if not hasattr(self.module, 'spits_committer_commit_pits'):
+            return [self.spits_committer_commit_pit(user_data, result)
+                for result in results]
+        n = len(results)
+        # Create the arrays of pointers to the results and result sizes
+        keep, cres, cressz = self.to_c_arrays(results)
+        crets = (ctypes.c_int * n)()
+        # Get the native pointer to the user data
+        p_user_data = user_data.get_value()
+        self.module.spits_committer_commit_pits(p_user_data, n, cres,
+            cressz, crets)
+        return list(crets)
+
     def spits_committer_commit_job(self, user_data, jobctx):
         fres = [None, None, None]
         # Get the native pointer to the user data
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import heapq, itertools, time
+
+class LeaseHeap(object):
+    """Leases of the tasks pushed to the task managers. Each copy of a
+       task holds a lease until it expires, the leases are kept in a heap
+       ordered by expiration so only the expired ones are looked at. A
+       task is pushed again when a lease expires and it has less than
+       max_copies leases left."""
+
+    def __init__(self, duration, max_copies=1):
+        """Construct a new heap giving leases of duration seconds."""
+        self.duration = duration
+        self.max_copies = max(max_copies, 1)
+        self.heap = [] # (expiration, sequence, taskid, holder)
+        self.tasks = {} # taskid: [task, {holder: expiration}]
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def Grant(self, taskid, task, holder, now=None):
+        """Lease a task pushed to the task manager named holder."""
+        if now == None:
+            now = time.time()
+        expiration = now + self.duration
+        entry = self.tasks.setdefault(taskid, [task, {}])
+        entry[1][holder] = expiration
+        heapq.heappush(self.heap, (expiration, next(self.sequence), taskid,
+            holder))
+
+    def Copies(self, taskid):
+        """Get the number of leases held on a task."""
+        entry = self.tasks.get(taskid, None)
+        return len(entry[1]) if entry != None else 0
+
+    def Holds(self, taskid, holder):
+        """Tell if the task manager named holder has a lease on a task."""
+        entry = self.tasks.get(taskid, None)
+        return entry != None and holder in entry[1]
+
+    def Release(self, taskid):
+        """Drop the leases of a task that was committed."""
+        self.tasks.pop(taskid, None)
+
+    def Expired(self, pending, now=None):
+        """Get the next task to push again as (taskid, task), or None. Only
+           tasks in pending are pushed again, the others are dropped."""
+        if now == None:
+            now = time.time()
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            expiration, seq, taskid, holder = heapq.heappop(self.heap)
+            entry = self.tasks.get(taskid, None)
+            # Skip the leases that were renewed or released
+            if entry == None or entry[1].get(holder, None) != expiration:
+                continue
+            del entry[1][holder]
+            if taskid not in pending:
+                del self.tasks[taskid]
+                continue
+            if len(entry[1]) < self.max_copies:
+                return (taskid, entry[0])
+        return None
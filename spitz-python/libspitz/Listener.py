@@ -26,19 +26,53 @@ from libspitz import ClientEndpoint
 from libspitz import config
 from libspitz import log_lines
 
-import socket, threading, time, logging, os, traceback, sys
+import socket, threading, time, logging, os, traceback, sys, errno
+
+try:
+    import Queue as queue # Python 2
+except ImportError:
+    import queue # Python 3
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
 
 class Listener(object):
     """Threaded TCP/UDS listener with callback"""
 
-    def __init__(self, mode, address, port, callback, user_args):
+    def __init__(self, mode, address, port, callback, user_args,
+        backlog=config.listen_backlog, handlers=0, accept=None):
+        """Construct a new listener. When handlers is 0 a new thread is
+           started for every connection and callback serves the whole
+           connection. Otherwise all idle connections are watched by a
+           single thread and the events are served by a pool of handlers
+           threads: accept is called once for a new connection and
+           callback every time the connection has a request to be read.
+           Both return True to keep the connection open."""
         self.mode = mode
         self.addr = address
         self.port = port
         self.callback = callback
         self.user_args = user_args
+        self.backlog = backlog
+        self.handlers = handlers
+        self.accept = accept
         self.thread = None
         self.socket = None
+
+        # Connections waiting for a handler and connections waiting to
+        # be watched again
+        self.events = queue.Queue()
+        self.rearm = []
+        self.rearm_lock = threading.Lock()
+        self.wakeup = None
+
+        # Metrics of the events served by the handlers
+        self.stats_lock = threading.Lock()
+        self.stats = { 'events': 0, 'wait': 0.0, 'max_wait': 0.0,
+            'max_depth': 0 }
+        self.stats_interval = 60
         
     def GetConnectableAddr(self):
         addr = '' #self.mode
@@ -46,6 +80,9 @@ class Listener(object):
             addr += socket.gethostname() + ':' + str(self.port)
         elif self.mode == config.mode_uds:
             addr += socket.gethostname() + ':' + str(self.addr)
+        elif self.mode == config.mode_shm:
+            # Only reachable from the same host
+            addr += str(self.addr) + ':0 shm'
         else:
             logging.error('Invalid listener mode %s provided!' % (self.mode))
             raise Exception()
@@ -55,7 +92,7 @@ class Listener(object):
         if self.mode == config.mode_tcp:
             logging.info('Listening to network at %s:%d...',
                 self.addr, self.port)
-        elif self.mode == config.mode_uds:
+        elif self.mode in (config.mode_uds, config.mode_shm):
             logging.info('Listening to file at %s...',
                 self.addr)
         while True:
@@ -66,14 +103,17 @@ class Listener(object):
                 if self.mode == config.mode_tcp:
                     # TCP
                     addr, port = addr
-                elif self.mode == config.mode_uds:
+                    conn.setsockopt(socket.IPPROTO_TCP,
+                        socket.TCP_NODELAY, 1)
+                elif self.mode in (config.mode_uds, config.mode_shm):
                     # UDS
-                    addr = 'uds'
+                    addr = self.mode
                     port = 0
 
                 # Create the endpoint and send to a thread to
                 # process the request
-                endpoint = ClientEndpoint(addr, port, conn)
+                endpoint = ClientEndpoint(addr, port, conn,
+                    self.mode == config.mode_shm)
                 threading.Thread(target = self.callback,
                     args=((endpoint, addr, port) + self.user_args)).start()
             except:
@@ -81,6 +121,137 @@ class Listener(object):
                 log_lines(traceback.format_exc(), logging.debug)
                 time.sleep(10)
 
+    def accept_all(self):
+        # Accept all pending connections from the non-blocking socket
+        conns = []
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except (socket.error, OSError) as e:
+                if isinstance(e, socket.timeout) or getattr(e, 'errno',
+                        None) in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                # Probably out of file descriptors, let the handlers
+                # close some connections before trying again
+                logging.warning('Failed to accept connection!')
+                log_lines(traceback.format_exc(), logging.debug)
+                time.sleep(0.1)
+                break
+
+            conn.setblocking(True)
+
+            # Assign the address from the connection
+            if self.mode == config.mode_tcp:
+                # TCP
+                addr, port = addr
+                conn.setsockopt(socket.IPPROTO_TCP,
+                    socket.TCP_NODELAY, 1)
+            elif self.mode in (config.mode_uds, config.mode_shm):
+                # UDS
+                addr = self.mode
+                port = 0
+
+            conns.append(ClientEndpoint(addr, port, conn,
+                self.mode == config.mode_shm))
+        return conns
+
+    def dispatch(self, callback, endpoint):
+        depth = self.events.qsize() + 1
+        with self.stats_lock:
+            self.stats['max_depth'] = max(self.stats['max_depth'], depth)
+        self.events.put((callback, endpoint, time.time()))
+
+    def dispatcher(self):
+        if self.mode == config.mode_tcp:
+            logging.info('Listening to network at %s:%d with %d handlers...',
+                self.addr, self.port, self.handlers)
+        elif self.mode in (config.mode_uds, config.mode_shm):
+            logging.info('Listening to file at %s with %d handlers...',
+                self.addr, self.handlers)
+
+        sel = selectors.DefaultSelector()
+        sel.register(self.socket, selectors.EVENT_READ, None)
+        sel.register(self.wakeup[0], selectors.EVENT_READ, self.wakeup)
+        t_stats = time.time()
+
+        while self.socket != None:
+            for key, mask in sel.select(self.stats_interval):
+                if key.data == None:
+                    # New connections, the handshake is served
+                    # by the handlers
+                    for endpoint in self.accept_all():
+                        self.dispatch(self.accept, endpoint)
+
+                elif key.data is self.wakeup:
+                    # Watch again the connections released by
+                    # the handlers
+                    try:
+                        self.wakeup[0].recv(4096)
+                    except:
+                        pass
+                    with self.rearm_lock:
+                        rearm, self.rearm = self.rearm, []
+                    for endpoint in rearm:
+                        try:
+                            sel.register(endpoint.socket,
+                                selectors.EVENT_READ, endpoint)
+                        except:
+                            log_lines(traceback.format_exc(), logging.debug)
+                            endpoint.Close()
+
+                else:
+                    # A request arrived or the connection was closed,
+                    # stop watching until the handler is done with it
+                    sel.unregister(key.fileobj)
+                    self.dispatch(self.callback, key.data)
+
+            if time.time() - t_stats >= self.stats_interval:
+                t_stats = time.time()
+                self.LogStats(logging.debug)
+
+        sel.close()
+
+    def handler(self):
+        while True:
+            callback, endpoint, t_queued = self.events.get()
+            if callback == None:
+                return
+
+            wait = time.time() - t_queued
+            with self.stats_lock:
+                self.stats['events'] += 1
+                self.stats['wait'] += wait
+                self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+
+            try:
+                keep = callback(*((endpoint, endpoint.address,
+                    endpoint.port) + self.user_args))
+            except:
+                log_lines(traceback.format_exc(), logging.debug)
+                keep = False
+
+            if not keep or endpoint.socket == None:
+                endpoint.Close()
+                continue
+
+            # Give the connection back to the dispatcher
+            with self.rearm_lock:
+                self.rearm.append(endpoint)
+            try:
+                self.wakeup[1].send(b'\0')
+            except:
+                pass
+
+    def LogStats(self, dest):
+        """Log the number of events served, the time they waited for a
+           handler and the largest number of events waiting."""
+        with self.stats_lock:
+            s = dict(self.stats)
+        if s['events'] > 0:
+            dest('Listener served %d events, wait avg %.6fs max %.6fs, ' \
+                'max queue depth %d.' % (s['events'], s['wait'] /
+                s['events'], s['max_wait'], s['max_depth']))
+
     def Start(self):
         if self.socket:
             return
@@ -89,7 +260,7 @@ class Listener(object):
             # Create a TCP socket
             socktype = socket.AF_INET
             sockaddr = (self.addr, self.port)
-        elif self.mode == config.mode_uds:
+        elif self.mode in (config.mode_uds, config.mode_shm):
             # Remove an old socket
             try:
                 os.unlink(self.addr)
@@ -117,7 +288,7 @@ class Listener(object):
             
         try:    
             self.socket.bind(sockaddr)
-            self.socket.listen(1)
+            self.socket.listen(self.backlog)
         except socket.error:
             logging.error('Failed to bind listener socket!')
             
@@ -126,15 +297,31 @@ class Listener(object):
         if self.mode == config.mode_tcp and self.port == 0:
             addr, port = self.socket.getsockname()
             self.port = port
-            
-        self.thread = threading.Thread(target=self.listener)
+
+        if self.handlers > 0:
+            if selectors == None:
+                logging.error('The system does not support selectors!')
+                raise Exception()
+            self.socket.setblocking(False)
+            self.wakeup = socket.socketpair()
+            self.wakeup[0].setblocking(False)
+            for i in range(self.handlers):
+                threading.Thread(target=self.handler).start()
+            self.thread = threading.Thread(target=self.dispatcher)
+        else:
+            self.thread = threading.Thread(target=self.listener)
         self.thread.start()
 
     def Stop(self):
         if self.socket:
             self.socket.close()
             self.socket = None
-            if self.mode == config.mode_uds:
+            if self.handlers > 0:
+                # Wake up the dispatcher and stop the handlers
+                self.wakeup[1].send(b'\0')
+                for i in range(self.handlers):
+                    self.events.put((None, None, None))
+            if self.mode in (config.mode_uds, config.mode_shm):
                 # Remove the socket file if it is an UDS
                 try:
                     os.unlink(self.addr)
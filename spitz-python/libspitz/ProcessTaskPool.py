@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+from .TaskPool import TaskPool
+from .JobBinary import JobBinary
+from libspitz import messaging, config, shm, log_lines
+
+import itertools, logging, multiprocessing, threading, traceback
+
+# Payloads are passed to and from the worker processes through the pipe,
+# the large ones are copied to the ring of shared memory of the sender
+
+def _pack(data, ring):
+    if data == None:
+        return None
+    if len(data) >= config.shm_threshold:
+        offset = ring.Write(data)
+        if offset != None:
+            return (shm.segment, ring.name, offset, len(data))
+    return (shm.inline, bytes(data))
+
+def _unpack(desc, peer):
+    if desc == None:
+        return None
+    if desc[0] == shm.inline:
+        return desc[1]
+    return peer.Read(desc[1], desc[2], desc[3])
+
+def _child(conn, filename, argv, name):
+    # Create the native worker once and run the tasks sent by the parent,
+    # the results are sent back as soon as they are pushed. The ring of
+    # the results is named by the parent, which removes it if the child
+    # dies before it was mapped
+    ring = shm.Ring(config.shm_ring, name)
+    peer = shm.Peer()
+    job = JobBinary(filename)
+    state = job.spits_worker_new(argv)
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+        if msg == None:
+            job.spits_worker_finalize(state)
+            return
+        tasks = [_unpack(x, peer) for x in msg[0]]
+        def stream(i):
+            return lambda res, ctx: conn.send(('push', i, _pack(res, ring)))
+        res = job.spits_worker_run_batch(state, tasks, msg[1], None,
+            [stream(i) for i in range(len(tasks))])
+        conn.send(('done', [x[0] for x in res]))
+
+class WorkerProcess(object):
+    """Worker running the native code in a child process, so a crash does
+       not take down the task manager. It exposes the worker methods of
+       JobBinary, the native state lives in the child process."""
+
+    # Return code of the tasks whose worker process crashed
+    crashed = messaging.as_result(messaging.res_module_error)
+
+    def __init__(self, filename, argv):
+        self.filename = filename
+        self.argv = argv
+        self.ctx = multiprocessing.get_context('spawn')
+        self.tags = itertools.count(1)
+        self.tag = None # Tag of the tasks being run by the child
+        self.killed = False
+        self.lock = threading.Lock()
+        self.Start()
+
+    def Start(self):
+        self.ring = shm.Ring(config.shm_ring)
+        self.peer = shm.Peer()
+        self.results = shm.new_name() # Ring of the child
+        self.conn, child = self.ctx.Pipe()
+        self.process = self.ctx.Process(target=_child, args=(child,
+            self.filename, self.argv, self.results))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def Restart(self):
+        self.conn.close()
+        self.process.join(1)
+        self.release()
+        logging.warning('Worker process %d exited with code %s, ' +
+            'restarting it...', self.process.pid, self.process.exitcode)
+        self.Start()
+
+    def Tag(self):
+        """Tag the tasks about to be sent to the child process, return the
+           tag passed to Kill."""
+        with self.lock:
+            self.tag = next(self.tags)
+            return self.tag
+
+    def Kill(self, tag):
+        """Kill the child process if it is still running the tasks tagged
+           with tag, they fail and it is restarted. Return False if they
+           already finished."""
+        with self.lock:
+            if tag != self.tag:
+                return False
+            self.tag = None
+            self.killed = True
+            self.process.kill()
+            return True
+
+    def finished(self):
+        # Untag the tasks, return True if the child was killed meanwhile
+        with self.lock:
+            killed = self.killed
+            self.tag = None
+            self.killed = False
+            return killed
+
+    def spits_worker_run(self, user_data, task, taskctx, pool=None,
+        stream=None):
+        return self.spits_worker_run_batch(user_data, [task], [taskctx],
+            pool, [stream] if stream != None else None)[0]
+
+    def spits_worker_run_batch(self, user_data, tasks, taskctxs, pool=None,
+        streams=None):
+        res = [[None, None, None] for i in range(len(tasks))]
+        try:
+            self.conn.send(([_pack(x, self.ring) for x in tasks],
+                list(taskctxs)))
+            while True:
+                msg = self.conn.recv()
+                if msg[0] == 'done':
+                    for i, r in enumerate(msg[1]):
+                        res[i][0] = r
+                    # The child may be killed after sending the last
+                    # results, the next tasks need a new one
+                    if self.finished():
+                        self.Restart()
+                    return res
+                i, data = msg[1], _unpack(msg[2], self.peer)
+                res[i][1] = (data,)
+                res[i][2] = taskctxs[i]
+                if streams != None:
+                    streams[i](data, taskctxs[i])
+        except (EOFError, IOError, OSError):
+            logging.error('The worker process crashed while processing ' +
+                'the tasks %s!', list(taskctxs))
+            log_lines(traceback.format_exc(), logging.debug)
+        self.finished()
+        self.Restart()
+        for x in res:
+            x[0] = self.crashed
+        return res
+
+    def spits_worker_finalize(self, user_data):
+        try:
+            self.conn.send(None)
+        except:
+            pass
+        self.process.join()
+        self.release()
+
+    def release(self):
+        # Remove the rings of the exited child, the payloads already
+        # read from its ring stay mapped until they are collected
+        self.ring.Close()
+        self.peer.Close()
+        shm.unlink(self.results)
+
+class ProcessTaskPool(TaskPool):
+    """Task pool running the native workers in child processes. Each thread
+       of the pool drives a worker process, created once with the job
+       module at filename and argv. The worker receives the WorkerProcess
+       as its state."""
+
+    def __init__(self, max_threads, overfill, filename, argv, worker,
+        user_args, batch=1, finalizer=None):
+        TaskPool.__init__(self, max_threads, overfill, self.spawn, worker,
+            user_args, batch, finalizer)
+        self.filename = filename
+        self.argv = argv
+
+    def spawn(self, *user_args):
+        return WorkerProcess(self.filename, self.argv)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import collections, hashlib, struct, threading
+
+class ResultCache(object):
+    """Cache of the results of completed tasks, keyed by a hash of the
+       job module, the job run and the task payload. Tasks are idempotent,
+       so a task received again can be answered from the cache. The least
+       recently used results are evicted to stay within the limit."""
+
+    def __init__(self, limit, salt=b''):
+        """Construct a new cache holding at most limit bytes of results.
+           The salt identifies the job module and its arguments."""
+        self.limit = limit
+        self.salt = salt
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = { 'hits' : 0, 'misses' : 0, 'evictions' : 0 }
+
+    def Key(self, runid, task):
+        """Get the key of a task payload sent by a job run."""
+        h = hashlib.sha1(self.salt)
+        h.update(struct.pack('!q', runid))
+        if task is not None:
+            h.update(task)
+        return h.digest()
+
+    def Get(self, key):
+        """Get the (r, res) cached for a key, or None."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry == None:
+                self.stats['misses'] += 1
+                return None
+            # Mark as the most recently used
+            self.entries[key] = entry
+            self.stats['hits'] += 1
+            return entry
+
+    def Put(self, key, r, res):
+        """Cache a copy of the result of a task."""
+        res = bytes(res) if res is not None else None
+        size = len(res) if res is not None else 0
+        if size > self.limit:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old != None:
+                self.size -= len(old[1]) if old[1] is not None else 0
+            self.entries[key] = (r, res)
+            self.size += size
+            while self.size > self.limit:
+                self.evict()
+
+    def evict(self):
+        # Drop the least recently used result
+        key, (r, res) = self.entries.popitem(False)
+        self.size -= len(res) if res is not None else 0
+        self.stats['evictions'] += 1
+
+    def Size(self):
+        """Get the number of bytes of cached results."""
+        with self.lock:
+            return self.size
+
+    def LogStats(self, dest):
+        """Log how many tasks were answered from the cache."""
+        with self.lock:
+            s = dict(self.stats)
+            size = self.size
+        if s['hits'] + s['misses'] > 0:
+            dest('Result cache answered %d of %d tasks, %d evictions, ' \
+                '%d bytes cached.' % (s['hits'], s['hits'] + s['misses'],
+                s['evictions'], size))
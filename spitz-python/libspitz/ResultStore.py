@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+from libspitz import spill
+
+import collections, threading
+
+try:
+    import Queue as queue # Python 2
+except:
+    import queue # Python 3
+
+class ResultStore(object):
+    """Queue of the results waiting to be sent to the job manager. The
+       payloads are kept in memory up to a memory limit and the ones that
+       do not fit are appended to memory mapped spill files, replayed in
+       order. Producers only wait when the disk limit is also reached.
+       Items are (taskid, runid, r, res, c) and the methods follow the
+       queue module."""
+
+    def __init__(self, memory_limit, disk_limit, segment, release=None):
+        """Construct a new store keeping at most memory_limit bytes of
+           payloads in memory and disk_limit bytes in spill files of
+           segment bytes. Payloads copied to disk are given to release."""
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.segment = max(segment, 1)
+        self.release = release
+        self.items = collections.deque()
+        self.memory = 0
+        self.disk = 0
+        # Spill file being appended as [mapping, offset, pending records]
+        self.current = None
+        self.cond = threading.Condition()
+        self.stats = { 'spilled' : 0, 'throttled' : 0 }
+
+    def payload_size(self, res):
+        """Get the memory used by a payload, payloads already backed by a
+           file do not count."""
+        if res is None or spill.is_spilled(res):
+            return 0
+        if isinstance(res, memoryview) and spill.is_spilled(res.obj):
+            return 0
+        return len(res)
+
+    def put(self, item, block=True):
+        """Queue an item. An item that does not fit waits for space, unless
+           block is False or the store is empty, and is then kept in
+           memory regardless of the limit."""
+        res = item[3]
+        size = self.payload_size(res)
+        with self.cond:
+            throttled = False
+            while True:
+                if size == 0 or self.memory + size <= self.memory_limit:
+                    self.items.append((item, size, None))
+                    self.memory += size
+                    res = None
+                    break
+                seg = self.reserve(size)
+                if seg != None:
+                    # Only the payload goes to disk
+                    self.items.append((item[:3] + (None, item[4]), size,
+                        (seg, self.append(seg, res))))
+                    self.stats['spilled'] += 1
+                    break
+                if not block or len(self.items) == 0:
+                    self.items.append((item, size, None))
+                    self.memory += size
+                    res = None
+                    break
+                if not throttled:
+                    self.stats['throttled'] += 1
+                    throttled = True
+                self.cond.wait()
+        if res is not None and self.release != None:
+            self.release(res)
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+    def get_nowait(self):
+        """Remove and return the oldest item, raise queue.Empty if there
+           are none."""
+        with self.cond:
+            if len(self.items) == 0:
+                raise queue.Empty()
+            item, size, spilled = self.items.popleft()
+            if spilled == None:
+                self.memory -= size
+            else:
+                seg, offset = spilled
+                # The view keeps the mapping alive after it is retired
+                item = item[:3] + (memoryview(seg[0])[offset:offset + size],
+                    item[4])
+                seg[2] -= 1
+                if seg[2] == 0 and seg is not self.current:
+                    self.disk -= len(seg[0])
+            self.cond.notify_all()
+        return item
+
+    def qsize(self):
+        with self.cond:
+            return len(self.items)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def reserve(self, size):
+        # Find a spill file with room for size bytes, appending a new
+        # one if the disk limit allows it
+        seg = self.current
+        if seg != None and seg[1] + size <= len(seg[0]):
+            return seg
+        if seg != None and seg[2] == 0:
+            self.disk -= len(seg[0])
+        self.current = None
+        n = max(min(self.segment, self.disk_limit), size)
+        if self.disk + n > self.disk_limit:
+            return None
+        self.current = [spill.allocate(n), 0, 0]
+        self.disk += n
+        return self.current
+
+    def append(self, seg, res):
+        offset = seg[1]
+        seg[0][offset:offset + len(res)] = res
+        seg[1] += len(res)
+        seg[2] += 1
+        return offset
+
+    def Usage(self):
+        """Get the bytes of payloads held in memory and on disk."""
+        with self.cond:
+            return self.memory, self.disk
+
+    def LogStats(self, dest):
+        """Log how many results were spilled and how many producers had
+           to wait."""
+        with self.cond:
+            s = dict(self.stats)
+            memory, disk = self.memory, self.disk
+        if s['spilled'] + s['throttled'] > 0:
+            dest('Result store spilled %d results, throttled %d times, ' \
+                '%d bytes in memory and %d bytes on disk.' % (s['spilled'],
+                s['throttled'], memory, disk))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+from libspitz import messaging
+from libspitz import log_lines
+
+import logging, select, threading, time, traceback
+
+class ResultWatcher(object):
+    """Keep a session open with every task manager to be told when it has
+       results ready, so the results are only pulled from the task managers
+       that have them. The notifications are read from the watcher thread."""
+
+    def __init__(self, subscribe, interval=1.0):
+        """Construct a new watcher. subscribe(name, endpoint) opens a
+           session with a task manager, asks for the notifications and
+           returns the session, or None if it failed. The sessions added
+           are watched after at most interval seconds."""
+        self.subscribe = subscribe
+        self.interval = interval
+        self.sessions = {} # name: endpoint
+        self.ready = {} # name: (count, bytes) of the last notification
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.stopped = False
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def Stop(self):
+        """Stop the watcher thread and close all sessions."""
+        self.stopped = True
+        with self.lock:
+            names = list(self.sessions)
+        for name in names:
+            self.drop(name)
+
+    def Update(self, tmlist):
+        """Subscribe to the task managers in tmlist that are not watched
+           and stop watching the ones that left the list."""
+        with self.lock:
+            names = set(self.sessions)
+        for name in names:
+            if name not in tmlist:
+                self.drop(name)
+        for name, endpoint in tmlist.items():
+            if name in names:
+                continue
+            e = self.subscribe(name, endpoint)
+            if e == None:
+                continue
+            with self.lock:
+                self.sessions[name] = e
+
+    def Take(self, name):
+        """Return True if the task manager has results ready or is not
+           watched, in which case it must be polled, and forget its
+           notification."""
+        with self.lock:
+            if name not in self.sessions:
+                return True
+            return self.ready.pop(name, None) != None
+
+    def Wait(self, timeout):
+        """Wait up to timeout seconds for a notification, return True if
+           one arrived."""
+        ready = self.event.wait(timeout)
+        self.event.clear()
+        return ready
+
+    def drop(self, name):
+        with self.lock:
+            e = self.sessions.pop(name, None)
+            self.ready.pop(name, None)
+        if e != None:
+            e.Close()
+
+    def read(self, name, e):
+        try:
+            mtype, count, nbytes = e.ReadHeader(messaging.ready_header,
+                self.interval)
+            if mtype != messaging.msg_results_ready:
+                raise messaging.MessagingError()
+        except:
+            # The task manager is polled until it is subscribed again
+            logging.debug('Stopped watching the results of %s!', name)
+            log_lines(traceback.format_exc(), logging.debug)
+            self.drop(name)
+            self.event.set()
+            return
+        logging.debug('Task manager %s has %d results ready (%d bytes).',
+            name, count, nbytes)
+        with self.lock:
+            if name in self.sessions:
+                self.ready[name] = (count, nbytes)
+        self.event.set()
+
+    def run(self):
+        while not self.stopped:
+            with self.lock:
+                sessions = dict((e.socket, (name, e)) for name, e in
+                    self.sessions.items() if e.socket != None)
+            if len(sessions) == 0:
+                time.sleep(self.interval)
+                continue
+            try:
+                readable = select.select(list(sessions), [], [],
+                    self.interval)[0]
+            except:
+                # A session was closed while being watched
+                continue
+            for s in readable:
+                self.read(*sessions[s])
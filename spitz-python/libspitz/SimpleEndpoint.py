@@ -23,17 +23,23 @@
 # IN THE SOFTWARE.
 
 from .Endpoint import Endpoint
-from libspitz import messaging
+from libspitz import messaging, config, shm
 
-import socket, logging
+import select, socket, logging
 
 class SimpleEndpoint(Endpoint):
     """Simple message exchange class"""
 
-    def __init__(self, address, port):
+    def __init__(self, address, port, shm=False):
         self.address = address
         self.port = port
         self.socket = None
+        self.codec = None
+        # Large payloads go through rings of shared memory, only
+        # for Unix Domain Sockets
+        self.shm = shm and port <= 0
+        self.ring = None
+        self.peer = None
 
     def Open(self, timeout):
         if self.socket:
@@ -66,13 +72,80 @@ class SimpleEndpoint(Endpoint):
         self.socket.settimeout(timeout)
         self.socket.connect(sockaddr)
 
-    def Read(self, size, timeout):
-        return messaging.recv(self.socket, size, timeout)
+        if socktype == socket.AF_INET:
+            # Messages are written with a single call, do not
+            # delay them waiting for more data
+            self.socket.setsockopt(socket.IPPROTO_TCP,
+                socket.TCP_NODELAY, 1)
+
+    def Read(self, size, timeout, buf=None):
+        return messaging.recv(self.socket, size, timeout, buf)
+
+    def ReadPayload(self, size, timeout, buf=None):
+        if not self.shm or size <= 0:
+            return Endpoint.ReadPayload(self, size, timeout, buf)
+        flag, name, offset = shm.descriptor.unpack(self.Read(
+            shm.descriptor.size, timeout))
+        if flag == shm.inline:
+            return Endpoint.ReadPayload(self, size, timeout, buf)
+        # The payload is used in place, buf is not needed
+        if self.peer == None:
+            self.peer = shm.Peer()
+        return self.peer.Read(name.rstrip(b'\0').decode('ascii'), offset,
+            size)
 
     def Write(self, data):
         self.socket.sendall(data)
 
+    def WriteMessage(self, header, values, payload=None):
+        if not self.shm or payload == None or len(payload) == 0:
+            messaging.send(self.socket, [header.pack(*values), payload])
+            return
+        offset = None
+        if len(payload) >= config.shm_threshold:
+            if self.ring == None:
+                self.ring = shm.Ring(config.shm_ring)
+            offset = self.ring.Write(payload)
+        if offset == None:
+            # Small payloads and the ones not fitting in the ring
+            # follow the descriptor
+            messaging.send(self.socket, [header.pack(*values),
+                shm.descriptor.pack(shm.inline, b'', 0), payload])
+        else:
+            messaging.send(self.socket, [header.pack(*values),
+                shm.descriptor.pack(shm.segment,
+                    self.ring.name.encode('ascii'), offset)])
+
+    def Alive(self):
+        # An idle connection must not have anything to be read,
+        # otherwise it was closed by the other side or the
+        # stream is out of sync
+        if self.socket == None:
+            return False
+        try:
+            ready = select.select([self.socket], [], [], 0)
+        except:
+            return False
+        return not ready[0]
+
+    def Shutdown(self):
+        # Wake up any thread blocked on the socket, the endpoint
+        # still has to be closed by its owner
+        s = self.socket
+        if s != None:
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+
     def Close(self):
         if self.socket != None:
             self.socket.close()
             self.socket = None
+        self.codec = None
+        if self.ring != None:
+            self.ring.Close()
+            self.ring = None
+        if self.peer != None:
+            self.peer.Close()
+            self.peer = None
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import collections, threading, time
+
+class Speculator(object):
+    """Launch speculative copies of the straggler tasks. The latency from
+       the first push of a task to its commit is recorded and a task still
+       uncommitted after multiple times a percentile of the latencies is
+       pushed again to another task manager, once enough latencies were
+       observed. The first result committed wins."""
+
+    def __init__(self, multiple, percentile=0.95, samples=20):
+        self.multiple = multiple
+        self.percentile = percentile
+        self.samples = samples
+        self.latencies = collections.deque(maxlen=1000)
+        self.dispatched = collections.OrderedDict() # taskid: first push
+        self.speculated = {} # taskid: [copies launched, last launch]
+        self.lock = threading.Lock()
+        self.stats = { 'committed' : 0, 'copies' : 0, 'speculated' : 0,
+            'finished' : 0 }
+
+    def Dispatch(self, taskid, now=None, completed=None):
+        """Record the push of a task, only the first push counts. The push
+           is recorded after the task was sent, so a task found in the
+           completed dict was committed in between and is ignored."""
+        if now == None:
+            now = time.time()
+        with self.lock:
+            if completed != None and \
+                    completed.get(taskid, (None, None))[0] != None:
+                return
+            if taskid not in self.dispatched:
+                self.dispatched[taskid] = now
+
+    def Commit(self, taskid, now=None):
+        """Record the commit of a task."""
+        if now == None:
+            now = time.time()
+        with self.lock:
+            start = self.dispatched.pop(taskid, None)
+            if start == None:
+                return
+            self.latencies.append(now - start)
+            self.stats['committed'] += 1
+            if self.speculated.pop(taskid, None) != None:
+                self.stats['finished'] += 1
+
+    def Threshold(self):
+        """Get the time after which an uncommitted task is a straggler,
+           None if not enough latencies were observed."""
+        with self.lock:
+            if len(self.latencies) < self.samples:
+                return None
+            latencies = sorted(self.latencies)
+        i = min(int(len(latencies) * self.percentile), len(latencies) - 1)
+        return latencies[i] * self.multiple
+
+    def Straggler(self, pending, leases, holder, now=None):
+        """Get a straggler to copy to the task manager named holder as
+           (taskid, task), or None. Tasks already leased to the holder,
+           with the maximum number of copies or copied less than the
+           threshold ago are skipped."""
+        threshold = self.Threshold()
+        if threshold == None:
+            return None
+        if now == None:
+            now = time.time()
+        with self.lock:
+            # The tasks are in the order they were first pushed, so the
+            # search stops at the first one that is not late
+            for taskid, start in self.dispatched.items():
+                if now - start < threshold:
+                    return None
+                p = pending.get(taskid, None)
+                if p == None or leases.Holds(taskid, holder):
+                    continue
+                if leases.Copies(taskid) >= leases.max_copies:
+                    continue
+                copies = self.speculated.get(taskid, None)
+                if copies == None:
+                    copies = self.speculated[taskid] = [0, None]
+                    self.stats['speculated'] += 1
+                elif now - copies[1] < threshold:
+                    continue
+                copies[0] += 1
+                copies[1] = now
+                self.stats['copies'] += 1
+                return (taskid, p[1])
+        return None
+
+    def LogStats(self, dest):
+        """Log how many speculative copies were launched."""
+        threshold = self.Threshold()
+        with self.lock:
+            s = dict(self.stats)
+        dest('Launched %d speculative copies of %d of %d tasks, %d of ' \
+            'them committed, straggler threshold %s.' % (s['copies'],
+            s['speculated'], s['committed'], s['finished'],
+            '%.3fs' % threshold if threshold != None else 'not reached'))
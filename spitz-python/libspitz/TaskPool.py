@@ -32,17 +32,34 @@ except:
 class TaskPool(object):
     """description of class"""
 
-    def __init__(self, max_threads, overfill, initializer, worker, user_args):
+    def __init__(self, max_threads, overfill, initializer, worker, user_args,
+        batch=1, finalizer=None):
+        # With batch greater than one the worker receives a list of up
+        # to batch (taskid, jobid, task) already queued instead of a
+        # single task
         self.max_threads = max_threads
+        self.overfill = overfill
+        self.batch = batch
         self.user_args = user_args
         self.initializer = initializer
+        self.finalizer = finalizer
         self.worker = worker
-        self.tasks = queue.Queue(maxsize=max_threads + overfill)
+        # The queue is unbounded so stop requests for retiring threads
+        # always fit, the capacity is enforced by Put instead
+        self.capacity = max_threads + overfill
+        self.tasks = queue.Queue()
+        self.lock = threading.Lock()
+        self.retiring = 0
+        self.detached = set()
+        self.started = False
         self.threads = [threading.Thread(target=self.runner) for
             i in range(max_threads)]
 
     def start(self):
-        for t in self.threads:
+        with self.lock:
+            self.started = True
+            threads = list(self.threads)
+        for t in threads:
             t.start()
 
     def runner(self):
@@ -56,22 +73,132 @@ class TaskPool(object):
         while True:
             # Pick a task from the queue and execute it
             # TODO better tm kill
-            taskid, jobid, task = self.tasks.get()
+            item = self.tasks.get()
+            if item == None:
+                self.stopping()
+                break
+            if self.batch > 1:
+                if not self.run_batch(state, item) or self.is_detached():
+                    break
+                continue
+            taskid, jobid, task = item
             try:
                 self.worker(state, taskid, jobid, task, *self.user_args)
             except:
                 logging.error('The worker crashed while processing ' +
                     'the task %d', taskid)
+            if self.is_detached():
+                break
+        self.retire(state)
 
-    def Put(self, taskid, jobid, task):
+    def run_batch(self, state, first):
+        # Take the tasks already waiting, without blocking, and return
+        # False if the thread was asked to stop meanwhile
+        tasks = [first]
+        running = True
+        while len(tasks) < self.batch:
+            try:
+                item = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            if item == None:
+                self.stopping()
+                running = False
+                break
+            tasks.append(item)
         try:
+            self.worker(state, tasks, *self.user_args)
+        except:
+            logging.error('The worker crashed while processing ' +
+                'the tasks %s', [x[0] for x in tasks])
+        return running
+
+    def stopping(self):
+        # The stop request left the queue, stop discounting it
+        with self.lock:
+            self.retiring -= 1
+
+    def is_detached(self):
+        with self.lock:
+            return threading.current_thread() in self.detached
+
+    def retire(self, state):
+        with self.lock:
+            self.detached.discard(threading.current_thread())
+            try:
+                self.threads.remove(threading.current_thread())
+            except ValueError:
+                pass
+        if self.finalizer == None or state == None:
+            return
+        try:
+            # Release the module worker of the retiring thread
+            self.finalizer(state, *self.user_args)
+        except:
+            logging.error('The worker crashed while finalizing!')
+
+    def Resize(self, max_threads):
+        """Change the number of worker threads, new threads initialize
+           their own worker and retiring threads finalize theirs after
+           the task at hand. The queue capacity follows the new size.
+           Return the new number of threads."""
+        max_threads = max(max_threads, 1)
+        with self.lock:
+            delta = max_threads - self.max_threads
+            self.max_threads = max_threads
+            self.capacity = max_threads + self.overfill
+            new = [threading.Thread(target=self.runner) for
+                i in range(max(delta, 0))]
+            self.threads.extend(new)
+            self.retiring += max(-delta, 0)
+            started = self.started
+        # Stop requests are queued behind the pending tasks
+        for i in range(max(-delta, 0)):
+            self.tasks.put(None)
+        if started:
+            for t in new:
+                t.start()
+        return max_threads
+
+    def Replace(self, thread):
+        """Start a new thread in place of a thread stuck in a task. The
+           stuck thread retires if it ever returns."""
+        with self.lock:
+            if thread not in self.threads or thread in self.detached:
+                return
+            self.detached.add(thread)
+            self.threads.remove(thread)
+            t = threading.Thread(target=self.runner)
+            t.daemon = thread.daemon
+            self.threads.append(t)
+        t.start()
+
+    def Size(self):
+        return self.max_threads
+
+    def SetOverfill(self, overfill):
+        """Change the number of tasks queued beyond the worker threads."""
+        with self.lock:
+            self.overfill = max(overfill, 0)
+            self.capacity = self.max_threads + self.overfill
+
+    def Overfill(self):
+        return self.overfill
+
+    def Put(self, taskid, jobid, task):
+        with self.lock:
+            if self.tasks.qsize() - self.retiring >= self.capacity:
+                return False
             self.tasks.put_nowait((taskid, jobid, task))
-        except queue.Full:
-            return False
         return True
 
+    def Free(self):
+        with self.lock:
+            return max(self.capacity - self.tasks.qsize() + self.retiring, 0)
+
     def Full(self):
-        return self.tasks.full()
+        return self.Free() == 0
 
     def Empty(self):
-        return self.tasks.empty()
+        with self.lock:
+            return self.tasks.qsize() - self.retiring <= 0
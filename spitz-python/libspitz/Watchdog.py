@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+from libspitz import log_lines
+
+import collections, itertools, logging, threading, time, traceback
+
+class Watchdog(object):
+    """Expire the tasks running past their deadline. The deadline is
+       either fixed or, when None, a multiple of a percentile of the
+       recent run times, no shorter than minimum, once enough run times
+       were observed. The expire callback is called once for each expired
+       task, from the watchdog thread."""
+
+    def __init__(self, deadline, expire, percentile=0.99, factor=4.0,
+        samples=32, minimum=0, interval=1.0):
+        self.deadline = deadline
+        self.expire = expire
+        self.percentile = percentile
+        self.factor = factor
+        self.samples = samples
+        self.minimum = minimum
+        self.interval = interval
+        self.durations = collections.deque(maxlen=1000)
+        self.running = {} # token: [start, weight, data, expired]
+        self.tokens = itertools.count()
+        self.lock = threading.Lock()
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def Start(self, data, weight=1):
+        """Start watching a task, weight tasks are run together. Return the
+           token passed to Finish."""
+        token = next(self.tokens)
+        with self.lock:
+            self.running[token] = [time.time(), weight, data, False]
+        return token
+
+    def Finish(self, token):
+        """Stop watching a task, return False if it already expired."""
+        with self.lock:
+            start, weight, data, expired = self.running.pop(token)
+            if not expired:
+                self.durations.append((time.time() - start) / weight)
+        return not expired
+
+    def Deadline(self):
+        """Get the deadline of a single task in seconds, None if there is
+           no deadline yet."""
+        if self.deadline != None:
+            return self.deadline
+        with self.lock:
+            if len(self.durations) < self.samples:
+                return None
+            durations = sorted(self.durations)
+        i = min(int(len(durations) * self.percentile), len(durations) - 1)
+        return max(durations[i] * self.factor, self.minimum)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            deadline = self.Deadline()
+            if deadline == None:
+                continue
+            now = time.time()
+            expired = []
+            with self.lock:
+                for entry in self.running.values():
+                    if not entry[3] and now - entry[0] > deadline * entry[1]:
+                        entry[3] = True
+                        expired.append(entry[2])
+            for data in expired:
+                try:
+                    self.expire(data)
+                except:
+                    logging.error('Error expiring a task!')
+                    log_lines(traceback.format_exc(), logging.debug)
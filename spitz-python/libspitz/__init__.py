@@ -25,16 +25,26 @@
 from .LogUtils import *
 
 from .Blob import Blob
+from .BufferPool import BufferPool
+from .ResultStore import ResultStore
+from .ResultCache import ResultCache
 from .Pointer import Pointer
 from .JobBinary import JobBinary
 
 from .Endpoint import Endpoint
 from .SimpleEndpoint import SimpleEndpoint
 from .ClientEndpoint import ClientEndpoint
+from .ConnectionPool import ConnectionPool
+from .LeaseHeap import LeaseHeap
+from .Speculator import Speculator
+from .ResultWatcher import ResultWatcher
+from .CapacityTable import CapacityTable
 
 from .Listener import Listener
 from .TaskPool import TaskPool
+from .ProcessTaskPool import ProcessTaskPool, WorkerProcess
 from .Timeout import timeout
+from .Watchdog import Watchdog
 from .PerfModule import PerfModule
 from .UIDUtils import make_uid
 
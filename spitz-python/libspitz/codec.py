@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import logging, threading, zlib
+
+try:
+    import lzma
+except:
+    lzma = None
+
+# Codec identifiers sent along with compressed payloads
+
+codec_none = 0
+codec_zlib = 1
+codec_lzma = 2
+
+_names = { codec_none : 'none', codec_zlib : 'zlib', codec_lzma : 'lzma' }
+
+# Favor speed, payloads are compressed to save bandwidth
+
+_zlib_level = 1
+_lzma_preset = 0
+
+# Bytes before and after compression for each codec
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+def available():
+    """Get the names of the codecs supported by this runtime."""
+    names = ['zlib']
+    if lzma != None:
+        names.append('lzma')
+    return names
+
+def choose(offered):
+    """Choose the first supported codec from a comma separated list
+       of codec names, return codec_none if none is supported."""
+    supported = available()
+    for name in offered.split(','):
+        name = name.strip()
+        if name in supported:
+            return by_name(name)
+    return codec_none
+
+def by_name(name):
+    """Get the identifier of a codec given its name."""
+    for c, n in _names.items():
+        if n == name:
+            return c
+    raise ValueError('Unknown codec %s!' % name)
+
+def name(c):
+    """Get the name of a codec given its identifier."""
+    return _names.get(c, str(c))
+
+def _count(c, raw, encoded):
+    with _stats_lock:
+        s = _stats.setdefault(c, [0, 0])
+        s[0] += raw
+        s[1] += encoded
+
+def encode(c, data, threshold):
+    """Compress data with the codec, return the codec actually used and
+       the payload. Payloads smaller than the threshold or that do not
+       shrink are kept uncompressed."""
+    if data == None or c == codec_none or len(data) < threshold:
+        return codec_none, data
+    if c == codec_zlib:
+        encoded = zlib.compress(data, _zlib_level)
+    elif c == codec_lzma:
+        encoded = lzma.compress(data, preset=_lzma_preset)
+    else:
+        raise ValueError('Unknown codec %d!' % c)
+    if len(encoded) >= len(data):
+        return codec_none, data
+    _count(c, len(data), len(encoded))
+    return c, encoded
+
+def decode(c, data):
+    """Decompress data compressed with the codec."""
+    if data == None or c == codec_none:
+        return data
+    if c == codec_zlib:
+        decoded = zlib.decompress(data)
+    elif c == codec_lzma:
+        decoded = lzma.decompress(data)
+    else:
+        raise ValueError('Unknown codec %d!' % c)
+    _count(c, len(decoded), len(data))
+    return decoded
+
+def log_stats(dest):
+    """Log the number of bytes handled by each codec."""
+    with _stats_lock:
+        stats = sorted(_stats.items())
+    for c, (raw, encoded) in stats:
+        dest('Codec %s: %d bytes as %d bytes (%.1f%%).' % (name(c), raw,
+            encoded, 100.0 * encoded / raw if raw > 0 else 0))
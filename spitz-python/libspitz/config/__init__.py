@@ -31,11 +31,51 @@ timeout = None # Exit TM after `timeout' seconds if idle
 send_backoff = 0.25
 recv_backoff = 2
 
+lease_time = 30 # Seconds before an uncommitted task is pushed again
+crash_retries = 2 # Times a task crashing its worker is scheduled again
+speculate_percentile = 0.95 # Latency percentile used by --speculate
+speculate_samples = 20 # Tasks committed before speculating
+
+pull_handlers = 4 # Threads serving the task managers pulling tasks
+pull_drain = 5 # Seconds waiting for the task managers to leave after a job
+push_batch = 64 # Results pushed at a time by a task manager pulling tasks
+push_batch_bytes = 64 * 1024 * 1024 # Bytes pushed at a time
+
+notify_bytes = 16 * 1024 * 1024 # Results queued before notifying the JM again
+notify_sweep = 30 # Seconds before the results of a notifying TM are polled
+
+listen_backlog = 128 # Pending connections queued by the listener
+
 spitz_jm_port = 7726
 spitz_tm_port = 7727
 
 mode_tcp = 'tcp'
 mode_uds = 'uds'
+mode_shm = 'shm' # Unix Domain Sockets with payloads in shared memory
+
+shm_dir = '/dev/shm' # Directory of the shared memory segments
+shm_threshold = 128 * 1024 # Smaller payloads are sent through the socket
+shm_ring = 64 * 1024 * 1024 # Shared memory of each side of a session
+
+spill_dir = None # Directory of the spilled payloads, None for the default
+spill_threshold = 256 * 1024 * 1024 # Larger payloads are spilled to disk
+spill_chunk = 4 * 1024 * 1024 # Bytes received at a time when spilling
+
+pool_limit = 64 * 1024 * 1024 # Idle bytes kept by the buffer pool, 0 to disable
+pool_min = 4 * 1024 # Smallest size class of the buffer pool
+pool_max = 16 * 1024 * 1024 # Larger payloads are not pooled
+
+result_memory_limit = 256 * 1024 * 1024 # Results kept in memory, 0 for no limit
+result_disk_limit = 4 * 1024 * 1024 * 1024 # Results spilled to disk
+result_segment = 64 * 1024 * 1024 # Size of the result spill files
+
+nw_policy_interval = 10 # Seconds between resizes of the worker pool
+overfill_max = 1024 # Largest overfill chosen by --overfill=auto
+
+deadline_percentile = 0.99 # Run time percentile used by --deadline=auto
+deadline_factor = 4.0 # Multiple of the percentile given to each task
+deadline_samples = 32 # Run times observed before the deadline applies
+deadline_min = 5 # Shortest deadline chosen by --deadline=auto
 
 announce_cat_nodes = 'cat'
 announce_file = 'file'
@@ -25,7 +25,7 @@
 from .SocketClosed import SocketClosed
 from .MessagingError import MessagingError
 
-import select, socket
+import errno, select, socket, struct
 
 
 # Messaging codes
@@ -35,31 +35,131 @@ msg_send_task  = 0x0201
 msg_send_more  = 0x0202
 msg_send_full  = 0x0203
 msg_send_rjct  = 0x0204
+msg_send_window = 0x0205
+msg_pull_tasks = 0x0206
 
 msg_read_result = 0x0101
+msg_read_batch = 0x0102
+msg_push_results = 0x0103
+msg_watch_results = 0x0104
+msg_results_ready = 0x0105
 msg_read_empty = 0x0000
 
+msg_set_codec = 0x0300
+msg_set_workers = 0x0301
+msg_query_capacity = 0x0302
+
 msg_terminate = 0xFFFF
 
+# Precompiled message headers
+
+int64_header = struct.Struct('!q')
+task_header = struct.Struct('!qqq') # taskid, runid, size
+result_header = struct.Struct('!qqqq') # taskid, runid, result, size
+ready_header = struct.Struct('!qqq') # message, results ready, bytes
+capacity_header = struct.Struct('!qqd') # workers, free slots, tasks/s
+
+# Headers used when a codec was negotiated for the session
+
+ctask_header = struct.Struct('!qqqB') # taskid, runid, size, codec
+cresult_header = struct.Struct('!qqqqB') # taskid, runid, result, size, codec
+
 # Signal the spitz system through the upper 32
 # bits of the result variable that an error
 # occurred with the function call itself
 res_module_error = 0xFFFFFFFF00000000
 res_module_noans = 0xFFFFFFFE00000000
 res_module_ctxer = 0xFFFFFFFD00000000
+res_module_timeout = 0xFFFFFFFC00000000
+
+def as_result(code):
+    # The result codes above are sent as signed 64 bit values
+    return code - (1 << 64) if code >= (1 << 63) else code
+
+# Tasks pushing more than one result stream them as partial results, the
+# result variable of a partial result holds the attempt that produced it
+# in the lower 32 bits and its sequence number above them. The stream is
+# closed by an end record holding the number of partial results instead
+# of the sequence number, its payload is the return code of the worker
+res_stream = 0x4000000000000000
+res_stream_end = 0x2000000000000000
+
+def stream_result(attempt, seq, end=False):
+    return (res_stream | (res_stream_end if end else 0) |
+        ((seq & 0x1FFFFFFF) << 32) | (attempt & 0xFFFFFFFF))
+
+def parse_stream_result(r):
+    # Return the attempt, sequence number and end flag of a streamed
+    # result, or None for a regular result
+    if r < 0 or not r & res_stream:
+        return None
+    return (r & 0xFFFFFFFF, (r >> 32) & 0x1FFFFFFF, (r & res_stream_end) != 0)
+
+# Maximum number of buffers passed to a single sendmsg call
+_max_iov = 512
+
+# Definition of the send method for sockets, sending a list of buffers
+# with a single system call whenever possible
+def send(conn, buffers):
+    views = []
+    for b in buffers:
+        if b == None or len(b) == 0:
+            continue
+        v = memoryview(b)
+        if v.format != 'B':
+            v = v.cast('B')
+        views.append(v)
+    if not hasattr(conn, 'sendmsg'):
+        for v in views:
+            conn.sendall(v)
+        return
+    while len(views) > 0:
+        n = conn.sendmsg(views[:_max_iov])
+        # Drop the buffers that were completely sent and
+        # keep the rest of a partially sent one
+        i = 0
+        while i < len(views) and n >= len(views[i]):
+            n -= len(views[i])
+            i += 1
+        views = views[i:]
+        if n > 0:
+            views[0] = views[0][n:]
+
+# Non-blocking flag for a single receive call, not available everywhere
+_dontwait = getattr(socket, 'MSG_DONTWAIT', 0)
 
 # Definition of the recv method for sockets, considering
-# a definite size and timeout
-def recv(conn, size, timeout):
-    r = None
-    left = size
-    while left > 0:
-        ready = select.select([conn], [], [], timeout)
-        if not ready[0]:
-            raise socket.timeout()
-        d = conn.recv(left)
-        if len(d) == 0:
+# a definite size and timeout. The data is received directly into
+# buf if it is provided, otherwise a buffer is allocated only once
+def recv(conn, size, timeout, buf=None):
+    if buf == None:
+        if size <= 0:
+            return None
+        buf = bytearray(size)
+    view = memoryview(buf)
+    if view.format != 'B':
+        view = view.cast('B')
+    # Sockets with a timeout wait inside recv anyway, otherwise
+    # only wait when there is no data ready to be read
+    wait = _dontwait == 0 or conn.gettimeout() != None
+    pos = 0
+    while pos < size:
+        if wait:
+            ready = select.select([conn], [], [], timeout)
+            if not ready[0]:
+                raise socket.timeout()
+            n = conn.recv_into(view[pos:size], size - pos)
+        else:
+            try:
+                n = conn.recv_into(view[pos:size], size - pos, _dontwait)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                ready = select.select([conn], [], [], timeout)
+                if not ready[0]:
+                    raise socket.timeout()
+                continue
+        if n == 0:
             raise SocketClosed()
-        r = r + d if r else d
-        left = size - len(r)
-    return r
+        pos += n
+    return buf
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+from libspitz import config
+
+import collections, ctypes, mmap, os, struct, tempfile, uuid, weakref
+
+# Large payloads are copied to a ring of pages shared with the other side,
+# created by the writer with its first large payload. The descriptor sent
+# through the socket holds the name of the ring and the offset of the
+# payload, the reader maps the ring once, removes its name and uses the
+# payloads in place. The first page of each payload has a flag set by the
+# writer and cleared by the reader once the payload is collected, the
+# writer reuses the pages in order as their flags are cleared.
+
+descriptor = struct.Struct('!B32sQ')
+
+inline = 0
+segment = 1
+
+page = mmap.PAGESIZE
+
+def directory():
+    """Get the directory holding the segments, preferably in memory."""
+    if config.shm_dir != None and os.path.isdir(config.shm_dir):
+        return config.shm_dir
+    return tempfile.gettempdir()
+
+def path(name):
+    return os.path.join(directory(), name)
+
+def new_name():
+    return 'spitz-' + uuid.uuid4().hex[:24]
+
+class Ring(object):
+    """Pages shared with a reader, written only by this side. The segment
+       is created with the first payload written, the flags of its pages
+       come first, one byte each."""
+
+    def __init__(self, size, name=None):
+        self.pages = max(size // page, 1)
+        self.first = -(-self.pages // page) # Pages taken by the flags
+        self.name = name if name != None else new_name()
+        self.map = None
+        self.blocks = collections.deque() # (first page, pages) in use
+
+    def create(self):
+        size = (self.first + self.pages) * page
+        fd = os.open(path(self.name), os.O_CREAT | os.O_EXCL | os.O_RDWR,
+            0o600)
+        try:
+            # Allocate the memory now, a full device would otherwise
+            # kill the process when a page is first written
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size, flags=mmap.MAP_SHARED |
+                getattr(mmap, 'MAP_POPULATE', 0))
+        except:
+            unlink(self.name)
+            raise
+        finally:
+            os.close(fd)
+
+    def Write(self, data):
+        """Copy a payload to free pages and return its offset, None if
+           there is no room for it."""
+        view = memoryview(data).cast('B')
+        n = max(-(-len(view) // page), 1)
+        if n > self.pages:
+            return None
+        if self.map == None:
+            self.create()
+        start = self.allocate(n)
+        if start == None:
+            return None
+        offset = (self.first + start) * page
+        self.map[offset:offset + len(view)] = view
+        self.map[self.first + start] = 1
+        self.blocks.append((start, n))
+        return offset
+
+    def allocate(self, n):
+        # Reclaim the pages of the payloads collected by the reader, in
+        # the order they were written
+        while len(self.blocks) > 0 and \
+                self.map[self.first + self.blocks[0][0]] == 0:
+            self.blocks.popleft()
+        if len(self.blocks) == 0:
+            return 0
+        tail = self.blocks[0][0]
+        head = self.blocks[-1][0] + self.blocks[-1][1]
+        if self.blocks[-1][0] < tail:
+            # The pages in use wrap around, the free ones are in between
+            return head if head + n <= tail else None
+        if head + n <= self.pages:
+            return head
+        return 0 if n <= tail else None
+
+    def Close(self):
+        """Unmap the ring, removing it if the reader never mapped it."""
+        unlink(self.name)
+        if self.map != None:
+            self.map.close()
+            self.map = None
+        self.blocks.clear()
+
+def release(mapping, flag):
+    # Give the pages of a collected payload back to the writer
+    try:
+        mapping[flag] = 0
+    except ValueError:
+        pass
+
+class Peer(object):
+    """Rings written by the other side, mapped by name."""
+
+    def __init__(self):
+        self.rings = {}
+
+    def Read(self, name, offset, size):
+        """Get a payload in place, its pages are released when it and the
+           views taken from it are collected."""
+        mapping = self.rings.get(name, None)
+        if mapping == None:
+            mapping = self.rings[name] = self.open(name)
+        data = (ctypes.c_byte * size).from_buffer(mapping, offset)
+        weakref.finalize(data, release, mapping, offset // page)
+        return memoryview(data).cast('B')
+
+    def open(self, name):
+        # The name is removed once mapped, the memory goes away with the
+        # mappings of both sides
+        try:
+            fd = os.open(path(name), os.O_RDWR)
+        finally:
+            unlink(name)
+        try:
+            return mmap.mmap(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+
+    def Close(self):
+        """Forget the rings, they are unmapped once their payloads are
+           collected."""
+        self.rings = {}
+
+def unlink(name):
+    """Remove a segment, ignoring segments already removed."""
+    try:
+        os.unlink(path(name))
+    except OSError:
+        pass
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+from libspitz import config
+
+import ctypes, mmap, tempfile
+
+# Payloads larger than config.spill_threshold are kept in memory mapped
+# temporary files instead of the Python heap. The mapping itself is used
+# as the payload, it supports len() and the buffer protocol, and the file
+# is released when the mapping is collected.
+
+def should_spill(size):
+    """Tell if a payload of the given size must be spilled to disk."""
+    return config.spill_threshold > 0 and size >= config.spill_threshold
+
+def allocate(size):
+    """Allocate a buffer backed by an unlinked temporary file."""
+    with tempfile.TemporaryFile(dir=config.spill_dir) as f:
+        f.truncate(size)
+        return mmap.mmap(f.fileno(), size)
+
+def copy(pointer, size):
+    """Copy native data to a buffer backed by a temporary file."""
+    buf = allocate(size)
+    ctypes.memmove((ctypes.c_byte * size).from_buffer(buf), pointer, size)
+    return buf
+
+def is_spilled(data):
+    """Tell if a payload is backed by a temporary file."""
+    return isinstance(data, mmap.mmap)
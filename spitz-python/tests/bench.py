@@ -0,0 +1,170 @@
+import ctypes
+import os
+import socket
+import sys
+import threading
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+
+from libspitz import ClientEndpoint
+from libspitz import JobBinary
+from libspitz import messaging
+
+class CountingSocket(object):
+    """Socket wrapper counting the calls that end up in the kernel"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def sendall(self, data):
+        self.calls += 1
+        return self.sock.sendall(data)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self.sock.sendmsg(buffers)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+def tcp_pair(nodelay):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    a = socket.create_connection(server.getsockname())
+    b, addr = server.accept()
+    server.close()
+    if nodelay:
+        for s in (a, b):
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return a, b
+
+def responder(conn, n):
+    # Read every task and reply like the task manager does
+    for i in range(n):
+        taskid, runid, size = conn.ReadHeader(messaging.task_header, None)
+        conn.Read(size, None)
+        conn.WriteInt64(messaging.msg_send_more)
+
+def write_fields(e, taskid, task):
+    # Push a task the way push_tasks used to
+    e.WriteInt64(taskid)
+    e.WriteInt64(1)
+    e.WriteInt64(len(task))
+    e.Write(task)
+
+def write_message(e, taskid, task):
+    e.WriteMessage(messaging.task_header, (taskid, 1, len(task)), task)
+
+def bench_push(write, nodelay, n, size):
+    a, b = tcp_pair(nodelay)
+    sock = CountingSocket(a)
+    e = ClientEndpoint('a', 0, sock)
+    t = threading.Thread(target=responder, args=(ClientEndpoint('b', 0, b), n))
+    t.start()
+    task = b'x' * size
+    start = timeit.default_timer()
+    for i in range(n):
+        write(e, i, task)
+        e.ReadInt64(None)
+    elapsed = timeit.default_timer() - start
+    t.join()
+    a.close()
+    b.close()
+    return sock.calls / float(n), elapsed / n * 1e6
+
+def payload_responder(conn, n):
+    # Like responder, reading the payloads through the endpoint
+    for i in range(n):
+        taskid, runid, size = conn.ReadHeader(messaging.task_header, None)
+        conn.ReadPayload(size, None)
+        conn.WriteInt64(messaging.msg_send_more)
+
+def bench_transport(shm, n, size):
+    a, b = socket.socketpair()
+    e = ClientEndpoint('a', 0, a, shm)
+    peer = ClientEndpoint('b', 0, b, shm)
+    t = threading.Thread(target=payload_responder, args=(peer, n + 1))
+    t.start()
+    task = b'x' * size
+    # The ring is created with the first payload of the session
+    write_message(e, 0, task)
+    e.ReadInt64(None)
+    start = timeit.default_timer()
+    for i in range(n):
+        write_message(e, i, task)
+        e.ReadInt64(None)
+    elapsed = timeit.default_timer() - start
+    t.join()
+    e.Close()
+    peer.Close()
+    return elapsed / n * 1e6, size * n / elapsed / (1 << 20)
+
+def legacy_to_c_array(job, it):
+    # Marshal a task the way to_c_array used to
+    cit = (ctypes.c_byte * len(it))()
+    cit[:] = job.unbyte(it)
+    return cit, ctypes.c_longlong(len(it))
+
+def legacy_to_py_array(job, v, sz):
+    # Marshal a result the way to_py_array used to
+    v = ctypes.cast(v, ctypes.POINTER(ctypes.c_byte))
+    return job.bytes(v[0:sz])
+
+def bench_marshal(n, size):
+    job = JobBinary.__new__(JobBinary)
+    task = b'x' * size
+    result = (ctypes.c_byte * size)()
+    times = []
+    for to_c, to_py in ((legacy_to_c_array, legacy_to_py_array),
+            (JobBinary.to_c_array, JobBinary.to_py_array)):
+        start = timeit.default_timer()
+        for i in range(n):
+            to_c(job, task)
+        times.append((timeit.default_timer() - start) / n * 1e3)
+        start = timeit.default_timer()
+        for i in range(n):
+            to_py(job, result, size)
+        times.append((timeit.default_timer() - start) / n * 1e3)
+    return times
+
+def main_marshal():
+    print('%8s %14s %14s %14s %14s' % ('size', 'old c [ms]', 'old py [ms]',
+        'new c [ms]', 'new py [ms]'))
+    for size in (1024 * 1024, 16 * 1024 * 1024):
+        print('%8d %14.3f %14.3f %14.3f %14.3f' % ((size,) +
+            tuple(bench_marshal(3, size))))
+
+def main_push():
+    n = 200
+    print('%-14s %-8s %8s %12s %14s' % ('write', 'nodelay', 'size',
+        'calls/task', 'latency [us]'))
+    for nodelay in (False, True):
+        for size in (64, 64 * 1024):
+            for name, write in (('fields', write_fields),
+                    ('WriteMessage', write_message)):
+                calls, latency = bench_push(write, nodelay, n, size)
+                print('%-14s %-8s %8d %12.1f %14.1f' % (name, nodelay, size,
+                    calls, latency))
+
+def main_transport():
+    n = 50
+    print('%-8s %10s %14s %14s' % ('mode', 'size', 'latency [us]',
+        'rate [MB/s]'))
+    for size in (64 * 1024, 256 * 1024, 1024 * 1024, 16 * 1024 * 1024):
+        for name, shm in (('uds', False), ('shm', True)):
+            latency, rate = bench_transport(shm, n, size)
+            print('%-8s %10d %14.1f %14.1f' % (name, size, latency, rate))
+
+def main():
+    main_push()
+    print('')
+    main_marshal()
+    print('')
+    main_transport()
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,8 @@
+import collections
+import ctypes
+import os
+import socket
+import threading
 import time
 import unittest
 try:
@@ -5,9 +10,23 @@ try:
 except:
     import mock
 
+import jm
 import tm
 import Args
 from libspitz import timeout
+from libspitz import ConnectionPool, ClientEndpoint, SimpleEndpoint
+from libspitz import LeaseHeap, Speculator, ResultWatcher, CapacityTable
+from libspitz import Listener, TaskPool, BufferPool, WorkerProcess
+from libspitz import ResultStore, ResultCache, Watchdog
+from libspitz.ProcessTaskPool import _pack, _unpack
+from libspitz import config
+from libspitz import messaging, codec, shm, spill
+from libspitz import JobBinary
+
+try:
+    import Queue as queue # Python 2
+except:
+    import queue # Python 3
 
 class TestArgs(unittest.TestCase):
     def test_args(self):
@@ -22,6 +41,422 @@ class TestTM(unittest.TestCase):
         tm.parse_global_config(args.args)
         self.assertEqual(tm.tm_timeout, 10)
 
+class TestJM(unittest.TestCase):
+    def test_parse_global_config(self):
+        args = Args.Args(['--speculate=1.5', '--lease=0.5',
+            '--tmtimeout=0.5'])
+        jm.parse_global_config(args.args)
+        self.assertEqual(jm.jm_speculate, 1.5)
+        self.assertEqual(jm.jm_lease_time, 0.5)
+        self.assertEqual(jm.jm_tm_timeout, 0.5)
+        self.assertEqual(jm.jm_max_copies, 2)
+
+class TestOverfillTuner(unittest.TestCase):
+    def test_refill(self):
+        pool = TaskPool(2, 0, None, None, ())
+        meter = tm.TaskMeter(1.0)
+        tuner = tm.OverfillTuner(pool, meter, 100, 1.0)
+        meter.Task(0.3, 3)
+        tuner.Refill()
+        self.assertEqual(pool.Overfill(), 0)
+        tuner.last -= 1.0
+        tuner.Refill()
+        # Two workers run 20 tasks between refills a second apart
+        self.assertTrue(20 <= pool.Overfill() <= 21)
+        self.assertEqual(pool.Free(), 2 + pool.Overfill())
+        meter.Task(0.0001)
+        tuner.last -= 1.0
+        tuner.Refill()
+        self.assertEqual(pool.Overfill(), 100)
+
+class TestResultStream(unittest.TestCase):
+    def setUp(self):
+        tm.parse_global_config({})
+        self.cqueue = queue.Queue()
+
+    def results(self):
+        items = []
+        while not self.cqueue.empty():
+            items.append(self.cqueue.get())
+        return items
+
+    def test_single(self):
+        stream = tm.ResultStream(5, 1, self.cqueue)
+        stream.Push(b'a', 5)
+        self.assertTrue(self.cqueue.empty())
+        stream.End(0)
+        self.assertEqual(self.results(), [(5, 1, 0, b'a', codec.codec_none)])
+
+    def test_stream(self):
+        stream = tm.ResultStream(5, 1, self.cqueue)
+        stream.Push(b'a', 5)
+        stream.Push(b'b', 5)
+        # Both results are queued as soon as the second one is pushed
+        items = self.results()
+        self.assertEqual([x[3] for x in items], [b'a', b'b'])
+        attempt, seq, end = messaging.parse_stream_result(items[1][2])
+        self.assertEqual((seq, end), (1, False))
+        stream.End(3)
+        end = self.results()[0]
+        self.assertEqual(messaging.parse_stream_result(end[2]),
+            (attempt, 2, True))
+        self.assertEqual(messaging.int64_header.unpack(end[3])[0], 3)
+
+    def test_expired(self):
+        stream = tm.ResultStream(5, 1, self.cqueue)
+        stream.Push(b'a', 5)
+        stream.Push(b'b', 5)
+        self.results()
+        # The partial results pushed after the timeout are not sent
+        stream.Expire()
+        stream.Push(b'c', 5)
+        stream.Drop()
+        self.assertEqual(self.results(), [])
+
+    def test_crashed(self):
+        # A crashed worker process reports the task as failed
+        stream = tm.ResultStream(5, 1, self.cqueue)
+        stream.End(WorkerProcess.crashed)
+        self.assertEqual(self.results(), [(5, 1, WorkerProcess.crashed, b'',
+            codec.codec_none)])
+        # The failure code can be sent in a result header
+        messaging.result_header.pack(5, 1, WorkerProcess.crashed, 0)
+
+    def test_cache(self):
+        tm.tm_cache = ResultCache(1024)
+        try:
+            key = tm.cache_key(1, b'task')
+            stream = tm.ResultStream(5, 1, self.cqueue, key)
+            stream.Push(b'a', 5)
+            stream.End(0)
+            self.results()
+            # A duplicate is answered without reaching the pool
+            pool = TaskPool(1, 0, None, None, ())
+            self.assertTrue(tm.accept_task(pool, self.cqueue, 6, 1, b'task'))
+            self.assertTrue(pool.Empty())
+            self.assertEqual(self.results(), [(6, 1, 0, b'a',
+                codec.codec_none)])
+            self.assertTrue(tm.accept_task(pool, self.cqueue, 7, 2, b'task'))
+            self.assertFalse(pool.Empty())
+        finally:
+            tm.tm_cache = None
+
+    def test_cache_full(self):
+        tm.tm_cache = ResultCache(1024)
+        try:
+            tm.tm_cache.Put(tm.cache_key(1, b'task'), 0, b'abcd')
+            store = ResultStore(4, 0, 16)
+            store.put((1, 1, 0, b'efgh', 0))
+            pool = TaskPool(1, 0, None, None, ())
+            t = threading.Thread(target=tm.accept_task,
+                args=(pool, store, 6, 1, b'task'))
+            t.daemon = True
+            t.start()
+            t.join(5)
+            # A cache hit does not wait for room in a full store
+            self.assertFalse(t.is_alive())
+            self.assertEqual(store.qsize(), 2)
+        finally:
+            tm.tm_cache = None
+
+class TestCommitResults(unittest.TestCase):
+    class Job(object):
+        def __init__(self):
+            self.pits = []
+
+        def spits_committer_commit_pits(self, co, results):
+            self.pits.extend(results)
+            return [0] * len(results)
+
+    def setUp(self):
+        jm.parse_global_config({})
+        self.job = self.Job()
+        self.tasklist = {1: (0, b't'), 2: (0, b't')}
+        self.completed = {0: 0}
+        self.streams = {}
+
+    def commit(self, results):
+        return jm.commit_results(self.job, 1, None, results, self.tasklist,
+            self.completed, self.streams)
+
+    def test_stream(self):
+        def partial(attempt, seq, res):
+            return (2, 1, messaging.stream_result(attempt, seq), res,
+                codec.codec_none)
+        end = (2, 1, messaging.stream_result(7, 2, True),
+            messaging.int64_header.pack(0), codec.codec_none)
+        # The end record arrives before one of the partial results and
+        # another attempt of the same task is streaming
+        self.commit([partial(7, 1, b'b'), (1, 1, 0, b'x', codec.codec_none),
+            end, partial(8, 0, b'z')])
+        self.assertEqual(self.job.pits, [b'x'])
+        self.assertNotIn(2, self.completed)
+        self.commit([partial(7, 0, b'a')])
+        self.assertEqual(self.job.pits, [b'x', b'a', b'b'])
+        self.assertEqual(self.completed[2], (0, 0))
+        self.assertEqual(self.streams, {})
+        # Late results of the other attempt are not committed
+        self.commit([partial(8, 1, b'y')])
+        self.assertEqual(self.job.pits, [b'x', b'a', b'b'])
+
+    def test_crashed(self):
+        retry = collections.deque()
+        crashed = (1, 1, messaging.as_result(messaging.res_module_error), b'',
+            codec.codec_none)
+        # The task is scheduled again until it crashed too many times
+        for i in range(config.crash_retries):
+            jm.commit_results(self.job, 1, None, [crashed], self.tasklist,
+                self.completed, self.streams, retry)
+            self.assertEqual(list(retry), [1] * (i + 1))
+            self.assertNotIn(1, self.completed)
+        jm.commit_results(self.job, 1, None, [crashed], self.tasklist,
+            self.completed, self.streams, retry)
+        self.assertEqual(len(retry), config.crash_retries)
+        self.assertEqual(self.completed[1], (crashed[2], None))
+        self.assertNotIn(1, self.tasklist)
+        self.assertEqual(self.job.pits, [])
+
+class TestTMBatch(unittest.TestCase):
+    def setUp(self):
+        tm.parse_global_config({'timeout': '0'})
+        a, b = socket.socketpair()
+        self.jm = ClientEndpoint('jm', 0, a)
+        self.cqueue = queue.Queue()
+        for i in range(3):
+            self.cqueue.put((i + 1, 1, 0, b'result', codec.codec_none))
+        self.thread = threading.Thread(target=tm.server_callback,
+            args=(ClientEndpoint('tm', 0, b), 'tm', 0, None, None,
+                self.cqueue, timeout(None, None)))
+        self.thread.start()
+        self.assertEqual(self.jm.ReadString(1), '')
+        self.jm.WriteString('')
+
+    def read_batch(self, maxcount):
+        self.jm.WriteInt64(messaging.msg_read_batch)
+        self.jm.WriteInt64(maxcount)
+        self.jm.WriteInt64(1024)
+        batch = []
+        for i in range(self.jm.ReadInt64(1)):
+            taskid, runid, r, sz = [self.jm.ReadInt64(1) for j in range(4)]
+            batch.append((taskid, self.jm.Read(sz, 1)))
+        return batch
+
+    def test_ack(self):
+        batch = self.read_batch(2)
+        self.assertEqual([x[0] for x in batch], [1, 2])
+        self.jm.WriteInt64Array([1])
+        self.assertEqual(len(self.read_batch(10)), 2)
+        self.jm.Close()
+        self.thread.join()
+
+    def test_put_back(self):
+        self.assertEqual(len(self.read_batch(10)), 3)
+        self.jm.Close()
+        self.thread.join()
+        self.assertEqual(self.cqueue.qsize(), 3)
+
+    def test_codec(self):
+        data = b'result' * 1000
+        self.jm.WriteInt64(messaging.msg_set_codec)
+        self.jm.WriteString('bogus, zlib')
+        self.jm.WriteInt64(16)
+        self.assertEqual(self.jm.ReadString(1), 'zlib')
+        c, res = codec.encode(codec.codec_zlib, data, 16)
+        self.cqueue.put((4, 1, 0, res, c))
+        self.jm.WriteInt64(messaging.msg_read_batch)
+        self.jm.WriteInt64(10)
+        self.jm.WriteInt64(1 << 20)
+        results = []
+        for i in range(self.jm.ReadInt64(1)):
+            taskid, runid, r, sz, c = self.jm.ReadHeader(
+                messaging.cresult_header, 1)
+            results.append((c, self.jm.Read(sz, 1)))
+        self.jm.WriteInt64Array([])
+        self.assertEqual(results[0], (codec.codec_none, b'result'))
+        self.assertEqual(results[3][0], codec.codec_zlib)
+        self.assertEqual(codec.decode(*results[3]), data)
+        self.jm.Close()
+        self.thread.join()
+
+class TestPull(unittest.TestCase):
+    def setUp(self):
+        jm.parse_global_config({})
+        tm.parse_global_config({'timeout': '0'})
+        a, b = socket.socketpair()
+        self.jm = ClientEndpoint('jm', 0, a)
+        self.tm = ClientEndpoint('tm', 0, b)
+        self.hub = jm.make_pull_hub()
+        self.committed = []
+        jm.pull_register(self.hub, 'results', self.committed.extend)
+        self.cqueue = queue.Queue()
+        self.pool = TaskPool(1, 0, None, None, ())
+
+    def tearDown(self):
+        self.jm.Close()
+        self.tm.Close()
+
+    def exchange(self, requests):
+        # Serve the requests of the task manager from another thread
+        served = []
+        thread = threading.Thread(target=lambda: served.extend(
+            jm.pull_request(self.jm, 'tm', 1, self.hub)
+            for i in range(requests)))
+        thread.start()
+        n = tm.pull_exchange(self.tm, 'jm', 0, self.pool, self.cqueue,
+            timeout(None, None))
+        thread.join()
+        self.assertEqual(served, [True] * requests)
+        return n
+
+    def test_exchange(self):
+        asked = []
+        def serve(e, name, count):
+            asked.append(count)
+            e.WriteInt64(2)
+            for taskid in (7, 8):
+                jm.write_task(e, taskid, 1, b'task')
+            asked.append(e.ReadInt64Array(1))
+        jm.pull_register(self.hub, 'tasks', serve)
+        self.cqueue.put((1, 1, 0, b'result', codec.codec_none))
+        self.assertEqual(self.exchange(2), 3)
+        self.assertEqual(self.committed, [(1, 1, 0, b'result',
+            codec.codec_none)])
+        self.assertTrue(self.cqueue.empty())
+        # The pool only had room for the task that was asked
+        self.assertEqual(asked, [1, [8]])
+        self.assertTrue(self.pool.Full())
+
+    def test_idle(self):
+        # Nothing is pulled between runs
+        self.assertEqual(self.exchange(1), 0)
+        self.assertTrue(self.pool.Empty())
+
+    def test_finished(self):
+        jm.pull_drain(self.hub)
+        self.assertEqual(self.exchange(1), None)
+
+class TestResultNotifier(unittest.TestCase):
+    def test_notify(self):
+        a, b = socket.socketpair()
+        cqueue = queue.Queue()
+        notifier = tm.ResultNotifier(cqueue)
+        notifier.Subscribe(ClientEndpoint('jm', 0, b), 1024)
+        watcher = ResultWatcher(lambda name, e: ClientEndpoint('tm', 0, a),
+            0.1)
+        watcher.Update({'tm': None})
+        watcher.start()
+        try:
+            self.assertFalse(watcher.Take('tm'))
+            # Only the first result is notified until the queue is drained
+            for i in range(2):
+                cqueue.put(i)
+                notifier.Queued(10)
+            self.assertTrue(watcher.Wait(1))
+            self.assertTrue(watcher.Take('tm'))
+            self.assertFalse(watcher.Wait(0.2))
+            self.assertFalse(watcher.Take('tm'))
+            # Unless enough bytes were queued
+            notifier.Queued(1024)
+            self.assertTrue(watcher.Wait(1))
+            self.assertTrue(watcher.Take('tm'))
+            # Results left in the queue are notified again
+            cqueue.get()
+            notifier.Drained()
+            self.assertTrue(watcher.Wait(1))
+            self.assertTrue(watcher.Take('tm'))
+            # The task managers not watched are always polled
+            watcher.Update({})
+            self.assertTrue(watcher.Take('tm'))
+        finally:
+            watcher.Stop()
+            b.close()
+
+class TestAsyncScheduler(unittest.TestCase):
+    def test_slow_tm(self):
+        from libspitz.AsyncScheduler import AsyncScheduler
+        a, b = socket.socketpair()
+        slow = ClientEndpoint('slow', 0, a)
+        sched = AsyncScheduler(2, 0.5)
+        served = []
+        aborted = []
+        def exchange(name, e):
+            if name == 'slow':
+                # Blocks until the exchange is aborted
+                self.assertRaises(messaging.SocketClosed, e.Read, 8, None)
+                aborted.append(name)
+            else:
+                served.append(sched.Native(threading.current_thread))
+        def abort(name, e):
+            e.Shutdown()
+        sched.Run(lambda tms: {'slow': slow, 'fast': None}, exchange,
+            lambda: len(served) >= 3, 0.01, abort)
+        sched.Shutdown()
+        b.close()
+        self.assertEqual(aborted, ['slow'])
+        self.assertEqual(len(set(served)), 1)
+        self.assertIsNot(served[0], threading.current_thread())
+
+class TestListener(unittest.TestCase):
+    def test_handlers(self):
+        def accept(conn, addr, port, tag):
+            conn.WriteString(tag)
+            return True
+        def request(conn, addr, port, tag):
+            value = conn.ReadInt64(1)
+            conn.WriteInt64(value + 1)
+            return value >= 0
+        listener = Listener(config.mode_tcp, '127.0.0.1', 0, request,
+            ('hello', ), 4, 2, accept)
+        listener.Start()
+        try:
+            clients = [SimpleEndpoint('127.0.0.1', listener.port)
+                for i in range(5)]
+            for c in clients:
+                c.Open(1)
+                self.assertEqual(c.ReadString(1), 'hello')
+            # Sessions are kept between requests
+            for i in range(3):
+                for c in clients:
+                    c.WriteInt64(i)
+                for c in clients:
+                    self.assertEqual(c.ReadInt64(1), i + 1)
+            # Dropped sessions are closed
+            clients[0].WriteInt64(-1)
+            self.assertEqual(clients[0].ReadInt64(1), 0)
+            self.assertRaises(messaging.SocketClosed, clients[0].Read, 1, 1)
+            for c in clients:
+                c.Close()
+            self.assertGreaterEqual(listener.stats['events'], 21)
+        finally:
+            listener.Stop()
+            listener.Join()
+
+class TestCodec(unittest.TestCase):
+    def test_roundtrip(self):
+        data = b'abc' * 1000
+        for name in codec.available():
+            c, payload = codec.encode(codec.by_name(name), data, 0)
+            self.assertEqual(c, codec.by_name(name))
+            self.assertLess(len(payload), len(data))
+            self.assertEqual(codec.decode(c, payload), data)
+
+    def test_threshold(self):
+        data = b'abc' * 1000
+        self.assertEqual(codec.encode(codec.codec_zlib, data, len(data) + 1),
+            (codec.codec_none, data))
+        self.assertEqual(codec.encode(codec.codec_zlib, None, 0),
+            (codec.codec_none, None))
+
+    def test_incompressible(self):
+        data = bytes(bytearray(range(7)))
+        self.assertEqual(codec.encode(codec.codec_zlib, data, 0),
+            (codec.codec_none, data))
+
+    def test_choose(self):
+        self.assertEqual(codec.choose('foo,zlib'), codec.codec_zlib)
+        self.assertEqual(codec.choose('foo'), codec.codec_none)
+        self.assertEqual(codec.choose(''), codec.codec_none)
+
 
 class TestTimeout(unittest.TestCase):
     def setUp(self):
@@ -51,5 +486,664 @@ class TestTimeout(unittest.TestCase):
         time.sleep(0.5)
         self.assertEqual(self.x['foo'], 0)
 
+class FakeEndpoint(object):
+    def __init__(self, address='localhost', port=1):
+        self.address = address
+        self.port = port
+        self.opened = 0
+        self.alive = False
+
+    def Open(self, timeout):
+        self.opened += 1
+        self.alive = True
+
+    def Alive(self):
+        return self.alive
+
+    def Close(self):
+        self.alive = False
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.handshakes = 0
+        def handshake(name, e):
+            self.handshakes += 1
+            return True
+        self.handshake = handshake
+
+    def test_reuse(self):
+        pool = ConnectionPool(self.handshake)
+        e = pool.Get('tm', FakeEndpoint(), None)
+        pool.Release('tm')
+        self.assertIs(pool.Get('tm', FakeEndpoint(), None), e)
+        self.assertEqual(self.handshakes, 1)
+
+    def test_reconnect(self):
+        pool = ConnectionPool(self.handshake)
+        e = pool.Get('tm', FakeEndpoint(), None)
+        e.Close()
+        pool.Release('tm')
+        self.assertNotIn('tm', pool.sessions)
+        f = FakeEndpoint()
+        self.assertIs(pool.Get('tm', f, None), f)
+        self.assertEqual(self.handshakes, 2)
+
+    def test_not_persistent(self):
+        pool = ConnectionPool(self.handshake, False)
+        e = pool.Get('tm', FakeEndpoint(), None)
+        pool.Release('tm')
+        self.assertFalse(e.Alive())
+
+    def test_prune(self):
+        pool = ConnectionPool(self.handshake)
+        pool.Get('a', FakeEndpoint(), None)
+        b = pool.Get('b', FakeEndpoint(), None)
+        pool.Prune({'a': None})
+        self.assertEqual(list(pool.sessions), ['a'])
+        self.assertFalse(b.Alive())
+
+class TestLeaseHeap(unittest.TestCase):
+    def test_expired(self):
+        leases = LeaseHeap(10)
+        leases.Grant(1, b'a', 'tm1', 0)
+        leases.Grant(2, b'b', 'tm1', 5)
+        leases.Grant(3, b'c', 'tm2', 6)
+        pending = {1: (0, b'a'), 2: (0, b'b')}
+        self.assertEqual(leases.Expired(pending, 9), None)
+        # Only the tasks with an expired lease are pushed again
+        self.assertEqual(leases.Expired(pending, 15), (1, b'a'))
+        self.assertEqual(leases.Expired(pending, 15), (2, b'b'))
+        self.assertEqual(leases.Copies(2), 0)
+        # Committed tasks are dropped
+        self.assertEqual(leases.Expired(pending, 20), None)
+        self.assertEqual(len(leases), 2)
+
+    def test_copies(self):
+        leases = LeaseHeap(10, 2)
+        leases.Grant(1, b'a', 'tm1', 0)
+        leases.Grant(1, b'a', 'tm2', 1)
+        leases.Grant(1, b'a', 'tm3', 2)
+        self.assertEqual(leases.Copies(1), 3)
+        # The task is pushed again once less than two copies are left
+        self.assertEqual(leases.Expired({1: None}, 10), None)
+        self.assertEqual(leases.Expired({1: None}, 11), (1, b'a'))
+        # A renewed lease replaces the old one
+        leases.Grant(1, b'a', 'tm3', 5)
+        self.assertEqual(leases.Expired({1: None}, 14), None)
+        leases.Release(1)
+        self.assertEqual(leases.Expired({1: None}, 20), None)
+
+class TestSpeculator(unittest.TestCase):
+    def test_straggler(self):
+        spec = Speculator(2.0, 0.5, 2)
+        leases = LeaseHeap(100, 2)
+        pending = {}
+        for taskid in range(1, 5):
+            pending[taskid] = (0, b'%d' % taskid)
+            leases.Grant(taskid, pending[taskid][1], 'tm1', 0)
+            spec.Dispatch(taskid, 0)
+        self.assertEqual(spec.Straggler(pending, leases, 'tm2', 10), None)
+        for taskid in (1, 2):
+            del pending[taskid]
+            spec.Commit(taskid, taskid)
+        # Late by twice the median latency of 2 seconds
+        self.assertEqual(spec.Threshold(), 4.0)
+        self.assertEqual(spec.Straggler(pending, leases, 'tm2', 3), None)
+        self.assertEqual(spec.Straggler(pending, leases, 'tm1', 5), None)
+        self.assertEqual(spec.Straggler(pending, leases, 'tm2', 5),
+            (3, b'3'))
+        leases.Grant(3, b'3', 'tm2', 5)
+        self.assertEqual(spec.Straggler(pending, leases, 'tm3', 5),
+            (4, b'4'))
+        # Task 3 has the maximum number of copies
+        self.assertEqual(spec.Straggler(pending, leases, 'tm3', 6), None)
+        del pending[3]
+        spec.Commit(3, 7)
+        self.assertEqual(spec.stats['copies'], 2)
+        self.assertEqual(spec.stats['finished'], 1)
+
+    def test_late_dispatch(self):
+        spec = Speculator(2.0, 0.5, 1)
+        completed = {0: 0, 1: (0, 0)}
+        # The task was committed before its push was recorded
+        spec.Commit(1, 1)
+        spec.Dispatch(1, 0, completed)
+        self.assertEqual(len(spec.dispatched), 0)
+        spec.Dispatch(2, 0, completed)
+        self.assertEqual(list(spec.dispatched), [2])
+
+class TestCapacityTable(unittest.TestCase):
+    def test_order(self):
+        table = CapacityTable()
+        table.Update('slow', 16, 16, 10.0)
+        table.Update('fast', 128, 128, 100.0)
+        # The task managers not measured come first
+        self.assertEqual(table.Order(['slow', 'new', 'fast']),
+            ['new', 'fast', 'slow'])
+        table.Prune(['fast'])
+        self.assertEqual(table.Get('slow'), None)
+
+    def test_quota(self):
+        table = CapacityTable()
+        self.assertEqual(table.Quota('tm'), None)
+        table.Update('tm', 4, 8, 10.0)
+        table.Visit('tm', 0)
+        self.assertEqual(table.Quota('tm'), None)
+        # The tasks run until the next visit
+        table.Visit('tm', 2)
+        self.assertEqual(table.Quota('tm'), 20)
+        # But never less than the workers
+        table.Update('tm', 4, 8, 1.0)
+        self.assertEqual(table.Quota('tm'), 4)
+
+    def test_query(self):
+        jm.parse_global_config({'weighted': '1'})
+        try:
+            a, b = socket.socketpair()
+            meter = tm.TaskMeter()
+            meter.Task(0.5, 2)
+            with mock.patch.object(tm, 'tm_meter', meter):
+                pool = TaskPool(2, 2, None, None, ())
+                b.sendall(messaging.int64_header.pack(
+                    messaging.msg_query_capacity))
+                self.assertTrue(tm.server_request(ClientEndpoint('jm', 0,
+                    a), 'jm', 0, None, pool, None, timeout(None, None)))
+            jm.query_capacity(ClientEndpoint('tm', 0, b), 'tm')
+            self.assertEqual(jm.jm_capacity.Get('tm'), (2, 4, 8.0))
+            a.close()
+            b.close()
+        finally:
+            jm.parse_global_config({})
+
+    def test_handshake(self):
+        jm.parse_global_config({'weighted': '1'})
+        try:
+            a, b = socket.socketpair()
+            a.sendall(messaging.capacity_header.pack(4, 6, 10.0))
+            with mock.patch.object(jm, 'check_jobid', lambda e: True):
+                self.assertTrue(jm.setup_session('tm1',
+                    ClientEndpoint('127.0.0.1', 7727, b)))
+            # The capacity is kept under the name in the list of TMs
+            self.assertEqual(jm.jm_capacity.Get('tm1'), (4, 6, 10.0))
+            self.assertEqual(ClientEndpoint('tm', 0, a).ReadInt64(1),
+                messaging.msg_query_capacity)
+            a.close()
+            b.close()
+        finally:
+            jm.parse_global_config({})
+
+class TestEndpoint(unittest.TestCase):
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.a = ClientEndpoint('a', 0, a)
+        self.b = ClientEndpoint('b', 0, b)
+
+    def tearDown(self):
+        self.a.Close()
+        self.b.Close()
+
+    def test_read_large(self):
+        data = bytes(bytearray(range(256))) * 4096
+        t = threading.Thread(target=self.a.Write, args=(data,))
+        t.start()
+        r = self.b.Read(len(data), 5)
+        t.join()
+        self.assertEqual(r, data)
+
+    def test_read_into(self):
+        buf = bytearray(8)
+        self.a.Write(b'abcd')
+        self.assertIs(self.b.Read(4, 1, buf), buf)
+        self.assertEqual(buf, b'abcd\0\0\0\0')
+        self.b.socket.settimeout(1)
+        cbuf = (ctypes.c_byte * 4)()
+        self.a.Write(b'\xff\x01\x02\x03')
+        self.b.Read(4, 1, cbuf)
+        self.assertEqual(list(cbuf), [-1, 1, 2, 3])
+
+    def test_read_empty(self):
+        self.assertIsNone(self.b.Read(0, 1))
+
+    def test_read_timeout(self):
+        self.assertRaises(socket.timeout, self.b.Read, 1, 0.1)
+
+    def test_read_closed(self):
+        self.a.Close()
+        self.assertRaises(messaging.SocketClosed, self.b.Read, 1, 1)
+
+    def test_write_message(self):
+        header = messaging.task_header
+        self.a.WriteMessage(header, (1, 2, 3), b'abc')
+        self.a.WriteMessage(header, (4, 5, 0), None)
+        self.assertEqual(self.b.ReadHeader(header, 1), (1, 2, 3))
+        self.assertEqual(self.b.Read(3, 1), b'abc')
+        self.assertEqual(self.b.ReadHeader(header, 1), (4, 5, 0))
+
+    def test_send_partial(self):
+        class Sock(object):
+            data = b''
+            def sendmsg(self, buffers):
+                # Send at most 3 bytes at a time
+                sent = b''.join(bytes(b) for b in buffers)[:3]
+                self.data += sent
+                return len(sent)
+        sock = Sock()
+        messaging.send(sock, [b'abcd', None, b'', bytearray(b'efgh')])
+        self.assertEqual(sock.data, b'abcdefgh')
+
+    def test_int64_array(self):
+        self.a.WriteInt64Array([1, -2, 3])
+        self.a.WriteInt64Array([])
+        self.assertEqual(self.b.ReadInt64Array(1), [1, -2, 3])
+        self.assertEqual(self.b.ReadInt64Array(1), [])
+
+
+class TestShmEndpoint(unittest.TestCase):
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.a = ClientEndpoint('a', 0, a, True)
+        self.b = ClientEndpoint('b', 0, b, True)
+
+    def tearDown(self):
+        self.a.Close()
+        self.b.Close()
+
+    def test_payloads(self):
+        header = messaging.task_header
+        large = b'x' * config.shm_threshold
+        self.a.WriteMessage(header, (1, 2, len(large)), large)
+        self.a.WriteMessage(header, (3, 4, 3), b'abc')
+        name = self.a.ring.name
+        self.assertTrue(os.path.exists(shm.path(name)))
+        self.assertEqual(self.b.ReadHeader(header, 1), (1, 2, len(large)))
+        res = self.b.ReadPayload(len(large), 1)
+        # The reader uses the payload in place and removes the name
+        self.assertEqual(res, large)
+        self.assertFalse(os.path.exists(shm.path(name)))
+        self.assertEqual(self.b.ReadHeader(header, 1), (3, 4, 3))
+        self.assertEqual(self.b.ReadPayload(3, 1), b'abc')
+        # The pages of a collected payload are reused
+        offset = self.a.ring.blocks[0][0]
+        del res
+        self.a.WriteMessage(header, (5, 6, len(large)), large)
+        self.assertEqual(list(self.a.ring.blocks), [(offset,
+            len(large) // shm.page)])
+
+    def test_full(self):
+        ring = config.shm_ring
+        config.shm_ring = config.shm_threshold
+        try:
+            header = messaging.task_header
+            large = b'x' * config.shm_threshold
+            self.a.WriteMessage(header, (1, 2, len(large)), large)
+            self.a.WriteMessage(header, (3, 4, len(large)), large)
+            self.b.ReadHeader(header, 1)
+            first = self.b.ReadPayload(len(large), 1)
+            # The second payload did not fit and follows the descriptor
+            self.b.ReadHeader(header, 1)
+            second = self.b.ReadPayload(len(large), 1)
+            self.assertIsInstance(second, bytearray)
+            self.assertEqual(first, second)
+        finally:
+            config.shm_ring = ring
+
+    def test_close(self):
+        large = b'x' * config.shm_threshold
+        self.a.WriteMessage(messaging.task_header, (1, 2, len(large)), large)
+        name = self.a.ring.name
+        self.a.Close()
+        self.assertFalse(os.path.exists(shm.path(name)))
+
+    def test_unread(self):
+        # The reader dies without mapping the ring
+        large = b'x' * config.shm_threshold
+        self.a.WriteMessage(messaging.task_header, (1, 2, len(large)), large)
+        name = self.a.ring.name
+        self.b.Close()
+        with self.assertRaises((messaging.SocketClosed, socket.error)):
+            self.a.ReadInt64(1)
+        self.assertTrue(os.path.exists(shm.path(name)))
+        self.a.Close()
+        self.assertFalse(os.path.exists(shm.path(name)))
+
+class TestRing(unittest.TestCase):
+    def test_wrap(self):
+        ring = shm.Ring(4 * shm.page)
+        peer = shm.Peer()
+        try:
+            page = b'x' * shm.page
+            offsets = [ring.Write(page * 2), ring.Write(page)]
+            held = [peer.Read(ring.name, x, shm.page) for x in offsets]
+            self.assertEqual(ring.Write(page * 2), None)
+            # The first payload is collected, the next one wraps around
+            view = held[1][1:]
+            del held[:]
+            self.assertEqual(ring.Write(page * 2), offsets[0])
+            self.assertEqual(ring.Write(page), None)
+            # The views taken from a payload keep its pages
+            del view
+            self.assertEqual(ring.Write(page), offsets[1])
+        finally:
+            ring.Close()
+            peer.Close()
+
+class TestSpill(unittest.TestCase):
+    def setUp(self):
+        self.threshold = config.spill_threshold
+        self.chunk = config.spill_chunk
+        config.spill_threshold = 1000
+        config.spill_chunk = 300
+
+    def tearDown(self):
+        config.spill_threshold = self.threshold
+        config.spill_chunk = self.chunk
+
+    def test_read_payload(self):
+        a, b = socket.socketpair()
+        a, b = ClientEndpoint('a', 0, a), ClientEndpoint('b', 0, b)
+        data = bytes(bytearray(range(256))) * 10
+        a.Write(b'abc' + data)
+        self.assertEqual(b.ReadPayload(3, 1), b'abc')
+        res = b.ReadPayload(len(data), 1)
+        self.assertTrue(spill.is_spilled(res))
+        self.assertEqual(res[:], data)
+        a.Close()
+        b.Close()
+
+    def test_native(self):
+        job = JobBinary.__new__(JobBinary)
+        data = (ctypes.c_byte * 2000)(*range(-100, 100))
+        res = job.to_spilled_array(data, 2000)
+        self.assertTrue(spill.is_spilled(res))
+        self.assertEqual(res[:], bytes(bytearray(data)))
+        self.assertEqual(job.to_spilled_array(data, 10), bytes(data)[:10])
+        # Spilled payloads are passed without copies
+        cres, cressz = job.to_c_array(res)
+        self.assertEqual(cressz.value, 2000)
+        res[0] = 7
+        self.assertEqual(cres[0], 7)
+
+class TestJobBinary(unittest.TestCase):
+    def test_to_c_array(self):
+        job = JobBinary.__new__(JobBinary)
+        data = bytes(bytearray(range(256)))
+        ctask, ctasksz = job.to_c_array(data)
+        self.assertTrue(ctask is data)
+        self.assertEqual(ctasksz.value, 256)
+        # Writable buffers are shared with native code
+        data = bytearray(range(256))
+        ctask, ctasksz = job.to_c_array(data)
+        data[0] = 7
+        self.assertEqual(ctask[0], 7)
+        self.assertEqual(ctasksz.value, 256)
+        ctask, ctasksz = job.to_c_array(memoryview(bytes(data)))
+        self.assertEqual(bytes(bytearray(ctask)), bytes(data))
+        self.assertEqual(job.to_c_array(b'')[1], 0)
+
+    def test_to_py_array(self):
+        job = JobBinary.__new__(JobBinary)
+        data = (ctypes.c_byte * 256)(*range(-128, 128))
+        self.assertEqual(job.to_py_array(data, 256), bytes(bytearray(data)))
+        self.assertEqual(job.to_py_array(None, 0), b'')
+
+    def test_batch_fallback(self):
+        # A module exporting only the single task methods
+        class Module(object):
+            def spits_job_manager_next_task(self, user_data, push, ctx):
+                if user_data[0] == 3:
+                    return 0
+                user_data[0] += 1
+                task = b'task%d' % user_data[0]
+                push(task, len(task), ctx)
+                return 1
+
+            def spits_committer_commit_pit(self, user_data, result, size):
+                return 0 if result == b'ok' else 1
+
+        class State(object):
+            def __init__(self):
+                self.value = [0]
+
+            def get_value(self):
+                return self.value
+
+        job = JobBinary.__new__(JobBinary)
+        job.module = Module()
+        job.cpusher = lambda push: (lambda p, sz, ctx: push(p, sz, ctx))
+        state = State()
+        res = job.spits_job_manager_next_tasks(state, 2, 10)
+        self.assertEqual([(r, task[0], ctx) for r, task, ctx in res],
+            [(1, b'task1', 10), (1, b'task2', 11)])
+        res = job.spits_job_manager_next_tasks(state, 2, 12)
+        self.assertEqual([r for r, task, ctx in res], [1, 0])
+        self.assertEqual(job.spits_committer_commit_pits(state,
+            [b'ok', b'bad']), [0, 1])
+
+class TestBufferPool(unittest.TestCase):
+    def test_reuse(self):
+        pool = BufferPool(1 << 20, 1024, 1 << 16)
+        buf = pool.Get(1000)
+        self.assertEqual(len(buf), 1000)
+        buf[:3] = b'abc'
+        pool.Release(buf)
+        self.assertEqual(pool.Idle(), 1024)
+        # The same size class serves the next request
+        again = pool.Get(600)
+        self.assertTrue(again.obj is buf.obj)
+        self.assertEqual(pool.Idle(), 0)
+        self.assertEqual(pool.Get(5000).obj._blob.get_size(), 8192)
+        self.assertEqual(pool.Get(1 << 17), None)
+        self.assertEqual(pool.Get(0), None)
+        # Buffers not taken from the pool are ignored
+        pool.Release(b'abc')
+        pool.Release(memoryview(bytearray(10)))
+        self.assertEqual(pool.Idle(), 0)
+
+    def test_evict(self):
+        pool = BufferPool(4096, 1024)
+        bufs = [pool.Get(1024) for i in range(4)] + [pool.Get(4096)]
+        for buf in bufs:
+            pool.Release(buf)
+        # The oldest buffers were evicted to stay within the limit
+        self.assertEqual(pool.Idle(), 4096)
+        self.assertTrue(pool.Get(4096).obj is bufs[4].obj)
+        self.assertEqual(pool.stats['evictions'], 4)
+
+    def test_receive(self):
+        pool = BufferPool(1 << 20)
+        a, b = socket.socketpair()
+        a, b = ClientEndpoint('a', 0, a), ClientEndpoint('b', 0, b)
+        a.Write(b'x' * 5000)
+        buf = b.ReadPayload(5000, 1, pool.Get(5000))
+        self.assertEqual(bytes(buf), b'x' * 5000)
+        # Pooled buffers are passed to native code without copies
+        job = JobBinary.__new__(JobBinary)
+        ctask, ctasksz = job.to_c_array(buf)
+        buf[0] = 7
+        self.assertEqual(ctask[0], 7)
+        res = job.to_py_array(ctask, 5000, pool)
+        self.assertFalse(res.obj is buf.obj)
+        self.assertEqual(bytes(res), bytes(buf))
+        a.Close()
+        b.Close()
+
+class TestResultStore(unittest.TestCase):
+    def test_spill(self):
+        released = []
+        store = ResultStore(10, 100, 16, released.append)
+        store.put((1, 1, 0, b'a' * 8, 0))
+        store.put((2, 1, 0, b'b' * 8, 0))
+        store.put((3, 1, 0, b'c' * 8, 0))
+        store.put((4, 1, 0, b'd' * 20, 0))
+        # Only the first result fits in memory
+        self.assertEqual(store.Usage(), (8, 16 + 20))
+        self.assertEqual(len(released), 3)
+        self.assertEqual(store.qsize(), 4)
+        # The results are replayed in order
+        got = [store.get_nowait() for i in range(4)]
+        self.assertEqual([x[0] for x in got], [1, 2, 3, 4])
+        self.assertEqual([bytes(x[3]) for x in got], [b'a' * 8, b'b' * 8,
+            b'c' * 8, b'd' * 20])
+        self.assertEqual(store.Usage(), (0, 20))
+        self.assertRaises(queue.Empty, store.get_nowait)
+
+    def test_throttle(self):
+        store = ResultStore(4, 0, 16)
+        store.put((1, 1, 0, b'abcd', 0))
+        t = threading.Thread(target=store.put, args=((2, 1, 0, b'efgh', 0),))
+        t.daemon = True
+        t.start()
+        t.join(0.2)
+        # The producer waits until there is room
+        self.assertTrue(t.is_alive())
+        self.assertEqual(store.get_nowait()[0], 1)
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(store.get_nowait()[0], 2)
+        # Results put back do not wait
+        store.put((3, 1, 0, b'abcd', 0))
+        store.put((4, 1, 0, b'efgh', 0), False)
+        self.assertEqual(store.qsize(), 2)
+
+class TestResultCache(unittest.TestCase):
+    def test_evict(self):
+        cache = ResultCache(8, b'module')
+        self.assertNotEqual(cache.Key(1, b'x'), cache.Key(2, b'x'))
+        self.assertNotEqual(cache.Key(1, b'x'),
+            ResultCache(8, b'other').Key(1, b'x'))
+        cache.Put(b'a', 0, b'1234')
+        cache.Put(b'b', 0, memoryview(b'5678'))
+        self.assertEqual(cache.Get(b'a'), (0, b'1234'))
+        # The least recently used result is evicted
+        cache.Put(b'c', 0, b'90')
+        self.assertEqual(cache.Get(b'b'), None)
+        self.assertEqual(cache.Size(), 6)
+        # Results larger than the cache are not kept
+        cache.Put(b'd', 0, b'x' * 9)
+        self.assertEqual(cache.Get(b'd'), None)
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['evictions'], 1)
+
+class TestWatchdog(unittest.TestCase):
+    def test_expire(self):
+        expired = []
+        dog = Watchdog(0.1, expired.append, interval=0.05)
+        dog.start()
+        token = dog.Start('slow')
+        fast = dog.Start('fast')
+        self.assertTrue(dog.Finish(fast))
+        time.sleep(0.3)
+        # The late task is reported once and its result is dropped
+        self.assertEqual(expired, ['slow'])
+        self.assertFalse(dog.Finish(token))
+
+    def test_percentile(self):
+        dog = Watchdog(None, None, 0.5, 2.0, 4, 0.1)
+        self.assertEqual(dog.Deadline(), None)
+        dog.durations.extend([0.1, 0.2, 0.3, 0.4])
+        self.assertAlmostEqual(dog.Deadline(), 0.6)
+        dog.durations.clear()
+        dog.durations.extend([0.01] * 4)
+        self.assertEqual(dog.Deadline(), 0.1)
+
+class TestWorkerProcess(unittest.TestCase):
+    def test_payloads(self):
+        ring, peer = shm.Ring(config.shm_ring), shm.Peer()
+        small = _pack(b'abc', ring)
+        self.assertEqual(_unpack(small, peer), b'abc')
+        data = b'x' * config.shm_threshold
+        large = _pack(data, ring)
+        self.assertEqual(large[0], shm.segment)
+        self.assertEqual(_unpack(large, peer), data)
+        # The ring is removed once mapped
+        self.assertFalse(os.path.exists(shm.path(large[1])))
+        self.assertEqual(_pack(None, ring), None)
+        ring.Close()
+
+    def test_kill(self):
+        with mock.patch.object(WorkerProcess, 'Start'):
+            worker = WorkerProcess('module.so', [])
+        worker.process = mock.Mock()
+        first = worker.Tag()
+        worker.finished()
+        # The tasks finished before the watchdog killed them
+        self.assertFalse(worker.Kill(first))
+        second = worker.Tag()
+        self.assertFalse(worker.Kill(first))
+        self.assertEqual(worker.process.kill.call_count, 0)
+        self.assertTrue(worker.Kill(second))
+        self.assertEqual(worker.process.kill.call_count, 1)
+        self.assertTrue(worker.finished())
+
+class TestTaskPool(unittest.TestCase):
+    def test_free(self):
+        pool = TaskPool(2, 1, None, None, ())
+        self.assertEqual(pool.Free(), 3)
+        pool.Put(1, 1, b'x')
+        self.assertEqual(pool.Free(), 2)
+
+    def test_batch(self):
+        batches = []
+        done = threading.Event()
+        def worker(state, tasks):
+            batches.append([x[0] for x in tasks])
+            if sum(len(x) for x in batches) == 5:
+                done.set()
+        pool = TaskPool(1, 4, lambda: None, worker, (), 3)
+        for i in range(5):
+            pool.Put(i, 1, b'x')
+        pool.threads[0].daemon = True
+        pool.start()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(batches, [[0, 1, 2], [3, 4]])
+
+    def test_replace(self):
+        release = threading.Event()
+        started = threading.Event()
+        done = threading.Event()
+        def worker(state, taskid, jobid, task):
+            if taskid == 1:
+                started.set()
+                release.wait(5)
+            else:
+                done.set()
+        pool = TaskPool(1, 1, lambda: None, worker, ())
+        pool.threads[0].daemon = True
+        pool.start()
+        pool.Put(1, 1, b'x')
+        self.assertTrue(started.wait(5))
+        stuck = pool.threads[0]
+        pool.Replace(stuck)
+        # The new thread runs the next task while the other is stuck
+        pool.Put(2, 1, b'x')
+        self.assertTrue(done.wait(5))
+        self.assertEqual(len(pool.threads), 1)
+        release.set()
+        stuck.join(5)
+        self.assertFalse(stuck.is_alive())
+        self.assertEqual(len(pool.threads), 1)
+
+    def test_resize(self):
+        finalized = []
+        done = threading.Event()
+        def finalizer(state):
+            finalized.append(state)
+            if len(finalized) == 2:
+                done.set()
+        pool = TaskPool(1, 1, object, lambda *args: None, (), 1, finalizer)
+        self.assertEqual(pool.Resize(3), 3)
+        self.assertEqual(len(pool.threads), 3)
+        self.assertEqual(pool.Free(), 4)
+        for t in pool.threads:
+            t.daemon = True
+        pool.start()
+        self.assertEqual(pool.Resize(1), 1)
+        # The stop requests do not count against the capacity
+        self.assertEqual(pool.Free(), 2)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(len(pool.threads), 1)
+        self.assertEqual(len(set(id(x) for x in finalized)), 2)
+
 if __name__ == '__main__':
     unittest.main()
@@ -23,16 +23,18 @@
 # IN THE SOFTWARE.
 
 from libspitz import JobBinary, SimpleEndpoint
-from libspitz import Listener, TaskPool
-from libspitz import messaging, config
+from libspitz import Listener, TaskPool, ProcessTaskPool, WorkerProcess
+from libspitz import BufferPool, ResultStore, ResultCache
+from libspitz import messaging, config, codec, spill
 from libspitz import timeout as Timeout
-from libspitz import make_uid
+from libspitz import make_uid, Watchdog
 from libspitz import log_lines
 
 from libspitz import PerfModule
 
 import Args
 import sys, os, socket, datetime, logging, multiprocessing, struct, time, traceback
+import itertools, math, random, threading
 
 from threading import Lock
 
@@ -46,7 +48,11 @@ tm_mode = None # Addressing mode
 tm_addr = None # Bind address
 tm_port = None # Bind port
 tm_nw = None # Maximum number of workers
-tm_overfill = 0 # Extra space in the task queue 
+tm_overfill = 0 # Extra space in the task queue, None to size it automatically
+tm_tuner = None # Sizes the extra space when automatic
+tm_meter = None # Measures the task durations read by the tuner and the JM
+tm_deadline = None # Seconds a task may run, None for automatic, 0 for no limit
+tm_watchdog = None # Expires the tasks running past the deadline
 tm_announce = None # Mechanism used to broadcast TM address
 tm_log_file = None # Output file for logging
 tm_verbosity = None # Verbosity level for logging
@@ -58,6 +64,22 @@ tm_profiling = None # 1 to enable profiling
 tm_perf_rinterv = None # Profiling report interval (seconds)
 tm_perf_subsamp = None # Number of samples collected between report intervals
 tm_jobid = None
+tm_backlog = None # Pending connections queued by the listener
+tm_handlers = None # Threads serving the listener events, 0 for one per client
+tm_pool = None # Reusable buffers for task and result payloads, None to disable
+tm_native_batch = None # Tasks run per call to the module
+tm_procs = None # 1 to run the workers in child processes
+tm_nw_policy = None # Policy resizing the worker pool at runtime
+tm_nw_min = None # Minimum number of workers left by the policy
+tm_result_memory = None # Results kept in memory, 0 for no limit
+tm_result_disk = None # Results spilled to disk when the memory is full
+tm_cache = None # Results of completed tasks, None to disable
+tm_cache_limit = None # Bytes of cached results, 0 to disable
+tm_codec = codec.codec_none # Codec negotiated by the job manager
+tm_codec_threshold = 0 # Minimum size of a compressed result
+tm_jm = None # Address of the job manager to pull tasks from, None to listen
+tm_results_ready = threading.Event() # Set every time a result is queued
+tm_notifier = None # Tells the job managers watching that results are ready
 
 ###############################################################################
 # Parse global configuration
@@ -66,7 +88,10 @@ def parse_global_config(argdict):
     global tm_mode, tm_addr, tm_port, tm_nw, tm_log_file, tm_verbosity, \
         tm_overfill, tm_announce, tm_conn_timeout, tm_recv_timeout, \
         tm_send_timeout, tm_timeout, tm_profiling, tm_perf_rinterv, \
-        tm_perf_subsamp, tm_jobid
+        tm_perf_subsamp, tm_jobid, tm_backlog, tm_handlers, tm_pool, \
+        tm_native_batch, tm_procs, tm_nw_policy, tm_nw_min, \
+        tm_result_memory, tm_result_disk, tm_cache_limit, tm_deadline, \
+        tm_jm
 
     def as_int(v):
         if v == None:
@@ -84,7 +109,11 @@ def parse_global_config(argdict):
     tm_nw = int(argdict.get('nw', multiprocessing.cpu_count()))
     if tm_nw <= 0:
         tm_nw = multiprocessing.cpu_count()
-    tm_overfill = max(int(argdict.get('overfill', 0)), 0)
+    tm_overfill = argdict.get('overfill', 0)
+    if tm_overfill == 'auto':
+        tm_overfill = None
+    else:
+        tm_overfill = max(int(tm_overfill), 0)
     tm_announce = argdict.get('announce', 'none')
     tm_log_file = argdict.get('log', None)
     tm_verbosity = as_int(argdict.get('verbose', logging.INFO // 10)) * 10
@@ -96,6 +125,25 @@ def parse_global_config(argdict):
     tm_perf_rinterv = as_int(argdict.get('rinterv', 60))
     tm_perf_subsamp = as_int(argdict.get('subsamp', 12))
     tm_jobid = argdict.get('jobid', '')
+    tm_backlog = as_int(argdict.get('backlog', config.listen_backlog))
+    tm_handlers = max(as_int(argdict.get('handlers', 0)), 0)
+    tm_native_batch = max(as_int(argdict.get('nbatch', 1)), 1)
+    tm_procs = as_int(argdict.get('procs', 0))
+    tm_nw_policy = argdict.get('nwpolicy', 'none')
+    tm_nw_min = min(max(as_int(argdict.get('nwmin', 1)), 1), tm_nw)
+    tm_result_memory = as_int(argdict.get('rmem',
+        config.result_memory_limit))
+    tm_result_disk = as_int(argdict.get('rdisk', config.result_disk_limit))
+    tm_cache_limit = as_int(argdict.get('cache', 0))
+    tm_deadline = argdict.get('deadline', 0)
+    if tm_deadline == 'auto':
+        tm_deadline = None
+    else:
+        tm_deadline = max(float(tm_deadline), 0)
+    tm_jm = argdict.get('jm', None)
+    pool_limit = as_int(argdict.get('pool', config.pool_limit))
+    if pool_limit > 0:
+        tm_pool = BufferPool(pool_limit, config.pool_min, config.pool_max)
 
 ###############################################################################
 # Configure the log output format
@@ -166,111 +214,327 @@ def announce_file(addr, dirname = None):
         logging.warning('Failed to write to %s!' % (filename,))
 
 ###############################################################################
-# Server callback
+# Read a task, decompressing it if a codec was negotiated
 ###############################################################################
-def server_callback(conn, addr, port, job, tpool, cqueue, timeout):
-    logging.debug('Connected to %s:%d.', addr, port)
+def read_task(conn):
+    if conn.codec == None:
+        taskid, runid, tasksz = conn.ReadHeader(messaging.task_header,
+            tm_recv_timeout)
+        return taskid, runid, read_payload(conn, tasksz)
+    taskid, runid, tasksz, c = conn.ReadHeader(messaging.ctask_header,
+        tm_recv_timeout)
+    task = read_payload(conn, tasksz)
+    data = codec.decode(c, task)
+    if data is not task:
+        release(task)
+    return taskid, runid, data
+
+###############################################################################
+# Receive a payload straight into a pooled buffer
+###############################################################################
+def read_payload(conn, size):
+    buf = None
+    if tm_pool != None and not spill.should_spill(size):
+        buf = tm_pool.Get(size)
+    return conn.ReadPayload(size, tm_recv_timeout, buf)
+
+###############################################################################
+# Give a task or result buffer back to the pool once it is no longer used
+###############################################################################
+def release(buf):
+    if tm_pool != None:
+        tm_pool.Release(buf)
+
+###############################################################################
+# Answer a task from the cache or queue it to the workers, returns False if
+# the task was rejected
+###############################################################################
+def accept_task(tpool, cqueue, taskid, runid, task):
+    if tm_cache != None:
+        cached = tm_cache.Get(tm_cache.Key(runid, task))
+        if cached != None:
+            # Duplicate tasks do not take a worker
+            logging.info('Task %d answered from the cache.', taskid)
+            release(task)
+            r, res = cached
+            enqueue_result(cqueue, taskid, runid, r, res, False)
+            return True
+    return tpool.Put(taskid, runid, task)
+
+###############################################################################
+# Get the cache key of a task, None if the cache is disabled
+###############################################################################
+def cache_key(runid, task):
+    if tm_cache == None:
+        return None
+    return tm_cache.Key(runid, task)
 
+###############################################################################
+# Send a result, keeping it compressed only if a codec was negotiated
+###############################################################################
+def write_result(conn, taskid, runid, r, res, c):
+    if conn.codec == None:
+        res = codec.decode(c, res)
+        conn.WriteMessage(messaging.result_header, (taskid, runid, r,
+            len(res) if res != None else 0), res)
+    else:
+        conn.WriteMessage(messaging.cresult_header, (taskid, runid, r,
+            len(res) if res != None else 0, c), res)
+
+###############################################################################
+# Dequeue completed tasks until the queue is empty or the budget is reached
+###############################################################################
+def dequeue_results(cqueue, maxcount, maxbytes):
+    batch = []
+    batchsz = 0
+    while len(batch) < maxcount and batchsz < maxbytes:
+        try:
+            item = cqueue.get_nowait()
+        except queue.Empty:
+            results_drained()
+            break
+        batch.append(item)
+        batchsz += len(item[3]) if item[3] != None else 0
+    return batch
+
+###############################################################################
+# Send a batch of results, the ones not acknowledged are put back in the
+# queue. Returns False if the session is out of sync
+###############################################################################
+def send_results(conn, addr, port, cqueue, batch):
+    synced = True
     try:
-        # Send the job identifier
-        conn.WriteString(tm_jobid)
+        logging.info('Sending %d tasks to committer %s:%d...',
+            len(batch), addr, port)
 
-        # Verify job id of the answer
-        jobid = conn.ReadString(tm_recv_timeout)
+        conn.WriteInt64(len(batch))
+        for taskid, runid, r, res, c in batch:
+            write_result(conn, taskid, runid, r, res, c)
 
-        if tm_jobid != jobid:
-            logging.error('Job Id mismatch from %s:%d! Self: %s, task manager: %s!',
-                conn.address, conn.port, tm_jobid, jobid)
-            conn.Close()
-            return False
+        # Wait for the list of tasks received by the
+        # other side
+        if len(batch) > 0:
+            acked = set(conn.ReadInt64Array(tm_recv_timeout))
+            for item in batch:
+                if item[0] in acked:
+                    release(item[3])
+            batch = [x for x in batch if x[0] not in acked]
 
-        # Read the type of message
-        mtype = conn.ReadInt64(tm_recv_timeout)
-        timeout.reset()
+    except:
+        logging.warning('Error sending tasks to committer ' +
+            '%s:%d!', addr, port)
+        log_lines(traceback.format_exc(), logging.debug)
+        synced = False
+
+    # Put back the tasks that were not acknowledged
+    for item in batch:
+        cqueue.put(item, False)
+        logging.info('Task %d put back in the queue.', item[0])
+
+    return synced
+
+###############################################################################
+# Exchange the job identifiers with a newly connected job manager
+###############################################################################
+def server_handshake(conn, addr, port):
+    logging.debug('Connected to %s:%d.', addr, port)
+
+    # Send the job identifier
+    conn.WriteString(tm_jobid)
+
+    # Verify job id of the answer
+    jobid = conn.ReadString(tm_recv_timeout)
+
+    if tm_jobid != jobid:
+        logging.error('Job Id mismatch from %s:%d! Self: %s, task manager: %s!',
+            conn.address, conn.port, tm_jobid, jobid)
+        return False
+
+    return True
+
+###############################################################################
+# Serve a single request, returns False if the session must be dropped
+###############################################################################
+def server_request(conn, addr, port, job, tpool, cqueue, timeout):
+    global tm_codec, tm_codec_threshold
+
+    # Read the type of message
+    mtype = conn.ReadInt64(tm_recv_timeout)
+    timeout.reset()
 
-        # Termination signal
-        if mtype == messaging.msg_terminate:
-            logging.info('Received a kill signal from %s:%d.',
-                addr, port)
-            os._exit(0)
-
-        # Job manager is sending heartbeats
-        if mtype == messaging.msg_send_heart:
-            logging.debug('Received heartbeat from %s:%d', addr, port)
-
-        # Job manager is trying to send tasks to the task manager
-        elif mtype == messaging.msg_send_task:
-            # Two phase pull: test-try-pull
-            while not tpool.Full():
-                # Task pool is not full, start asking for data
-                conn.WriteInt64(messaging.msg_send_more)
-                taskid = conn.ReadInt64(tm_recv_timeout)
-                runid = conn.ReadInt64(tm_recv_timeout)
-                tasksz = conn.ReadInt64(tm_recv_timeout)
-                task = conn.Read(tasksz, tm_recv_timeout)
-                logging.info('Received task %d from %s:%d.',
+    # Termination signal
+    if mtype == messaging.msg_terminate:
+        logging.info('Received a kill signal from %s:%d.',
+            addr, port)
+        codec.log_stats(logging.info)
+        if tm_cache != None:
+            tm_cache.LogStats(logging.info)
+        os._exit(0)
+
+    # Job manager is negotiating the payload compression
+    if mtype == messaging.msg_set_codec:
+        offered = conn.ReadString(tm_recv_timeout)
+        threshold = conn.ReadInt64(tm_recv_timeout)
+        c = codec.choose(offered)
+        logging.info('Using codec %s with %s:%d.', codec.name(c),
+            addr, port)
+        # Results are compressed by the workers, so the codec
+        # holds for every session with the job manager
+        tm_codec = c
+        tm_codec_threshold = threshold
+        conn.codec = c
+        conn.WriteString(codec.name(c))
+
+    # Job manager is setting the number of workers, the task manager
+    # answers with the number actually used
+    elif mtype == messaging.msg_set_workers:
+        n = conn.ReadInt64(tm_recv_timeout)
+        if n > 0 and min(n, tm_nw) != tpool.Size():
+            logging.info('Resizing the worker pool from %d to %d ' +
+                'workers as requested by %s:%d.', tpool.Size(),
+                min(n, tm_nw), addr, port)
+            tpool.Resize(min(n, tm_nw))
+        conn.WriteInt64(tpool.Size())
+
+    # Job manager is asking for the capacity of the task manager
+    elif mtype == messaging.msg_query_capacity:
+        workers = tpool.Size()
+        conn.WriteMessage(messaging.capacity_header, (workers, tpool.Free(),
+            tm_meter.Rate(workers) if tm_meter != None else 0))
+
+    # Job manager is sending heartbeats
+    elif mtype == messaging.msg_send_heart:
+        logging.debug('Received heartbeat from %s:%d', addr, port)
+
+    # Job manager is trying to send tasks to the task manager
+    elif mtype == messaging.msg_send_task:
+        if tm_tuner != None:
+            tm_tuner.Refill()
+        # Two phase pull: test-try-pull
+        while not tpool.Full():
+            # Task pool is not full, start asking for data
+            conn.WriteInt64(messaging.msg_send_more)
+            taskid, runid, task = read_task(conn)
+            logging.info('Received task %d from %s:%d.',
+                taskid, addr, port)
+
+            # Try enqueue the received task
+            if not accept_task(tpool, cqueue, taskid, runid, task):
+                # For some reason the pool got full in between
+                # (shouldn't happen)
+                logging.warning('Rejecting task %d because ' +
+                    'the pool is ful!', taskid)
+                release(task)
+                conn.WriteInt64(messaging.msg_send_rjct)
+
+        # Task pool is full, stop receiving tasks
+        conn.WriteInt64(messaging.msg_send_full)
+
+    # Job manager is streaming a window of tasks
+    elif mtype == messaging.msg_send_window:
+        if tm_tuner != None:
+            tm_tuner.Refill()
+        # Advertise the free slots, the job manager will send
+        # at most that many tasks without waiting for replies
+        nfree = tpool.Free()
+        conn.WriteInt64(nfree)
+        if nfree <= 0:
+            return True
+        ntasks = conn.ReadInt64(tm_recv_timeout)
+        rejected = []
+        for i in range(ntasks):
+            taskid, runid, task = read_task(conn)
+            logging.info('Received task %d from %s:%d.',
+                taskid, addr, port)
+
+            # Try enqueue the received task
+            if not accept_task(tpool, cqueue, taskid, runid, task):
+                logging.warning('Rejecting task %d because ' +
+                    'the pool is ful!', taskid)
+                release(task)
+                rejected.append(taskid)
+
+        # Acknowledge the whole window at once
+        conn.WriteInt64Array(rejected)
+
+    # Job manager is querying the results of the completed tasks
+    elif mtype == messaging.msg_read_result:
+        taskid = None
+        try:
+            # Dequeue completed tasks until cqueue fires
+            # an Empty exception
+            while True:
+                # Pop the task
+                taskid, runid, r, res, c = cqueue.get_nowait()
+
+                logging.info('Sending task %d to committer %s:%d...',
                     taskid, addr, port)
 
-                # Try enqueue the received task
-                if not tpool.Put(taskid, runid, task):
-                    # For some reason the pool got full in between
-                    # (shouldn't happen)
-                    logging.warning('Rejecting task %d because ' +
-                        'the pool is ful!', taskid)
-                    conn.WriteInt64(messaging.msg_send_rjct)
+                # Send the task
+                write_result(conn, taskid, runid, r, res, c)
 
-            # Task pool is full, stop receiving tasks
-            conn.WriteInt64(messaging.msg_send_full)
+                # Wait for the confirmation that the task has
+                # been received by the other side
+                ans = conn.ReadInt64(messaging.msg_read_result)
+                if ans != messaging.msg_read_result:
+                    logging.warning('Unknown response received from '+
+                        '%s:%d while committing task!', addr, port)
+                    raise messaging.MessagingError()
 
-        # Job manager is querying the results of the completed tasks
-        elif mtype == messaging.msg_read_result:
-            taskid = None
-            try:
-                # Dequeue completed tasks until cqueue fires
-                # an Empty exception
-                while True:
-                    # Pop the task
-                    taskid, runid, r, res = cqueue.get_nowait()
-
-                    logging.info('Sending task %d to committer %s:%d...',
-                        taskid, addr, port)
-
-                    # Send the task
-                    conn.WriteInt64(taskid)
-                    conn.WriteInt64(runid)
-                    conn.WriteInt64(r)
-                    if res == None:
-                        conn.WriteInt64(0)
-                    else:
-                        conn.WriteInt64(len(res))
-                        conn.Write(res)
-
-                    # Wait for the confirmation that the task has
-                    # been received by the other side
-                    ans = conn.ReadInt64(messaging.msg_read_result)
-                    if ans != messaging.msg_read_result:
-                        logging.warning('Unknown response received from '+
-                            '%s:%d while committing task!', addr, port)
-                        raise messaging.MessagingError()
-
-                    taskid = None
-
-            except queue.Empty:
-                # Finish the response
-                conn.WriteInt64(messaging.msg_read_empty)
+                release(res)
+                taskid = None
 
-            except:
-                # Something went wrong while sending, put
-                # the last task back in the queue
-                if taskid != None:
-                    cqueue.put((taskid, runid, r, res))
-                    logging.info('Task %d put back in the queue.', taskid)
-                pass
-
-        # Unknow message received or a wrong sized packet could be trashing
-        # the buffer, don't do anything
-        else:
-            logging.warning('Unknown message received \'%d\'!', mtype)
+        except queue.Empty:
+            results_drained()
+            # Finish the response
+            conn.WriteInt64(messaging.msg_read_empty)
+
+        except:
+            # Something went wrong while sending, put
+            # the last task back in the queue
+            if taskid != None:
+                cqueue.put((taskid, runid, r, res, c), False)
+                logging.info('Task %d put back in the queue.', taskid)
+            # The session is out of sync, drop it
+            return False
+
+    # Job manager is pulling a batch of completed tasks
+    elif mtype == messaging.msg_read_batch:
+        maxcount = conn.ReadInt64(tm_recv_timeout)
+        maxbytes = conn.ReadInt64(tm_recv_timeout)
+
+        batch = dequeue_results(cqueue, maxcount, maxbytes)
+
+        # The session is out of sync, drop it
+        if not send_results(conn, addr, port, cqueue, batch):
+            return False
+
+    # Job manager wants to be told when results are ready, the session
+    # is kept open for the notifications
+    elif mtype == messaging.msg_watch_results:
+        threshold = conn.ReadInt64(tm_recv_timeout)
+        logging.info('Notifying %s:%d of the results ready.', addr, port)
+        tm_notifier.Subscribe(conn, threshold)
+
+    # Unknow message received or a wrong sized packet could be trashing
+    # the buffer, drop the session
+    else:
+        logging.warning('Unknown message received \'%d\'!', mtype)
+        return False
+
+    return True
+
+###############################################################################
+# Serve the handshake or the next request of a session, returns False and
+# closes the session if it must be dropped
+###############################################################################
+def server_event(conn, addr, port, job, tpool, cqueue, timeout, accept=False):
+    try:
+        if accept:
+            if server_handshake(conn, addr, port):
+                return True
+        elif server_request(conn, addr, port, job, tpool, cqueue, timeout):
+            return True
 
     except messaging.SocketClosed:
         logging.debug('Connection to %s:%d closed from the other side.',
@@ -284,8 +548,117 @@ def server_callback(conn, addr, port, job, tpool, cqueue, timeout):
             addr, port)
         log_lines(traceback.format_exc(), logging.debug)
 
+    codec.log_stats(logging.debug)
+    if tm_pool != None:
+        tm_pool.LogStats(logging.debug)
+    if isinstance(cqueue, ResultStore):
+        cqueue.LogStats(logging.debug)
+    if tm_cache != None:
+        tm_cache.LogStats(logging.debug)
     conn.Close()
     logging.debug('Connection to %s:%d closed.', addr, port)
+    return False
+
+###############################################################################
+# Accept callback for the event listener
+###############################################################################
+def server_accept(conn, addr, port, job, tpool, cqueue, timeout):
+    return server_event(conn, addr, port, job, tpool, cqueue, timeout, True)
+
+###############################################################################
+# Server callback
+###############################################################################
+def server_callback(conn, addr, port, job, tpool, cqueue, timeout):
+    if server_event(conn, addr, port, job, tpool, cqueue, timeout, True):
+        # Serve requests until the job manager closes the session
+        while server_event(conn, addr, port, job, tpool, cqueue, timeout):
+            pass
+
+###############################################################################
+# Push the queued results to the job manager and ask for as many tasks as
+# there are free slots, returns the number of results and tasks exchanged
+# or None when the job manager finished the job
+###############################################################################
+def pull_exchange(conn, addr, port, tpool, cqueue, timeout):
+    batch = dequeue_results(cqueue, config.push_batch,
+        config.push_batch_bytes)
+    if len(batch) > 0:
+        conn.WriteInt64(messaging.msg_push_results)
+        if not send_results(conn, addr, port, cqueue, batch):
+            raise messaging.MessagingError()
+        timeout.reset()
+
+    if tm_tuner != None:
+        tm_tuner.Refill()
+    nfree = max(tpool.Free(), 0)
+    conn.WriteInt64(messaging.msg_pull_tasks)
+    conn.WriteInt64(nfree)
+    ntasks = conn.ReadInt64(tm_recv_timeout)
+    if ntasks < 0:
+        return None
+
+    rejected = []
+    for i in range(ntasks):
+        taskid, runid, task = read_task(conn)
+        logging.info('Received task %d from %s:%d.',
+            taskid, addr, port)
+
+        # Try enqueue the received task
+        if not accept_task(tpool, cqueue, taskid, runid, task):
+            logging.warning('Rejecting task %d because ' +
+                'the pool is ful!', taskid)
+            release(task)
+            rejected.append(taskid)
+
+    if ntasks > 0:
+        # Acknowledge all the tasks at once
+        conn.WriteInt64Array(rejected)
+        timeout.reset()
+
+    return len(batch) + ntasks
+
+###############################################################################
+# Connect to the job manager and pull tasks whenever there are free slots,
+# until the job manager finishes the job
+###############################################################################
+def puller(tpool, cqueue, timeout):
+    host, port = tm_jm.rsplit(':', 1)
+    port = int(port)
+    while True:
+        conn = SimpleEndpoint(host, port)
+        try:
+            conn.Open(tm_conn_timeout)
+            if server_handshake(conn, host, port):
+                logging.info('Pulling tasks from %s:%d...', host, port)
+                while True:
+                    tm_results_ready.clear()
+                    n = pull_exchange(conn, host, port, tpool, cqueue,
+                        timeout)
+                    if n == None:
+                        break
+                    if n == 0:
+                        # Wait for a result or ask again later
+                        tm_results_ready.wait(config.send_backoff)
+
+                logging.info('The job manager at %s:%d finished the job.',
+                    host, port)
+                codec.log_stats(logging.info)
+                if tm_cache != None:
+                    tm_cache.LogStats(logging.info)
+                os._exit(0)
+
+        except messaging.SocketClosed:
+            logging.debug('Connection to %s:%d closed from the other side.',
+                host, port)
+
+        except:
+            # Because this is a connection event,
+            # make it a debug rather than a warning
+            logging.debug('Error pulling tasks from %s:%d!', host, port)
+            log_lines(traceback.format_exc(), logging.debug)
+
+        conn.Close()
+        time.sleep(config.send_backoff)
 
 ###############################################################################
 # Initializer routine for the worker
@@ -294,6 +667,33 @@ def initializer(cqueue, job, argv, active_workers, timeout):
     logging.info('Initializing worker...')
     return job.spits_worker_new(argv)
 
+###############################################################################
+# Finalize the worker of a retiring thread
+###############################################################################
+def finalizer(state, cqueue, job, argv, active_workers, timeout):
+    logging.info('Finalizing worker...')
+    worker_runner(state, job).spits_worker_finalize(state)
+
+###############################################################################
+# Resize the worker pool following the load of the node
+###############################################################################
+def resize_by_load(tpool, active_workers):
+    while True:
+        time.sleep(config.nw_policy_interval)
+        try:
+            # Leave to the workers the processors not used by
+            # other processes
+            load = os.getloadavg()[0] - active_workers.get()
+            n = int(multiprocessing.cpu_count() - max(load, 0))
+            n = min(max(n, tm_nw_min), tm_nw)
+        except OSError:
+            logging.warning('Could not read the load average!')
+            return
+        if n != tpool.Size():
+            logging.info('Resizing the worker pool from %d to %d workers.',
+                tpool.Size(), n)
+            tpool.Resize(n)
+
 ###############################################################################
 # Worker routine
 ###############################################################################
@@ -302,23 +702,137 @@ def worker(state, taskid, runid, task, cqueue, job, argv, active_workers, timeou
     active_workers.inc()
     logging.info('Processing task %d from job %d...', taskid, runid)
 
-    # Execute the task using the job module
-    r, res, ctx = job.spits_worker_run(state, task, taskid)
+    # Execute the task using the job module, the results are queued
+    # as they are pushed
+    stream = ResultStream(taskid, runid, cqueue, cache_key(runid, task))
+    token = watch(state, cqueue, [stream])
+    start = time.time()
+    r, res, ctx = worker_runner(state, job).spits_worker_run(state, task,
+        taskid, tm_pool, stream.Push)
+    task_done(time.time() - start)
+    release(task)
 
     logging.info('Task %d processed.', taskid)
 
-    if res == None:
-        logging.error('Task %d did not push any result!', taskid)
-        return
+    if unwatch(token):
+        stream.End(r)
+    else:
+        stream.Drop()
+    active_workers.dec()
+
+###############################################################################
+# Worker routine running a batch of tasks with a single call to the module
+###############################################################################
+def worker_batch(state, tasks, cqueue, job, argv, active_workers, timeout):
+    timeout.reset()
+    active_workers.inc()
+    logging.info('Processing tasks %s...', [x[0] for x in tasks])
 
-    if ctx != taskid:
-        logging.error('Context verification failed for task %d!', taskid)
-        return
+    # Execute the tasks using the job module
+    streams = [ResultStream(taskid, runid, cqueue, cache_key(runid, task))
+        for taskid, runid, task in tasks]
+    token = watch(state, cqueue, streams)
+    start = time.time()
+    results = worker_runner(state, job).spits_worker_run_batch(state,
+        [x[2] for x in tasks], [x[0] for x in tasks], tm_pool,
+        [x.Push for x in streams])
+    task_done(time.time() - start, len(tasks))
 
-    # Enqueue the result
-    cqueue.put((taskid, runid, r, res[0]))
+    expired = not unwatch(token)
+    for (taskid, runid, task), (r, res, ctx), stream in zip(tasks, results,
+            streams):
+        release(task)
+        logging.info('Task %d processed.', taskid)
+        if expired:
+            stream.Drop()
+        else:
+            stream.End(r)
     active_workers.dec()
 
+###############################################################################
+# Record the time taken by count tasks run together
+###############################################################################
+def task_done(elapsed, count=1):
+    if tm_meter != None:
+        tm_meter.Task(elapsed, count)
+
+###############################################################################
+# Watch the streams of the tasks run by a worker, returns the token of the
+# watch or None if there is no deadline. The tasks sent to a worker process
+# are tagged so an expired watch only kills the process if it still runs them
+###############################################################################
+def watch(state, cqueue, streams):
+    if tm_watchdog == None:
+        return None
+    tag = state.Tag() if isinstance(state, WorkerProcess) else None
+    return tm_watchdog.Start((state, threading.current_thread(), cqueue,
+        streams, tag), len(streams))
+
+###############################################################################
+# Stop watching the tasks, returns False if they expired
+###############################################################################
+def unwatch(token):
+    if token == None:
+        return True
+    return tm_watchdog.Finish(token)
+
+###############################################################################
+# Report the tasks of an expired watch as timed out and free their worker
+###############################################################################
+def expire_tasks(tpool, data):
+    state, thread, cqueue, streams, tag = data
+    for stream in streams:
+        logging.warning('Task %d exceeded its deadline!', stream.taskid)
+        # The results the task still pushes are dropped, the job manager
+        # schedules it again right away
+        stream.Expire()
+        enqueue_result(cqueue, stream.taskid, stream.runid,
+            messaging.as_result(messaging.res_module_timeout), b'', False)
+    if isinstance(state, WorkerProcess):
+        pid = state.process.pid
+        if state.Kill(tag):
+            logging.warning('Killed the worker process %d.', pid)
+    else:
+        # The thread cannot be stopped, it retires if it ever returns
+        logging.warning('Replacing the stuck worker thread %s...',
+            thread.name)
+        tpool.Replace(thread)
+
+###############################################################################
+# Worker processes run the native code themselves
+###############################################################################
+def worker_runner(state, job):
+    return state if isinstance(state, WorkerProcess) else job
+
+###############################################################################
+# Compress a result and queue it to be sent. The network and watchdog threads
+# pass block False, they must not wait for the job managers to make room
+###############################################################################
+def enqueue_result(cqueue, taskid, runid, r, res, block=True):
+    # Compress the result here so the network threads do not have to
+    c, data = codec.encode(tm_codec, res, tm_codec_threshold)
+    if data is not res:
+        release(res)
+
+    # Enqueue the result
+    cqueue.put((taskid, runid, r, data, c), block)
+    results_queued(len(data) if data != None else 0)
+
+###############################################################################
+# Wake up the puller and notify the job managers watching the results
+###############################################################################
+def results_queued(size):
+    tm_results_ready.set()
+    if tm_notifier != None:
+        tm_notifier.Queued(size)
+
+###############################################################################
+# Rearm the notifications once the job managers emptied the result queue
+###############################################################################
+def results_drained():
+    if tm_notifier != None:
+        tm_notifier.Drained()
+
 ###############################################################################
 # Run routine
 ###############################################################################
@@ -343,17 +857,258 @@ class AtomicInc(object):
         return self.value
 
 
+class TaskMeter(object):
+    """Measure the average duration of the recent tasks, read by the
+       overfill tuner and by the throughput reported to the job manager."""
+
+    def __init__(self, weight=0.2):
+        self.weight = weight
+        self.duration = None
+        self.lock = Lock()
+
+    def Task(self, elapsed, count=1):
+        with self.lock:
+            if self.duration == None:
+                self.duration = elapsed / count
+            else:
+                self.duration += self.weight * (elapsed / count -
+                    self.duration)
+
+    def Duration(self):
+        """Get the average duration of a task, None if no task was run
+           yet."""
+        with self.lock:
+            return self.duration
+
+    def Rate(self, workers):
+        """Get the tasks run per second by workers, 0 if no task was
+           run yet."""
+        duration = self.Duration()
+        if duration == None:
+            return 0.0
+        return workers / max(duration, 1e-6)
+
+class OverfillTuner(object):
+    """Size the extra space of the task queue so the workers do not run
+       out of tasks between two refills by the job manager. The queue
+       must hold the tasks run by all workers in the average interval
+       between refills, given the average task duration measured by
+       meter."""
+
+    def __init__(self, tpool, meter, max_overfill, weight=0.2):
+        self.tpool = tpool
+        self.meter = meter
+        self.max_overfill = max_overfill
+        self.weight = weight
+        self.interval = None
+        self.last = None
+        self.lock = Lock()
+
+    def average(self, avg, value):
+        if avg == None:
+            return value
+        return avg + self.weight * (value - avg)
+
+    def Refill(self):
+        now = time.time()
+        with self.lock:
+            if self.last != None:
+                self.interval = self.average(self.interval, now - self.last)
+            self.last = now
+            interval = self.interval
+        duration = self.meter.Duration()
+        if duration == None or interval == None:
+            return
+        workers = self.tpool.Size()
+        n = int(math.ceil(workers * interval / max(duration, 1e-6)))
+        n = min(n, self.max_overfill)
+        current = self.tpool.Overfill()
+        # Avoid resizing the queue on every small variation
+        if abs(n - current) <= current // 8:
+            return
+        logging.info('Queue overfill set to %d: %d workers, tasks take ' +
+            '%.2fms and refills come every %.2fms.', n, workers,
+            duration * 1000, interval * 1000)
+        self.tpool.SetOverfill(n)
+
+# Identifiers of the task attempts, starting at random so the attempts of
+# different task managers do not collide
+tm_attempts = itertools.count(random.getrandbits(31))
+
+class ResultStream(object):
+    """Queue the results pushed by a task. A task pushing a single result
+       sends it as a regular result when it ends. When more results are
+       pushed, each one is queued as a partial result as soon as it is
+       pushed and the task ends with an end record. Single results of
+       successful tasks are cached under key when it is not None."""
+
+    def __init__(self, taskid, runid, cqueue, key=None):
+        self.taskid = taskid
+        self.runid = runid
+        self.cqueue = cqueue
+        self.key = key
+        self.held = None
+        self.attempt = None
+        self.count = 0
+        self.expired = False
+
+    def Push(self, res, ctx):
+        if ctx != self.taskid:
+            logging.error('Context verification failed for task %d!',
+                self.taskid)
+            release(res)
+            return
+        if self.expired:
+            # The task was reported as timed out
+            release(res)
+            return
+        if self.attempt == None:
+            if self.held == None:
+                # Hold the first result, it may be the only one
+                self.held = res
+                return
+            self.attempt = next(tm_attempts)
+            logging.debug('Streaming the results of task %d...',
+                self.taskid)
+            self.put(self.held)
+            self.held = None
+        self.put(res)
+
+    def put(self, res):
+        r = messaging.stream_result(self.attempt, self.count)
+        self.count += 1
+        enqueue_result(self.cqueue, self.taskid, self.runid, r, res)
+
+    def Expire(self):
+        # Called from the watchdog thread, the results pushed from now on
+        # are dropped
+        self.expired = True
+
+    def Drop(self):
+        if self.held != None:
+            release(self.held)
+            self.held = None
+        logging.warning('Dropping the results of task %d, it was ' +
+            'reported as timed out.', self.taskid)
+
+    def End(self, r):
+        if self.attempt != None:
+            # The payload of the end record is the return code
+            self.cqueue.put((self.taskid, self.runid,
+                messaging.stream_result(self.attempt, self.count, True),
+                messaging.int64_header.pack(r), codec.codec_none))
+            results_queued(messaging.int64_header.size)
+        elif self.held == None and r == WorkerProcess.crashed:
+            # Report the task as failed
+            enqueue_result(self.cqueue, self.taskid, self.runid, r, b'')
+        elif self.held == None:
+            logging.error('Task %d did not push any result!', self.taskid)
+        else:
+            if self.key != None and r == 0:
+                tm_cache.Put(self.key, r, self.held)
+            enqueue_result(self.cqueue, self.taskid, self.runid, r,
+                self.held)
+
+class ResultNotifier(object):
+    """Tell the job managers watching the results when the result queue
+       stops being empty or when more than threshold bytes were queued
+       since the last notification."""
+
+    def __init__(self, cqueue):
+        self.cqueue = cqueue
+        self.watchers = []
+        self.threshold = 0
+        self.armed = True
+        self.pending = 0
+        self.lock = Lock()
+
+    def Subscribe(self, conn, threshold):
+        with self.lock:
+            self.watchers.append(conn)
+            self.threshold = threshold
+            # Tell about the results queued before
+            if not self.cqueue.empty():
+                self.notify()
+
+    def Queued(self, size):
+        with self.lock:
+            self.pending += size
+            if len(self.watchers) > 0 and (self.armed or
+                    self.pending >= self.threshold):
+                self.notify()
+
+    def Drained(self):
+        with self.lock:
+            self.armed = True
+            self.pending = 0
+            # A result may have been queued after the queue was found
+            # empty and before it was rearmed
+            if len(self.watchers) > 0 and not self.cqueue.empty():
+                self.notify()
+
+    def notify(self):
+        values = (messaging.msg_results_ready, self.cqueue.qsize(),
+            self.pending)
+        self.armed = False
+        self.pending = 0
+        for conn in list(self.watchers):
+            try:
+                conn.WriteMessage(messaging.ready_header, values)
+            except:
+                # The job manager closed the session
+                log_lines(traceback.format_exc(), logging.debug)
+                self.watchers.remove(conn)
+
 class App(object):
     def __init__(self, args):
+        global tm_cache, tm_tuner, tm_watchdog, tm_notifier, tm_meter
         self.args = args
         self.timeout = Timeout(tm_timeout, self.timeout_exit)
         self.job = JobBinary(args.margs[0])
-        self.cqueue = queue.Queue()
+        if tm_cache_limit > 0:
+            # The results depend on the module and its arguments
+            tm_cache = ResultCache(tm_cache_limit,
+                '\0'.join(args.margs).encode('utf-8'))
+        if tm_result_memory > 0:
+            # Spill the results when the job manager falls behind
+            self.cqueue = ResultStore(tm_result_memory, tm_result_disk,
+                config.result_segment, release)
+        else:
+            self.cqueue = queue.Queue()
+        tm_notifier = ResultNotifier(self.cqueue)
+        tm_meter = TaskMeter()
         self.active_workers = AtomicInc()
         data = (self.cqueue, self.job, self.args.margs, self.active_workers, self.timeout)
-        self.tpool = TaskPool(tm_nw, tm_overfill, initializer, worker, data)
-        self.server = Listener(tm_mode, tm_addr, tm_port, server_callback,
-                               (self.job, self.tpool, self.cqueue, self.timeout))
+        # Tasks already queued are run together with a single call to
+        # the module when batching
+        target = worker_batch if tm_native_batch > 1 else worker
+        # Start with room for another round of tasks until the
+        # overfill is measured
+        overfill = tm_overfill if tm_overfill != None else tm_nw
+        if tm_procs == 1:
+            # Isolate the native code from the task manager
+            self.tpool = ProcessTaskPool(tm_nw, overfill,
+                self.job.filename, args.margs, target, data, tm_native_batch,
+                finalizer)
+        else:
+            self.tpool = TaskPool(tm_nw, overfill, initializer, target,
+                data, tm_native_batch, finalizer)
+        if tm_overfill == None:
+            tm_tuner = OverfillTuner(self.tpool, tm_meter,
+                config.overfill_max)
+        if tm_deadline != 0:
+            tm_watchdog = Watchdog(tm_deadline,
+                lambda data: expire_tasks(self.tpool, data),
+                config.deadline_percentile, config.deadline_factor,
+                config.deadline_samples, config.deadline_min)
+        # With handlers the listener calls back for each request instead
+        # of once for the whole session
+        callback = server_event if tm_handlers > 0 else server_callback
+        self.server = None
+        if tm_jm == None:
+            self.server = Listener(tm_mode, tm_addr, tm_port, callback,
+                                   (self.job, self.tpool, self.cqueue, self.timeout),
+                                   tm_backlog, tm_handlers, server_accept)
 
     def run(self):
         argv = self.args.margs
@@ -363,6 +1118,19 @@ class App(object):
         self.timeout.reset()
         logging.info('Starting workers...')
         self.tpool.start()
+        if tm_watchdog != None:
+            tm_watchdog.start()
+        if tm_nw_policy == 'load':
+            t = threading.Thread(target=resize_by_load,
+                args=(self.tpool, self.active_workers))
+            t.daemon = True
+            t.start()
+        elif tm_nw_policy != 'none':
+            logging.warning('Unknown worker policy %s!', tm_nw_policy)
+        if self.server == None:
+            # The job manager is listening, connect to it instead
+            puller(self.tpool, self.cqueue, self.timeout)
+            return
         logging.info('Starting network listener...')
         self.server.Start()
         addr = self.server.GetConnectableAddr()